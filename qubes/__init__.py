@@ -32,6 +32,7 @@ import collections
 import os
 import os.path
 import string
+import weakref
 
 import lxml.etree
 import qubes.config
@@ -55,6 +56,8 @@ class Label(object):
     :param str name: label's name like "red" or "green"
     '''
 
+    __slots__ = ('index', 'color', 'name', 'icon', 'icon_dispvm')
+
     def __init__(self, index, color, name):
         #: numeric identificator of label
         self.index = index
@@ -160,6 +163,13 @@ class property(object):  # pylint: disable=redefined-builtin,invalid-name
     :param int order: order of evaluation (bigger order values are later)
     :param bool clone: :py:meth:`PropertyHolder.clone_properties` will not \
         include this property by default if :py:obj:`False`
+    :param default_depends: if not :py:obj:`None`, callable default is \
+        memoized until one of those properties changes; each one is a name \
+        of other property of the holder, or dotted path to property of other \
+        holder (like ``'app.default_netvm'`` or ``'template.default_user'``); \
+        attributes on the path which are not properties are assumed to never \
+        change
+    :type default_depends: iterable of :py:class:`str`
     :param str doc: docstring; this should be one paragraph of plain RST, no \
         sphinx-specific features
 
@@ -192,7 +202,7 @@ class property(object):  # pylint: disable=redefined-builtin,invalid-name
 
     def __init__(self, name, setter=None, saver=None, type=None,
             default=_NO_DEFAULT, write_once=False, load_stage=2, order=0,
-            save_via_ref=False, clone=True,
+            save_via_ref=False, clone=True, default_depends=None,
             doc=None):
         # pylint: disable=redefined-builtin
         self.__name__ = name
@@ -208,6 +218,11 @@ class property(object):  # pylint: disable=redefined-builtin,invalid-name
         self.clone = clone
         self.__doc__ = doc
         self._attr_name = '_qubesprop_' + name
+        self._default_depends = None
+        if default_depends is not None \
+                and isinstance(default, collections.Callable):
+            self._default_depends = tuple(tuple(path.split('.'))
+                for path in default_depends)
 
     def __get__(self, instance, owner):
         if instance is None:
@@ -225,11 +240,43 @@ class property(object):  # pylint: disable=redefined-builtin,invalid-name
             if self._default is self._NO_DEFAULT:
                 raise AttributeError(
                     'property {!r} not set'.format(self.__name__))
+            elif self._default_depends is not None:
+                return self._get_memoized_default(instance)
             elif isinstance(self._default, collections.Callable):
                 return self._default(instance)
             else:
                 return self._default
 
+    def _get_memoized_default(self, instance):
+        cache = instance.__dict__.get('_property_defaults')
+        if cache is None:
+            cache = instance.__dict__['_property_defaults'] = {}
+        try:
+            return cache[self.__name__]
+        except KeyError:
+            pass
+        value = self._default(instance)
+        self._watch_default_depends(instance)
+        cache[self.__name__] = value
+        return value
+
+    def _watch_default_depends(self, instance):
+        '''Register memoized default value of *instance* to be invalidated
+        when any of the properties it depends on changes'''
+        # pylint: disable=protected-access
+        for path in self._default_depends:
+            holder = instance
+            for name in path[:-1]:
+                if isinstance(holder, PropertyHolder):
+                    holder._property_watch(name, instance, self.__name__)
+                holder = getattr(holder, name, None)
+                if holder is None:
+                    break
+            else:
+                if isinstance(holder, PropertyHolder):
+                    holder._property_watch(path[-1], instance,
+                        self.__name__)
+
 
     def __set__(self, instance, value):
         self._enforce_write_once(instance)
@@ -282,6 +329,8 @@ class property(object):  # pylint: disable=redefined-builtin,invalid-name
                 pre_event=True,
                 name=self.__name__, oldvalue=oldvalue)
             delattr(instance, self._attr_name)
+            # pylint: disable=protected-access
+            instance._property_changed(self.__name__)
             instance.fire_event('property-del:' + self.__name__,
                 name=self.__name__, oldvalue=oldvalue)
 
@@ -427,7 +476,68 @@ def stateless_property(func):
         doc=func.__doc__)
 
 
-class PropertyHolder(qubes.events.Emitter):
+class PropertyTable(object):
+    '''Properties of a :py:class:`PropertyHolder` class, precomputed
+
+    :param PropertyHolderMeta cls: class to compute properties of
+    '''
+
+    __slots__ = ('generation', 'props', 'by_name', 'by_stage',
+        'names_by_stage')
+
+    def __init__(self, cls):
+        #: value of :py:attr:`PropertyHolderMeta.generation`, for which the
+        #: table was computed
+        self.generation = PropertyHolderMeta.generation
+
+        by_name = {}
+        for class_ in cls.__mro__:
+            for prop in class_.__dict__.values():
+                # first one found in MRO wins, like in attribute lookup
+                if isinstance(prop, property) \
+                        and prop.__name__ not in by_name:
+                    by_name[prop.__name__] = prop
+
+        #: all properties, sorted
+        self.props = tuple(sorted(by_name.values()))
+        #: properties by name
+        self.by_name = by_name
+        #: sorted properties of each ``load_stage``
+        self.by_stage = {}
+        for prop in self.props:
+            self.by_stage.setdefault(prop.load_stage, []).append(prop)
+        #: names of properties of each ``load_stage``
+        self.names_by_stage = {}
+        for load_stage, props in self.by_stage.items():
+            self.by_stage[load_stage] = tuple(props)
+            self.names_by_stage[load_stage] = frozenset(
+                prop.__name__ for prop in props)
+
+
+class PropertyHolderMeta(qubes.events.EmitterMeta):
+    '''Metaclass for :py:class:`PropertyHolder`
+
+    Tracks changes of properties of already created classes, so
+    precomputed :py:class:`PropertyTable` can be recomputed.
+    '''
+
+    #: incremented each time a property is added to or removed from a class;
+    #: as this may affect also subclasses, all tables are recomputed then
+    generation = 0
+
+    def __setattr__(cls, name, value):
+        if isinstance(value, property) \
+                or isinstance(cls.__dict__.get(name), property):
+            PropertyHolderMeta.generation += 1
+        super(PropertyHolderMeta, cls).__setattr__(name, value)
+
+    def __delattr__(cls, name):
+        if isinstance(cls.__dict__.get(name), property):
+            PropertyHolderMeta.generation += 1
+        super(PropertyHolderMeta, cls).__delattr__(name)
+
+
+class PropertyHolder(qubes.events.Emitter, metaclass=PropertyHolderMeta):
     '''Abstract class for holding :py:class:`qubes.property`
 
     Events fired by instances of this class:
@@ -488,7 +598,7 @@ class PropertyHolder(qubes.events.Emitter):
 
         propvalues = {}
 
-        all_names = set(prop.__name__ for prop in self.property_list())
+        all_names = self.property_table().by_name
         for key in list(kwargs):
             if not key in all_names:
                 continue
@@ -501,8 +611,6 @@ class PropertyHolder(qubes.events.Emitter):
 
         if self.xml is not None:
             # check if properties are appropriate
-            all_names = set(prop.__name__ for prop in self.property_list())
-
             for node in self.xml.xpath('./properties/property'):
                 name = node.get('name')
                 if name not in all_names:
@@ -510,6 +618,22 @@ class PropertyHolder(qubes.events.Emitter):
                         'property {!r} not applicable to {!r}'.format(
                             name, self.__class__.__name__))
 
+    @classmethod
+    def property_table(cls):
+        '''Precomputed properties of this class
+
+        Computed on first use and each time properties of any class change.
+
+        :rtype: :py:class:`PropertyTable`
+        '''
+
+        # not inherited, each class has its own
+        table = cls.__dict__.get('_property_table')
+        if table is None or table.generation != PropertyHolderMeta.generation:
+            table = PropertyTable(cls)
+            cls._property_table = table
+        return table
+
     @classmethod
     def property_list(cls, load_stage=None):
         '''List all properties attached to this VM's class
@@ -518,14 +642,10 @@ class PropertyHolder(qubes.events.Emitter):
         :type load_stage: :py:func:`int` or :py:obj:`None`
         '''
 
-        props = set()
-        for class_ in cls.__mro__:
-            props.update(prop for prop in class_.__dict__.values()
-                if isinstance(prop, property))
+        table = cls.property_table()
         if load_stage is not None:
-            props = set(prop for prop in props
-                if prop.load_stage == load_stage)
-        return sorted(props)
+            return list(table.by_stage.get(load_stage, ()))
+        return list(table.props)
 
     def _property_init(self, prop, value):
         '''Initialise property to a given value, without side effects.
@@ -534,9 +654,65 @@ class PropertyHolder(qubes.events.Emitter):
         :param value: value
         '''
 
+        prop = self.property_get_def(prop)
         # pylint: disable=protected-access
-        setattr(self, self.property_get_def(prop)._attr_name, value)
+        setattr(self, prop._attr_name, value)
+        self._property_changed(prop.__name__)
+
+    def _property_watch(self, name, watcher, dependent):
+        '''Invalidate memoized default of other holder when property changes
+
+        Watching the same property again does nothing. The other holder is
+        referenced weakly and forgotten once removed. Entries are keyed by
+        :py:func:`id`, because holders may be not hashable yet while
+        loading.
+
+        :param str name: name of property of this holder
+        :param PropertyHolder watcher: holder of memoized default
+        :param str dependent: name of property with memoized default
+        '''
+
+        dependents = self.__dict__.get('_property_dependents')
+        if dependents is None:
+            dependents = self.__dict__['_property_dependents'] = {}
+        watchers = dependents.setdefault(name, {})
+        key = id(watcher)
+        entry = watchers.get(key)
+        if entry is not None and entry[0]() is watcher:
+            entry[1].add(dependent)
+            return
+
+        def forget(ref):
+            if watchers.get(key, (None,))[0] is ref:
+                del watchers[key]
+        watchers[key] = (weakref.ref(watcher, forget), {dependent})
 
+    def _property_changed(self, name):
+        '''Invalidate memoized defaults depending on a property
+
+        This is called whenever value of the property is set or deleted,
+        even if events are disabled (like while loading).
+
+        :param str name: name of property, which value has changed
+        '''
+
+        cache = self.__dict__.get('_property_defaults')
+        if cache:
+            cache.pop(name, None)
+        dependents = self.__dict__.get('_property_dependents')
+        if not dependents:
+            return
+        watchers = dependents.pop(name, None)
+        if not watchers:
+            return
+        # popped before recursing, so cycles end here
+        for ref, names in list(watchers.values()):
+            watcher = ref()
+            if watcher is None:
+                continue
+            for dependent in names:
+                # pylint: disable=protected-access
+                watcher._property_changed(dependent)
 
     def property_is_default(self, prop):
         '''Check whether property is in it's default value.
@@ -571,9 +747,10 @@ class PropertyHolder(qubes.events.Emitter):
         if isinstance(prop, qubes.property):
             return prop
 
-        for p in cls.property_list():
-            if p.__name__ == prop:
-                return p
+        try:
+            return cls.property_table().by_name[prop]
+        except (KeyError, TypeError):
+            pass
 
         raise AttributeError('No property {!r} found in {!r}'.format(
             prop, cls))
@@ -589,8 +766,11 @@ class PropertyHolder(qubes.events.Emitter):
 
         if self.xml is None:
             return
-        all_names = set(
-            prop.__name__ for prop in self.property_list(load_stage))
+        table = self.property_table()
+        if load_stage is None:
+            all_names = table.by_name
+        else:
+            all_names = table.names_by_stage.get(load_stage, ())
         for node in self.xml.xpath('./properties/property'):
             name = node.get('name')
             value = node.get('ref') or node.text
@@ -612,7 +792,7 @@ class PropertyHolder(qubes.events.Emitter):
 
         properties = lxml.etree.Element('properties')
 
-        for prop in self.property_list():
+        for prop in self.property_table().props:
             # pylint: disable=protected-access
             try:
                 value = getattr(
@@ -646,10 +826,10 @@ class PropertyHolder(qubes.events.Emitter):
         '''
 
         if proplist is None:
-            proplist = [prop for prop in self.property_list()
+            proplist = [prop for prop in self.property_table().props
                 if prop.clone]
         else:
-            proplist = [prop for prop in self.property_list()
+            proplist = [prop for prop in self.property_table().props
                 if prop.__name__ in proplist or prop in proplist]
 
         for prop in proplist:
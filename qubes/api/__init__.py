@@ -27,8 +27,11 @@ import os
 import shutil
 import socket
 import struct
+import time
 import traceback
 
+import qubes.api.metrics
+import qubes.api.scheduler
 import qubes.exc
 
 class ProtocolError(AssertionError):
@@ -116,7 +119,13 @@ class AbstractQubesAPI(object):
     #: the preferred socket location (to be overridden in child's class)
     SOCKNAME = None
 
-    def __init__(self, app, src, method_name, dest, arg, send_event=None):
+    #: calls wait for admission by
+    #: :py:class:`qubes.api.scheduler.CallScheduler` (to be overridden in
+    #: child's class)
+    ADMISSION_CONTROL = False
+
+    def __init__(self, app, src, method_name, dest, arg, send_event=None,
+            connection=None):
         #: :py:class:`qubes.Qubes` object
         self.app = app
 
@@ -135,21 +144,46 @@ class AbstractQubesAPI(object):
         #: callback for sending events if applicable
         self.send_event = send_event
 
+        #: connection to the client (:py:class:`QubesDaemonProtocol`), for
+        #: methods sending a lot of events; :py:obj:`None` if not applicable
+        self.connection = connection
+
         #: is this operation cancellable?
         self.cancellable = False
 
-        candidates = list(self.list_methods(self.method))
+        #: time spent checking permission (in
+        #: :py:meth:`fire_event_for_permission`), in seconds
+        self.permission_time = 0.
 
-        if not candidates:
+        try:
+            #: the method to execute, and its endpoint
+            self._handler = self.method_table()[self.method]
+        except KeyError:
             raise ProtocolError('no such method: {!r}'.format(self.method))
 
-        assert len(candidates) == 1, \
-            'multiple candidates for method {!r}'.format(self.method)
-
-        #: the method to execute
-        self._handler = candidates[0]
         self._running_handler = None
 
+    @classmethod
+    def method_table(cls):
+        '''Map of all API methods of this class
+
+        Computed on first use (:py:func:`create_servers` does it for served
+        classes), separately for each class.
+
+        :returns: dict of method name to ``(handler, endpoint)`` pairs
+        '''
+
+        # not inherited, each class has its own
+        table = cls.__dict__.get('_method_table')
+        if table is None:
+            table = {}
+            for func, mname, endpoint in cls.list_methods():
+                assert mname not in table, \
+                    'multiple candidates for method {!r}'.format(mname)
+                table[mname] = (func, endpoint)
+            cls._method_table = table
+        return table
+
     @classmethod
     def list_methods(cls, select_method=None):
         for attr in dir(cls):
@@ -172,7 +206,7 @@ class AbstractQubesAPI(object):
 
         This method is a coroutine.
         '''
-        handler, _, endpoint = self._handler
+        handler, endpoint = self._handler
         kwargs = {}
         if endpoint is not None:
             kwargs['endpoint'] = endpoint
@@ -186,10 +220,20 @@ class AbstractQubesAPI(object):
             self._running_handler.cancel()
 
 
-    def fire_event_for_permission(self, **kwargs):
-        '''Fire an event on the source qube to check for permission'''
-        return self.src.fire_event('mgmt-permission:' + self.method,
-            pre_event=True, dest=self.dest, arg=self.arg, **kwargs)
+    def fire_event_for_permission(self, method=None, arg=None, **kwargs):
+        '''Fire an event on the source qube to check for permission
+
+        :param str method: check for this method instead of the called one
+        :param str arg: argument to check with; defaults to the call's one
+        '''
+        start = time.perf_counter()
+        try:
+            return self.src.fire_event(
+                'mgmt-permission:' + (method or self.method),
+                pre_event=True, dest=self.dest,
+                arg=(self.arg if arg is None else arg), **kwargs)
+        finally:
+            self.permission_time += time.perf_counter() - start
 
     def fire_event_for_filter(self, iterable, **kwargs):
         '''Fire an event on the source qube to filter for permission'''
@@ -197,10 +241,120 @@ class AbstractQubesAPI(object):
             self.fire_event_for_permission(**kwargs))
 
 
+#: Frame types of multiplexed (version 2) protocol. Client sends
+#: :py:data:`FRAME_CALL` with the request (in the same format as in version 1)
+#: and may send :py:data:`FRAME_CANCEL` to interrupt a call in progress (like
+#: ``admin.Events``). Server answers with any number of
+#: :py:data:`FRAME_DATA` (which concatenated give the same response as in
+#: version 1), followed by :py:data:`FRAME_END`, or :py:data:`FRAME_ABORT`
+#: when version 1 would abort the connection.
+FRAME_CALL = 0
+FRAME_CANCEL = 1
+FRAME_DATA = 2
+FRAME_END = 3
+FRAME_ABORT = 4
+
+
+def serialize_event(app, subject, event, kwargs, sequence=None):
+    '''Serialize an event the way it is sent to the client
+
+    The same data may be sent to many clients, see
+    :py:meth:`QubesDaemonProtocol.send_serialized_event`.
+
+    :param int sequence: sequence number of the event, sent before the
+        subject if given (see :py:mod:`qubes.api.eventbus`)
+    :rtype: bytes
+    '''
+    data = [QubesDaemonProtocol.header.pack(0x31)]
+    if sequence is not None:
+        data.append(str(sequence).encode('ascii') + b'\0')
+    if subject is not app:
+        data.append(subject.name.encode('ascii'))
+    data.append(b'\0')
+
+    data.append(event.encode('ascii') + b'\0')
+
+    for k, v in kwargs.items():
+        data.append('{}\0{}\0'.format(k, str(v)).encode('ascii'))
+    data.append(b'\0')
+    return b''.join(data)
+
+
+class MultiplexedTransport(object):
+    '''Transport of a single call, sent as frames over a connection using
+    multiplexed (version 2) protocol
+
+    Writes done in the same iteration of the event loop are sent in one frame.
+
+    :param QubesDaemonProtocol protocol: protocol of the connection
+    :param int request_id: request id of the call
+    '''
+
+    def __init__(self, protocol, request_id):
+        self.protocol = protocol
+        self.request_id = request_id
+        self._buffer = []
+        self._closed = False
+
+    def write(self, data):
+        if self._closed:
+            return
+        if not self._buffer:
+            asyncio.get_event_loop().call_soon(self._flush)
+        self._buffer.append(data)
+
+    def _flush(self):
+        if self._buffer and not self._closed:
+            self.protocol.send_frame(self.request_id, FRAME_DATA,
+                b''.join(self._buffer))
+        self._buffer = []
+
+    def write_eof(self):
+        pass
+
+    def close(self):
+        if self._closed:
+            return
+        self._flush()
+        self._closed = True
+        self.protocol.call_finished(self.request_id, FRAME_END)
+
+    def abort(self):
+        if self._closed:
+            return
+        self._buffer = []
+        self._closed = True
+        self.protocol.call_finished(self.request_id, FRAME_ABORT)
+
+    def detach(self):
+        '''Drop anything written from now on (the call was cancelled)'''
+        self._buffer = []
+        self._closed = True
+
+
 class QubesDaemonProtocol(asyncio.Protocol):
+    '''Protocol of qubesd sockets
+
+    In version 1 of the protocol, client sends a single request
+    (``src\\0method\\0dest\\0arg\\0payload``) and closes its side of the
+    connection, then server sends the response and closes the connection.
+
+    Version 2 is used when client starts with :py:attr:`v2_magic`, which is
+    echoed back by the server. Then both sides exchange frames, each
+    starting with :py:attr:`v2_header` (request id, frame type and length of
+    data), see :py:data:`FRAME_CALL` for frame types. Any number of calls may
+    be in progress at the same time, each with own request id.
+    '''
+
     buffer_size = 65536
     header = struct.Struct('Bx')
 
+    #: first bytes of version 2 connection; version 1 request cannot start
+    #: with NUL byte, as it would mean empty source qube name
+    v2_magic = b'\0QubesAPI/2\n'
+    #: header of a frame: request id, frame type, length of data
+    v2_header = struct.Struct('!IBI')
+
     def __init__(self, handler, *args, app, debug=False, **kwargs):
         super().__init__(*args, **kwargs)
         self.handler = handler
@@ -211,6 +365,23 @@ class QubesDaemonProtocol(asyncio.Protocol):
         self.debug = debug
         self.event_sent = False
         self.mgmt = None
+        #: task waiting for admission of the call and then responding
+        self.call_task = None
+        #: time the call waited for admission, in seconds
+        self.queue_time = None
+        self._writing_paused = False
+        self._drain_waiter = None
+
+        #: protocol version, :py:obj:`None` until first data is received
+        self.version = None
+        #: data received but not processed yet (version 2 only)
+        self.untrusted_frames = bytearray()
+        #: version 2 negotiated
+        self.negotiated = False
+        #: calls in progress (version 2 only), keyed by request id
+        self.calls = {}
+        #: client closed its side of the connection (version 2 only)
+        self.eof = False
 
     def connection_made(self, transport):
         self.transport = transport
@@ -220,9 +391,51 @@ class QubesDaemonProtocol(asyncio.Protocol):
         # for cancellable operation, interrupt it, otherwise it will do nothing
         if self.mgmt is not None:
             self.mgmt.cancel()
+        elif self.call_task is not None:
+            # still waiting for admission, nobody is interested anymore
+            self.call_task.cancel()
+        for call in self.calls.values():
+            call.transport.detach()
+            call.connection_lost(exc)
+        self.calls.clear()
         self.transport = None
+        self.resume_writing()
+
+    def pause_writing(self):
+        self._writing_paused = True
+
+    def resume_writing(self):
+        self._writing_paused = False
+        if self._drain_waiter is not None:
+            if not self._drain_waiter.done():
+                self._drain_waiter.set_result(None)
+            self._drain_waiter = None
+
+    @property
+    def writing_paused(self):
+        '''The client does not keep up with data sent'''
+        if isinstance(self.transport, MultiplexedTransport):
+            return self.transport.protocol.writing_paused
+        return self._writing_paused
+
+    @asyncio.coroutine
+    def drain(self):
+        '''Wait until the client accepts more data'''
+        if isinstance(self.transport, MultiplexedTransport):
+            yield from self.transport.protocol.drain()
+            return
+        while self._writing_paused:
+            if self._drain_waiter is None:
+                self._drain_waiter = asyncio.get_event_loop().create_future()
+            yield from asyncio.shield(self._drain_waiter)
 
     def data_received(self, untrusted_data):  # pylint: disable=arguments-differ
+        if self.version is None:
+            self.version = 2 if untrusted_data[:1] == b'\0' else 1
+        if self.version == 2:
+            self.data_received_v2(untrusted_data)
+            return
+
         if self.len_untrusted_buffer + len(untrusted_data) > self.buffer_size:
             self.app.log.warning('request too long')
             self.transport.abort()
@@ -232,7 +445,93 @@ class QubesDaemonProtocol(asyncio.Protocol):
         self.len_untrusted_buffer += \
             self.untrusted_buffer.write(untrusted_data)
 
+    def data_received_v2(self, untrusted_data):
+        '''Handle data received on version 2 connection'''
+        self.untrusted_frames += untrusted_data
+
+        if not self.negotiated:
+            magic_len = len(self.v2_magic)
+            if self.untrusted_frames[:magic_len] != \
+                    self.v2_magic[:len(self.untrusted_frames)]:
+                self.app.log.warning('framing error')
+                self.transport.abort()
+                return
+            if len(self.untrusted_frames) < magic_len:
+                return
+            del self.untrusted_frames[:magic_len]
+            self.negotiated = True
+            self.transport.write(self.v2_magic)
+
+        header_size = self.v2_header.size
+        while len(self.untrusted_frames) >= header_size:
+            request_id, frame_type, length = \
+                self.v2_header.unpack_from(self.untrusted_frames)
+            if length > self.buffer_size:
+                self.app.log.warning('request too long')
+                self.transport.abort()
+                return
+            if len(self.untrusted_frames) < header_size + length:
+                break
+            untrusted_body = bytes(
+                self.untrusted_frames[header_size:header_size + length])
+            del self.untrusted_frames[:header_size + length]
+
+            if frame_type == FRAME_CALL:
+                self.call_received(request_id, untrusted_body)
+            elif frame_type == FRAME_CANCEL:
+                call = self.calls.pop(request_id, None)
+                if call is not None:
+                    call.transport.detach()
+                    call.connection_lost(None)
+            else:
+                self.app.log.warning('framing error')
+                self.transport.abort()
+            if self.transport is None or self.transport.is_closing():
+                return
+
+    def call_received(self, request_id, untrusted_body):
+        '''Start a call requested on version 2 connection'''
+        if request_id in self.calls:
+            self.app.log.warning('duplicate request id')
+            self.transport.abort()
+            return
+
+        try:
+            src, meth, dest, arg, untrusted_payload = \
+                untrusted_body.split(b'\0', 4)
+        except ValueError:
+            self.app.log.warning('framing error')
+            self.send_frame(request_id, FRAME_ABORT)
+            return
+
+        call = QubesDaemonProtocol(self.handler, app=self.app,
+            debug=self.debug)
+        call.version = 1
+        call.connection_made(MultiplexedTransport(self, request_id))
+        self.calls[request_id] = call
+        call.call_task = asyncio.ensure_future(call.schedule(
+            src, meth, dest, arg, untrusted_payload=untrusted_payload))
+
+    def call_finished(self, request_id, frame_type):
+        '''Send the last frame of a call on version 2 connection'''
+        self.calls.pop(request_id, None)
+        self.send_frame(request_id, frame_type)
+        if self.eof and not self.calls and self.transport is not None:
+            self.transport.close()
+
+    def send_frame(self, request_id, frame_type, data=b''):
+        '''Send a frame on version 2 connection'''
+        if self.transport is None:
+            return
+        self.transport.write(
+            self.v2_header.pack(request_id, frame_type, len(data)) + data)
+
     def eof_received(self):
+        if self.version == 2:
+            # finish calls in progress, then close
+            self.eof = True
+            return bool(self.calls)
+
         try:
             src, meth, dest, arg, untrusted_payload = \
                 self.untrusted_buffer.getvalue().split(b'\0', 4)
@@ -243,37 +542,77 @@ class QubesDaemonProtocol(asyncio.Protocol):
         finally:
             self.untrusted_buffer.close()
 
-        asyncio.ensure_future(self.respond(
+        self.call_task = asyncio.ensure_future(self.schedule(
             src, meth, dest, arg, untrusted_payload=untrusted_payload))
 
         return True
 
+    @asyncio.coroutine
+    def schedule(self, src, meth, dest, arg, *, untrusted_payload):
+        '''Wait until :py:class:`qubes.api.scheduler.CallScheduler` admits
+        the call, then :py:meth:`respond`
+
+        Calls of handlers without
+        :py:attr:`AbstractQubesAPI.ADMISSION_CONTROL` are responded to right
+        away.
+        '''
+        if not self.handler.ADMISSION_CONTROL:
+            yield from self.respond(src, meth, dest, arg,
+                untrusted_payload=untrusted_payload)
+            return
+
+        scheduler = qubes.api.scheduler.CallScheduler.get(self.app)
+        source = src.decode('ascii', 'replace')
+        lane = qubes.api.scheduler.method_lane(self.handler, meth)
+        start = time.perf_counter()
+        try:
+            yield from scheduler.acquire(source, lane)
+        except qubes.api.scheduler.QueueFull as err:
+            self.app.log.warning('refusing call %s+%s (%s → %s): %s',
+                meth, arg, src, dest, err)
+            if self.transport is not None:
+                self.transport.abort()
+            return
+        self.queue_time = time.perf_counter() - start
+        try:
+            yield from self.respond(src, meth, dest, arg,
+                untrusted_payload=untrusted_payload)
+        finally:
+            scheduler.release(source, lane)
+
     @asyncio.coroutine
     def respond(self, src, meth, dest, arg, *, untrusted_payload):
+        start = time.perf_counter()
         try:
             self.mgmt = self.handler(self.app, src, meth, dest, arg,
-                self.send_event)
+                self.send_event, connection=self)
+            qubes.api.metrics.APIMetrics.get(self.app).call_started(
+                meth.decode('ascii'))
             response = yield from self.mgmt.execute(
                 untrusted_payload=untrusted_payload)
             assert not (self.event_sent and response)
             if self.transport is None:
+                self.record_call(src, meth, 'ok', start)
                 return
 
         # except clauses will fall through to transport.abort() below
 
         except PermissionDenied:
+            result = 'permission_denied'
             self.app.log.warning(
                 'permission denied for call %s+%s (%s → %s) '
                 'with payload of %d bytes',
                     meth, arg, src, dest, len(untrusted_payload))
 
         except ProtocolError:
+            result = 'protocol_error'
             self.app.log.warning(
                 'protocol error for call %s+%s (%s → %s) '
                 'with payload of %d bytes',
                     meth, arg, src, dest, len(untrusted_payload))
 
         except qubes.exc.QubesException as err:
+            handler_end = time.perf_counter()
             msg = ('%r while calling '
                 'src=%r meth=%r dest=%r arg=%r len(untrusted_payload)=%d')
 
@@ -287,15 +626,18 @@ class QubesDaemonProtocol(asyncio.Protocol):
                 self.send_exception(err)
                 self.transport.write_eof()
                 self.transport.close()
+            self.record_call(src, meth, 'exception', start, handler_end)
             return
 
         except Exception:  # pylint: disable=broad-except
+            result = 'internal_error'
             self.app.log.exception(
                 'unhandled exception while calling '
                 'src=%r meth=%r dest=%r arg=%r len(untrusted_payload)=%d',
                     src, meth, dest, arg, len(untrusted_payload))
 
         else:
+            handler_end = time.perf_counter()
             if not self.event_sent:
                 self.send_response(response)
             try:
@@ -303,12 +645,43 @@ class QubesDaemonProtocol(asyncio.Protocol):
             except NotImplementedError:
                 pass
             self.transport.close()
+            self.record_call(src, meth, 'ok', start, handler_end)
             return
 
         # this is reached if from except: blocks; do not put it in finally:,
         # because this will prevent the good case from sending the reply
+        self.record_call(src, meth, result, start)
         self.transport.abort()
 
+    def record_call(self, src, meth, result, start, handler_end=None):
+        '''Record finished call in :py:class:`qubes.api.metrics.APIMetrics`
+
+        :param str result: see :py:data:`qubes.api.metrics.RESULTS`
+        :param float start: when the call started
+            (:py:func:`time.perf_counter`)
+        :param float handler_end: when the handler finished and writing
+            response started, :py:obj:`None` if there was no response
+        '''
+        end = time.perf_counter()
+        metrics = qubes.api.metrics.APIMetrics.get(self.app)
+        if self.mgmt is None:
+            # not even started: no such method or source qube, do not trust
+            # the names
+            metrics.call_started(qubes.api.metrics.UNKNOWN)
+            metrics.call_finished(qubes.api.metrics.UNKNOWN,
+                qubes.api.metrics.UNKNOWN, result, {})
+            return
+        times = {
+            'queue': self.queue_time or 0.,
+            'permission': self.mgmt.permission_time,
+            'handler': (handler_end or end) - start
+                - self.mgmt.permission_time,
+        }
+        if handler_end is not None:
+            times['write'] = end - handler_end
+        metrics.call_finished(meth.decode('ascii'), src.decode('ascii'),
+            result, times)
+
     def send_header(self, *args):
         self.transport.write(self.header.pack(*args))
 
@@ -319,18 +692,13 @@ class QubesDaemonProtocol(asyncio.Protocol):
             self.transport.write(content.encode('utf-8'))
 
     def send_event(self, subject, event, **kwargs):
-        self.event_sent = True
-        self.send_header(0x31)
-
-        if subject is not self.app:
-            self.transport.write(subject.name.encode('ascii'))
-        self.transport.write(b'\0')
+        self.send_serialized_event(
+            serialize_event(self.app, subject, event, kwargs))
 
-        self.transport.write(event.encode('ascii') + b'\0')
-
-        for k, v in kwargs.items():
-            self.transport.write('{}\0{}\0'.format(k, str(v)).encode('ascii'))
-        self.transport.write(b'\0')
+    def send_serialized_event(self, data):
+        '''Send an event already serialized with :py:func:`serialize_event`'''
+        self.event_sent = True
+        self.transport.write(data)
 
     def send_exception(self, exc):
         self.send_header(0x32)
@@ -373,6 +741,7 @@ def create_servers(*args, force=False, loop=None, **kwargs):
             assert sockpath is not None, \
                 'SOCKNAME needs to be overloaded in {}'.format(
                     type(handler).__name__)
+            handler.method_table()
 
             if os.path.exists(sockpath):
                 if force:
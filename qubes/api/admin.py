@@ -23,13 +23,18 @@ Qubes OS Management API
 '''
 
 import asyncio
+import collections
+import re
 import string
 import itertools
 import pkg_resources
 import libvirt
 
 import qubes.api
+import qubes.api.eventbus
+import qubes.api.metrics
 import qubes.devices
+import qubes.events
 import qubes.firewall
 import qubes.storage
 import qubes.utils
@@ -37,32 +42,19 @@ import qubes.vm
 import qubes.vm.qubesvm
 
 
-class QubesMgmtEventsDispatcher(object):
-    def __init__(self, filters, send_event):
-        self.filters = filters
-        self.send_event = send_event
+def _escape(value):
+    '''Escape value to fit in a single line of bulk read response'''
+    return value.replace('\\', '\\\\').replace('\n', '\\n')
 
-    def vm_handler(self, subject, event, **kwargs):
-        if event.startswith('mgmt-permission:'):
-            return
-        if not list(qubes.api.apply_filters([(subject, event, kwargs)],
-                self.filters)):
-            return
-        self.send_event(subject, event, **kwargs)
 
-    def app_handler(self, subject, event, **kwargs):
-        if not list(qubes.api.apply_filters([(subject, event, kwargs)],
-                self.filters)):
-            return
-        self.send_event(subject, event, **kwargs)
-
-    def on_domain_add(self, subject, event, vm):
-        # pylint: disable=unused-argument
-        vm.add_handler('*', self.vm_handler)
-
-    def on_domain_delete(self, subject, event, vm):
-        # pylint: disable=unused-argument
-        vm.remove_handler('*', self.vm_handler)
+def _unescape(untrusted_value):
+    '''Reverse :py:func:`_escape`, on (untrusted) bytes'''
+    def replace(match):
+        try:
+            return {b'\\\\': b'\\', b'\\n': b'\n'}[match.group(0)]
+        except KeyError:
+            raise qubes.exc.QubesValueError('Invalid escape sequence')
+    return re.sub(rb'\\.?', replace, untrusted_value, flags=re.DOTALL)
 
 
 class QubesAdminAPI(qubes.api.AbstractQubesAPI):
@@ -76,6 +68,8 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
 
     SOCKNAME = '/var/run/qubesd.sock'
 
+    ADMISSION_CONTROL = True
+
     @qubes.api.method('admin.vmclass.List', no_payload=True,
         scope='global', read=True)
     @asyncio.coroutine
@@ -146,12 +140,17 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
         return self._property_get(self.app)
 
     def _property_get(self, dest):
-        if self.arg not in dest.property_list():
+        if self.arg not in dest.property_table().by_name:
             raise qubes.exc.QubesNoSuchPropertyError(dest, self.arg)
 
         self.fire_event_for_permission()
 
-        property_def = dest.property_get_def(self.arg)
+        return self._serialize_property(dest, self.arg)
+
+    @staticmethod
+    def _serialize_property(dest, name):
+        '''Format property value the way admin.vm.property.Get returns it'''
+        property_def = dest.property_get_def(name)
         # explicit list to be sure that it matches protocol spec
         if isinstance(property_def, qubes.vm.VMProperty):
             property_type = 'vm'
@@ -159,21 +158,49 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
             property_type = 'int'
         elif property_def.type is bool:
             property_type = 'bool'
-        elif self.arg == 'label':
+        elif name == 'label':
             property_type = 'label'
         else:
             property_type = 'str'
 
         try:
-            value = getattr(dest, self.arg)
+            value = getattr(dest, name)
         except AttributeError:
             return 'default=True type={} '.format(property_type)
         else:
             return 'default={} type={} {}'.format(
-                str(dest.property_is_default(self.arg)),
+                str(dest.property_is_default(name)),
                 property_type,
                 str(value) if value is not None else '')
 
+    def _bulk_domains(self):
+        '''Qubes covered by bulk read method: all of them when called on
+        dom0 (like admin.vm.List), otherwise just the destination'''
+        assert not self.arg
+
+        if self.dest.name == 'dom0':
+            return sorted(self.app.domains)
+        return [self.dest]
+
+    @qubes.api.method('admin.vm.property.GetAll', no_payload=True,
+        scope='global', read=True)
+    @asyncio.coroutine
+    def vm_property_getall(self):
+        '''Get values of all properties of one or all qubes
+
+        Each line is ``<qube> <property> <value>``, where the value is as
+        returned by admin.vm.property.Get, with backslash and newline
+        escaped. Permission filters get ``(qube, property name)`` pairs.
+        '''
+        entries = ((vm, prop.__name__)
+            for vm in self._bulk_domains()
+            for prop in vm.property_list())
+        entries = self.fire_event_for_filter(entries)
+
+        return ''.join('{} {} {}\n'.format(vm.name, name,
+                _escape(self._serialize_property(vm, name)))
+            for vm, name in entries)
+
     @qubes.api.method('admin.vm.property.Set',
         scope='local', write=True)
     @asyncio.coroutine
@@ -192,7 +219,7 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
             untrusted_payload=untrusted_payload)
 
     def _property_set(self, dest, untrusted_payload):
-        if self.arg not in dest.property_list():
+        if self.arg not in dest.property_table().by_name:
             raise qubes.exc.QubesNoSuchPropertyError(dest, self.arg)
 
         property_def = dest.property_get_def(self.arg)
@@ -201,7 +228,75 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
         self.fire_event_for_permission(newvalue=newvalue)
 
         setattr(dest, self.arg, newvalue)
-        self.app.save()
+        self.app.schedule_save()
+
+    @qubes.api.method('admin.vm.property.SetMany',
+        scope='local', write=True)
+    @asyncio.coroutine
+    def vm_property_setmany(self, untrusted_payload):
+        '''Set values of many properties at once
+
+        Payload has one ``<property> <value>`` line for each property, with
+        value escaped like in admin.vm.property.GetAll. All the values are
+        validated before any is set. If setting any of them fails, the ones
+        already set are restored and the error is reported. qubes.xml is
+        saved once.
+
+        Besides ``mgmt-permission:admin.vm.property.SetMany``, the
+        ``mgmt-permission:admin.vm.property.Set`` event is fired for each
+        property (with the property name as *arg*), so extensions
+        restricting single properties apply here too. The method has no
+        argument, so qrexec policy cannot restrict it per property and
+        rules like ``admin.vm.property.Set+<property>`` are not consulted:
+        allowing it is the same as allowing ``admin.vm.property.Set`` for
+        every property of the target.
+        '''
+        assert not self.arg
+
+        newvalues = collections.OrderedDict()
+        for untrusted_line in untrusted_payload.split(b'\n'):
+            if not untrusted_line:
+                continue
+            untrusted_name, _, untrusted_value = untrusted_line.partition(b' ')
+            try:
+                name = untrusted_name.decode('ascii', errors='strict')
+            except UnicodeDecodeError:
+                raise qubes.exc.QubesValueError
+            if name not in self.dest.property_table().by_name:
+                raise qubes.exc.QubesNoSuchPropertyError(self.dest, name)
+            if name in newvalues:
+                raise qubes.exc.QubesValueError(
+                    'Property {} given more than once'.format(name))
+            property_def = self.dest.property_get_def(name)
+            newvalues[name] = property_def.sanitize(
+                untrusted_newvalue=_unescape(untrusted_value))
+
+        self.fire_event_for_permission(newvalues=newvalues)
+        for name, newvalue in newvalues.items():
+            self.fire_event_for_permission(method='admin.vm.property.Set',
+                arg=name, newvalue=newvalue)
+
+        # (name, was default, old value) of properties already set
+        applied = []
+        try:
+            for name, newvalue in newvalues.items():
+                if self.dest.property_is_default(name):
+                    applied.append((name, True, None))
+                else:
+                    applied.append((name, False, getattr(self.dest, name)))
+                setattr(self.dest, name, newvalue)
+        except Exception:
+            for name, was_default, oldvalue in reversed(applied):
+                try:
+                    if was_default:
+                        delattr(self.dest, name)
+                    else:
+                        setattr(self.dest, name, oldvalue)
+                except Exception:  # pylint: disable=broad-except
+                    self.dest.log.exception(
+                        'Failed to restore property {}'.format(name))
+            raise
+        self.app.schedule_save()
 
     @qubes.api.method('admin.vm.property.Help', no_payload=True,
         scope='local', read=True)
@@ -219,7 +314,7 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
         return self._property_help(self.app)
 
     def _property_help(self, dest):
-        if self.arg not in dest.property_list():
+        if self.arg not in dest.property_table().by_name:
             raise qubes.exc.QubesNoSuchPropertyError(dest, self.arg)
 
         self.fire_event_for_permission()
@@ -247,13 +342,13 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
         return self._property_reset(self.app)
 
     def _property_reset(self, dest):
-        if self.arg not in dest.property_list():
+        if self.arg not in dest.property_table().by_name:
             raise qubes.exc.QubesNoSuchPropertyError(dest, self.arg)
 
         self.fire_event_for_permission()
 
         delattr(dest, self.arg)
-        self.app.save()
+        self.app.schedule_save()
 
     @qubes.api.method('admin.vm.volume.List', no_payload=True,
         scope='local', read=True)
@@ -426,6 +521,22 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
 
         return ''.join('{}\n'.format(tag) for tag in sorted(tags))
 
+    @qubes.api.method('admin.vm.tag.ListAll', no_payload=True,
+        scope='global', read=True)
+    @asyncio.coroutine
+    def vm_tag_listall(self):
+        '''List tags of one or all qubes
+
+        Each line is ``<qube> <tag>``. Permission filters get
+        ``(qube, tag)`` pairs.
+        '''
+        entries = ((vm, tag)
+            for vm in self._bulk_domains()
+            for tag in sorted(vm.tags))
+        entries = self.fire_event_for_filter(entries)
+
+        return ''.join('{} {}\n'.format(vm.name, tag) for vm, tag in entries)
+
     @qubes.api.method('admin.vm.tag.Get', no_payload=True,
         scope='local', read=True)
     @asyncio.coroutine
@@ -445,7 +556,7 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
         self.fire_event_for_permission()
 
         self.dest.tags.add(self.arg)
-        self.app.save()
+        self.app.schedule_save()
 
     @qubes.api.method('admin.vm.tag.Remove', no_payload=True,
         scope='local', write=True)
@@ -459,7 +570,7 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
             self.dest.tags.remove(self.arg)
         except KeyError:
             raise qubes.exc.QubesTagNotFoundError(self.dest, self.arg)
-        self.app.save()
+        self.app.schedule_save()
 
     @qubes.api.method('admin.pool.List', no_payload=True,
         scope='global', read=True)
@@ -698,43 +809,150 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
         scope='global', read=True)
     @asyncio.coroutine
     def events(self):
-        assert not self.arg
+        '''Stream events until the client disconnects
+
+        The argument is a list of options, separated by ``+``:
+
+        ``<epoch>.<sequence>``
+            Send events with sequence numbers (see
+            :py:mod:`qubes.api.eventbus`), starting with events after the
+            given one, if they are still available. Use ``0.0`` if there is
+            nothing to resume. The first event is ``connection-established``,
+            with arguments ``epoch`` and ``resumed`` (``True`` if no event
+            after the requested one was lost); its sequence number is the one
+            to resume from, if the connection breaks before any other event
+            arrives.
+
+        ``coalesce`` or ``coalesce-<milliseconds>``
+            Hold events for a while, and send only the last one of repeated
+            events (see :py:mod:`qubes.api.eventbus`).
+
+        ``nopre``
+            Do not send ``-pre-`` events.
+
+        ``overflow-<policy>``
+            What to do when the client does not keep up with the events:
+            ``disconnect`` (the default), ``drop`` or ``coalesce`` (see
+            :py:mod:`qubes.api.eventbus`).
+
+        With empty argument, all events are sent as they happen.
+        '''
+        resume = None
+        coalesce = None
+        drop_pre = False
+        overflow = None
+        for option in (self.arg.split('+') if self.arg else ()):
+            match = re.match(r'\A([0-9a-f]{1,16})\.([0-9]{1,20})\Z', option)
+            if match is not None:
+                assert resume is None
+                resume = (match.group(1), int(match.group(2)))
+                continue
+            match = re.match(r'\Acoalesce(?:-([0-9]{1,5}))?\Z', option)
+            if match is not None:
+                assert coalesce is None
+                coalesce = (int(match.group(1)) / 1000 if match.group(1)
+                    else qubes.api.eventbus.DEFAULT_COALESCE_WINDOW)
+                continue
+            match = re.match(r'\Aoverflow-([a-z]+)\Z', option)
+            if match is not None:
+                assert overflow is None
+                overflow = match.group(1)
+                assert overflow in qubes.api.eventbus.OVERFLOW_POLICIES
+                continue
+            assert option == 'nopre' and not drop_pre
+            drop_pre = True
 
         # run until client connection is terminated
         self.cancellable = True
-        wait_for_cancel = asyncio.get_event_loop().create_future()
 
         # cache event filters, to not call an event each time an event arrives
         event_filters = self.fire_event_for_permission()
 
-        dispatcher = QubesMgmtEventsDispatcher(event_filters, self.send_event)
-        if self.dest.name == 'dom0':
-            self.app.add_handler('*', dispatcher.app_handler)
-            self.app.add_handler('domain-add', dispatcher.on_domain_add)
-            self.app.add_handler('domain-delete', dispatcher.on_domain_delete)
-            for vm in self.app.domains:
-                vm.add_handler('*', dispatcher.vm_handler)
-        else:
-            self.dest.add_handler('*', dispatcher.vm_handler)
+        bus = qubes.api.eventbus.EventBus.get(self.app)
+        subscriber = bus.subscribe(self.send_event, event_filters,
+            dest=(None if self.dest.name == 'dom0' else self.dest),
+            connection=self.connection, sequenced=(resume is not None),
+            coalesce=coalesce, drop_pre=drop_pre, overflow=overflow,
+            source=self.src.name)
 
         # send artificial event as a confirmation that connection is established
-        self.send_event(self.app, 'connection-established')
+        if not subscriber.sequenced:
+            self.send_event(self.app, 'connection-established')
+        else:
+            epoch, sequence = resume
+            resumed = bus.can_resume(epoch, sequence)
+            self.connection.send_serialized_event(qubes.api.serialize_event(
+                self.app, self.app, 'connection-established',
+                {'epoch': bus.epoch, 'resumed': resumed},
+                sequence=(sequence if resumed else bus.sequence)))
+            if resumed:
+                bus.resume(subscriber, sequence)
 
         try:
-            yield from wait_for_cancel
+            yield from subscriber.run()
         except asyncio.CancelledError:
             # the above waiting was already interrupted, this is all we need
             pass
+        finally:
+            bus.unsubscribe(subscriber)
 
-        if self.dest.name == 'dom0':
-            self.app.remove_handler('*', dispatcher.app_handler)
-            self.app.remove_handler('domain-add', dispatcher.on_domain_add)
-            self.app.remove_handler('domain-delete',
-                dispatcher.on_domain_delete)
-            for vm in self.app.domains:
-                vm.remove_handler('*', dispatcher.vm_handler)
-        else:
-            self.dest.remove_handler('*', dispatcher.vm_handler)
+        if subscriber.disconnected:
+            self.app.log.warning(
+                'admin.Events client of %s does not keep up, disconnecting',
+                self.src.name)
+
+    @qubes.api.method('admin.events.Profile', no_payload=True,
+        scope='global', read=True)
+    @asyncio.coroutine
+    def events_profile(self):
+        '''Timing statistics of event handlers, the slowest first'''
+        assert not self.arg
+        assert self.dest.name == 'dom0'
+
+        handler_profile = qubes.events.profile
+        if handler_profile is None:
+            raise qubes.exc.QubesException(
+                'Event handler profiling is not enabled')
+
+        self.fire_event_for_permission()
+
+        stats = sorted(handler_profile.stats.items(),
+            key=(lambda item: (-item[1][1], item[0])))
+        return ''.join(
+            '{} {} calls={} total={:.6f} max={:.6f}\n'.format(
+                event, handler, calls, total, max_time)
+            for (event, handler), (calls, total, max_time) in stats)
+
+    @qubes.api.method('admin.events.ProfileReset', no_payload=True,
+        scope='global', execute=True)
+    @asyncio.coroutine
+    def events_profile_reset(self):
+        '''Discard collected timing statistics of event handlers'''
+        assert not self.arg
+        assert self.dest.name == 'dom0'
+
+        handler_profile = qubes.events.profile
+        if handler_profile is None:
+            raise qubes.exc.QubesException(
+                'Event handler profiling is not enabled')
+
+        self.fire_event_for_permission()
+
+        handler_profile.reset()
+
+    @qubes.api.method('admin.api.Stats', no_payload=True,
+        scope='global', read=True)
+    @asyncio.coroutine
+    def api_stats(self):
+        '''Counters and timing of API calls, in OpenMetrics text format
+        (see :py:mod:`qubes.api.metrics`)'''
+        assert not self.arg
+        assert self.dest.name == 'dom0'
+
+        self.fire_event_for_permission()
+
+        return qubes.api.metrics.APIMetrics.get(self.app).render(
+            qubes.api.eventbus.EventBus.get(self.app).stats())
 
     @qubes.api.method('admin.vm.feature.List', no_payload=True,
         scope='local', read=True)
@@ -744,6 +962,25 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
         features = self.fire_event_for_filter(self.dest.features.keys())
         return ''.join('{}\n'.format(feature) for feature in features)
 
+    @qubes.api.method('admin.vm.feature.GetAll', no_payload=True,
+        scope='global', read=True)
+    @asyncio.coroutine
+    def vm_feature_getall(self):
+        '''Get values of all features of one or all qubes
+
+        Each line is ``<qube> <feature> <value>``, with backslash and
+        newline escaped in the value. Permission filters get
+        ``(qube, feature)`` pairs.
+        '''
+        entries = ((vm, feature)
+            for vm in self._bulk_domains()
+            for feature in sorted(vm.features))
+        entries = self.fire_event_for_filter(entries)
+
+        return ''.join('{} {} {}\n'.format(vm.name, feature,
+                _escape(str(vm.features[feature])))
+            for vm, feature in entries)
+
     @qubes.api.method('admin.vm.feature.Get', no_payload=True,
         scope='local', read=True)
     @asyncio.coroutine
@@ -781,7 +1018,7 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
             del self.dest.features[self.arg]
         except KeyError:
             raise qubes.exc.QubesFeatureNotFoundError(self.dest, self.arg)
-        self.app.save()
+        self.app.schedule_save()
 
     @qubes.api.method('admin.vm.feature.Set',
         scope='local', write=True)
@@ -793,7 +1030,7 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
 
         self.fire_event_for_permission(value=value)
         self.dest.features[self.arg] = value
-        self.app.save()
+        self.app.schedule_save()
 
     @qubes.api.method('admin.vm.Create.{endpoint}', endpoints=(ep.name
             for ep in pkg_resources.iter_entry_points(qubes.vm.VM_ENTRY_POINT)),
@@ -1026,7 +1263,7 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
             dev.backend_domain, dev.ident,
             options=options, persistent=persistent)
         yield from self.dest.devices[devclass].attach(assignment)
-        self.app.save()
+        self.app.schedule_save()
 
     # Attach/Detach action can both modify persistent state (with
     # persistent=True) and volatile state of running VM (with persistent=False).
@@ -1052,7 +1289,7 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
         assignment = qubes.devices.DeviceAssignment(
             dev.backend_domain, dev.ident)
         yield from self.dest.devices[devclass].detach(assignment)
-        self.app.save()
+        self.app.schedule_save()
 
     @qubes.api.method('admin.vm.firewall.Get', no_payload=True,
             scope='local', read=True)
@@ -1079,7 +1316,8 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
 
         self.fire_event_for_permission(rules=rules)
 
-        self.dest.firewall.rules = rules
+        self.dest.firewall.rules = [qubes.firewall.RuleValue.from_rule(rule)
+            for rule in rules]
         self.dest.firewall.save()
 
     @qubes.api.method('admin.vm.firewall.Reload', no_payload=True,
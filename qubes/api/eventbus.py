@@ -0,0 +1,542 @@
+# -*- encoding: utf8 -*-
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, see <http://www.gnu.org/licenses/>.
+
+'''Delivery of events to ``admin.Events`` subscribers
+
+There is one :py:class:`EventBus` per :py:class:`qubes.Qubes` object. It
+registers a single handler on the app and on each domain (only while there
+is any subscriber), and passes each event to all the interested
+subscribers.
+
+Each event is serialized once, and the same data is written to all the
+subscribers. Each :py:class:`Subscriber` writes events straight to its
+client, as long as the client keeps up. When the client connection stops
+accepting data, events are queued, up to :py:attr:`Subscriber.queue_size`.
+What happens when the queue is full is decided by the overflow policy:
+
+``disconnect``
+    Disconnect the subscriber, so the client notices, reconnects and
+    fetches the state again (or resumes, see below). This is the default.
+
+``drop``
+    Discard the oldest queued event.
+
+``coalesce``
+    Replace already queued event of the same subject and name with the new
+    one; if there is none, discard the new event.
+
+Events lost with ``drop`` and ``coalesce`` policies are not reported to the
+client, so these are only for clients which can live with that.
+
+A subscriber may also ask to *coalesce* events: it then holds events for
+a short time (see :py:data:`DEFAULT_COALESCE_WINDOW`), and when an event
+with the same subject, name and key argument (one of
+:py:data:`COALESCE_KEYS`) arrives in the meantime, only the newer one is
+sent. This cuts the traffic during mass changes (like switching template
+of many qubes), when the client is interested only in the final state.
+Subscribers can also skip ``-pre-`` events, which are of no use to most
+clients.
+
+Every event passing through the bus gets a sequence number, increasing by
+one with each event. While there is any *sequenced* subscriber, and for
+:py:attr:`EventBus.replay_keep` seconds after the last one leaves, the bus
+keeps last :py:attr:`EventBus.replay_size` events in memory, so a client
+reconnecting after a short break can get the events it missed, instead of
+fetching the whole state again. Sequence numbers are valid only within
+single :py:attr:`EventBus.epoch` (which changes when qubesd restarts).
+
+Kept events do not hold their subjects or arguments alive: filters of
+resuming subscribers get arguments converted to strings (as sent to the
+client), and events of subjects removed in the meantime are replayed only
+to subscribers without filters.
+Sequenced subscribers get events with the sequence number as an
+additional field::
+
+    1\0<sequence>\0<subject>\0<event>\0(<key>\0<value>\0)*\0
+'''
+
+import asyncio
+import binascii
+import collections
+import os
+import time
+import weakref
+
+import qubes.api
+
+#: overflow policies, see module description
+OVERFLOW_POLICIES = ('drop', 'coalesce', 'disconnect')
+
+#: default time to hold events of coalescing subscriber, in seconds
+DEFAULT_COALESCE_WINDOW = 0.1
+
+#: event arguments telling apart events of the same name and subject, when
+#: coalescing them; the first one present is used
+COALESCE_KEYS = ('name', 'feature', 'tag', 'vm', 'device')
+
+
+class _RemovedSubject(object):
+    '''Stands for subject of kept event, removed in the meantime'''
+    # pylint: disable=too-few-public-methods
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+
+def _compile_filters(filters):
+    '''Combine filters returned by ``mgmt-permission:admin.Events`` event
+    into a single function, or :py:obj:`None` if there are none'''
+    filters = tuple(filters)
+    if not filters:
+        return None
+    if len(filters) == 1:
+        return filters[0]
+    return lambda entry: all(selector(entry) for selector in filters)
+
+
+class Subscriber(object):
+    '''Single ``admin.Events`` call
+
+    Create with :py:meth:`EventBus.subscribe`.
+
+    :param send_event: callback writing single event to the client, used
+        if there is no *connection*
+    :param filters: filters returned by permission event
+    :param dest: deliver only events of this domain, or :py:obj:`None` for
+        events of the app and all the domains
+    :param connection: connection to the client (see
+        :py:attr:`qubes.api.AbstractQubesAPI.connection`), or
+        :py:obj:`None` if writing never blocks
+    :param bool sequenced: send events with sequence numbers, requires
+        *connection*
+    :param float coalesce: hold events for this many seconds and coalesce
+        them (see module description), or :py:obj:`None` to send them
+        right away
+    :param bool drop_pre: skip ``-pre-`` events
+    :param str source: name of the qube which subscribed, for statistics
+    '''
+    # pylint: disable=too-many-instance-attributes
+
+    #: default maximum number of queued events
+    queue_size = 1000
+
+    #: default overflow policy
+    overflow = 'disconnect'
+
+    def __init__(self, send_event, filters=(), dest=None, connection=None,
+            queue_size=None, overflow=None, sequenced=False, coalesce=None,
+            drop_pre=False, source=None):
+        self.send_event = send_event
+        self.filter = _compile_filters(filters)
+        self.dest = dest
+        self.connection = connection
+        if queue_size is not None:
+            self.queue_size = queue_size
+        if overflow is not None:
+            self.overflow = overflow
+        assert self.overflow in OVERFLOW_POLICIES, \
+            'unknown overflow policy {!r}'.format(self.overflow)
+        assert not sequenced or connection is not None, \
+            'sequenced subscriber requires a connection'
+        self.sequenced = sequenced
+        self.coalesce = coalesce
+        self.drop_pre = drop_pre
+        self.source = source
+        #: number telling apart subscribers of the bus, set by
+        #: :py:meth:`EventBus.subscribe`
+        self.ident = None
+
+        #: events held for coalescing, by (subject, event, key argument)
+        self._pending = collections.OrderedDict()
+        self._flush_handle = None
+
+        #: queued events, as ``[subject, event, serialized event, time
+        #: queued]``
+        self.queue = collections.deque()
+        #: queued events by (subject, event), for ``coalesce`` policy
+        self._queued_by_key = {}
+        self._waiter = None
+
+        #: subscriber was disconnected because of ``disconnect`` policy
+        self.disconnected = False
+
+        #: events accepted by filters
+        self.received = 0
+        #: events written to the client
+        self.delivered = 0
+        #: events discarded because the queue was full
+        self.dropped = 0
+        #: events merged into already queued or held ones
+        self.coalesced = 0
+        #: the highest number of queued events seen
+        self.max_queued = 0
+
+    @property
+    def paused(self):
+        '''The client does not accept more data right now'''
+        return self.connection is not None and \
+            self.connection.writing_paused
+
+    @property
+    def lag(self):
+        '''How long the oldest queued event waits, in seconds'''
+        if not self.queue:
+            return 0.
+        return time.monotonic() - self.queue[0][3]
+
+    def stats(self):
+        '''Delivery statistics of this subscriber
+
+        :rtype: dict
+        '''
+        return {
+            'id': self.ident,
+            'source': self.source,
+            'received': self.received,
+            'delivered': self.delivered,
+            'dropped': self.dropped,
+            'coalesced': self.coalesced,
+            'queued': len(self.queue),
+            'pending': len(self._pending),
+            'max_queued': self.max_queued,
+            'lag': self.lag,
+            'disconnected': self.disconnected,
+        }
+
+    def accepts(self, subject, event, kwargs):
+        '''Check if the subscriber is interested in the event
+
+        :rtype: bool
+        '''
+        if self.dest is not None and self.dest is not subject:
+            return False
+        if self.drop_pre and '-pre-' in event:
+            return False
+        return self.filter is None or self.filter((subject, event, kwargs))
+
+    def put(self, subject, event, kwargs, data=None):
+        '''Deliver an event, or queue it if the client is not ready
+
+        The event should be already checked with :py:meth:`accepts`.
+
+        :param data: the event serialized with
+            :py:func:`qubes.api.serialize_event`, needed if there is
+            a connection
+        '''
+        if self.disconnected:
+            return
+        self.received += 1
+
+        if self.coalesce is None:
+            self._deliver(subject, event, kwargs, data)
+            return
+
+        key = (subject, event,
+            next((str(kwargs[arg]) for arg in COALESCE_KEYS
+                if arg in kwargs), None))
+        if self._pending.pop(key, None) is not None:
+            self.coalesced += 1
+        self._pending[key] = (subject, event, kwargs, data)
+        if self._flush_handle is None:
+            self._flush_handle = asyncio.get_event_loop().call_later(
+                self.coalesce, self._flush)
+
+    def _flush(self):
+        self._flush_handle = None
+        pending, self._pending = self._pending, collections.OrderedDict()
+        for subject, event, kwargs, data in pending.values():
+            self._deliver(subject, event, kwargs, data)
+
+    def close(self):
+        '''Discard held events, called when the subscriber is removed'''
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        self._pending.clear()
+
+    def _deliver(self, subject, event, kwargs, data):
+        if self.disconnected:
+            return
+        if self.connection is None:
+            # nothing to wait for
+            self.send_event(subject, event, **kwargs)
+            self.delivered += 1
+            return
+        if not self.queue and not self.paused:
+            self.connection.send_serialized_event(data)
+            self.delivered += 1
+            return
+
+        key = (subject, event)
+        if len(self.queue) >= self.queue_size:
+            if self.overflow == 'disconnect':
+                self.disconnected = True
+                self.queue.clear()
+                self._wakeup()
+                return
+            if self.overflow == 'coalesce':
+                entry = self._queued_by_key.get(key)
+                if entry is None:
+                    self.dropped += 1
+                else:
+                    entry[2] = data
+                    self.coalesced += 1
+                return
+            self._dequeue()
+            self.dropped += 1
+
+        entry = [subject, event, data, time.monotonic()]
+        self.queue.append(entry)
+        if self.overflow == 'coalesce':
+            self._queued_by_key[key] = entry
+        if len(self.queue) > self.max_queued:
+            self.max_queued = len(self.queue)
+        self._wakeup()
+
+    def _dequeue(self):
+        entry = self.queue.popleft()
+        if self.overflow == 'coalesce':
+            key = (entry[0], entry[1])
+            if self._queued_by_key.get(key) is entry:
+                del self._queued_by_key[key]
+        return entry
+
+    def _wakeup(self):
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    @asyncio.coroutine
+    def run(self):
+        '''Write queued events to the client as it accepts them
+
+        Returns when the subscriber gets disconnected, run until cancelled
+        otherwise.
+        '''
+        while not self.disconnected:
+            if self.connection is not None:
+                yield from self.connection.drain()
+            if not self.queue:
+                self._waiter = asyncio.get_event_loop().create_future()
+                try:
+                    yield from self._waiter
+                finally:
+                    self._waiter = None
+                continue
+            while self.queue and not self.paused:
+                self.connection.send_serialized_event(self._dequeue()[2])
+                self.delivered += 1
+
+
+class EventBus(object):
+    '''Fan-out of events of the app and its domains to subscribers
+
+    Use :py:meth:`get` to get the instance for given app.
+
+    :param qubes.Qubes app: the app
+    '''
+
+    _instances = weakref.WeakKeyDictionary()
+
+    #: how many past events to keep for sequenced subscribers
+    replay_size = 10000
+
+    #: how long (in seconds) to keep past events after the last sequenced
+    #: subscriber leaves
+    replay_keep = 600
+
+    def __init__(self, app):
+        self.app = app
+        #: current subscribers; replaced, not modified, so handlers can
+        #: iterate over it safely
+        self.subscribers = ()
+        #: identifier of this bus; sequence numbers from other epoch are
+        #: meaningless; changes also when past events are dropped, since
+        #: events are not counted while the bus is detached
+        self.epoch = self._new_epoch()
+        #: sequence number of the last event
+        self.sequence = 0
+        #: past events, as ``(sequence, weak reference to subject, subject
+        #: name, event, kwargs converted to strings, serialized event with
+        #: sequence number)``; :py:obj:`None` when not recording them
+        self.replay = None
+        self._replay_drop_handle = None
+        self._attached = False
+        self._last_ident = 0
+
+    @classmethod
+    def get(cls, app):
+        '''Get the bus of given app, create it if needed
+
+        :param qubes.Qubes app: the app
+        :rtype: EventBus
+        '''
+        try:
+            return cls._instances[app]
+        except KeyError:
+            bus = cls._instances[app] = cls(app)
+            return bus
+
+    def subscribe(self, send_event, filters=(), dest=None, **kwargs):
+        '''Add a subscriber
+
+        Arguments are passed to :py:class:`Subscriber`. Subscribing with
+        ``sequenced=True`` starts recording events for replay, and they are
+        recorded until :py:attr:`replay_keep` seconds after the last
+        sequenced subscriber leaves, even when there are no subscribers.
+
+        :rtype: Subscriber
+        '''
+        subscriber = Subscriber(send_event, filters, dest=dest, **kwargs)
+        self._last_ident += 1
+        subscriber.ident = self._last_ident
+        if subscriber.sequenced:
+            if self.replay is None:
+                self.replay = collections.deque(maxlen=self.replay_size)
+            if self._replay_drop_handle is not None:
+                self._replay_drop_handle.cancel()
+                self._replay_drop_handle = None
+        if not self._attached:
+            self._attach()
+        self.subscribers += (subscriber,)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        '''Remove a subscriber'''
+        self.subscribers = tuple(s for s in self.subscribers
+            if s is not subscriber)
+        subscriber.close()
+        if self.replay is not None and self._replay_drop_handle is None \
+                and not any(s.sequenced for s in self.subscribers):
+            self._replay_drop_handle = asyncio.get_event_loop().call_later(
+                self.replay_keep, self._drop_replay)
+        if not self.subscribers and self.replay is None:
+            self._detach()
+
+    @staticmethod
+    def _new_epoch():
+        return binascii.hexlify(os.urandom(4)).decode('ascii')
+
+    def _drop_replay(self):
+        self._replay_drop_handle = None
+        self.replay = None
+        # events missed from now on can't be replayed, make sure no client
+        # resumes with sequence number from before
+        self.epoch = self._new_epoch()
+        if not self.subscribers:
+            self._detach()
+
+    def can_resume(self, epoch, sequence):
+        '''Check if all events after given one are available for replay
+
+        :param str epoch: :py:attr:`epoch` the client got the events from
+        :param int sequence: sequence number of the last event the client
+            got
+        :rtype: bool
+        '''
+        if epoch != self.epoch or self.replay is None \
+                or not 0 <= sequence <= self.sequence:
+            return False
+        if sequence == self.sequence:
+            return True
+        # there must be no gap between the requested and the oldest event
+        return bool(self.replay) and self.replay[0][0] <= sequence + 1
+
+    def resume(self, subscriber, sequence):
+        '''Deliver to the subscriber past events after given one
+
+        Check first with :py:meth:`can_resume` that none of them is missing.
+
+        :param Subscriber subscriber: sequenced subscriber
+        :param int sequence: sequence number of the last event the client
+            got
+        '''
+        assert subscriber.sequenced
+        for event_seq, subject_ref, name, event, kwargs, data in self.replay:
+            if event_seq <= sequence:
+                continue
+            subject = subject_ref()
+            if subject is None:
+                if subscriber.filter is not None:
+                    # filters can't tell anything about removed subject
+                    continue
+                subject = _RemovedSubject(name)
+            if subscriber.accepts(subject, event, kwargs):
+                subscriber.put(subject, event, kwargs, data)
+
+    def stats(self):
+        '''Statistics of all subscribers
+
+        :rtype: list of dicts, see :py:meth:`Subscriber.stats`
+        '''
+        return [subscriber.stats() for subscriber in self.subscribers]
+
+    def _attach(self):
+        self._attached = True
+        self.app.add_handler('*', self.app_handler)
+        self.app.add_handler('domain-add', self.on_domain_add)
+        self.app.add_handler('domain-delete', self.on_domain_delete)
+        for vm in self.app.domains:
+            vm.add_handler('*', self.vm_handler)
+
+    def _detach(self):
+        self._attached = False
+        self.app.remove_handler('*', self.app_handler)
+        self.app.remove_handler('domain-add', self.on_domain_add)
+        self.app.remove_handler('domain-delete', self.on_domain_delete)
+        for vm in self.app.domains:
+            vm.remove_handler('*', self.vm_handler)
+
+    def _dispatch(self, subject, event, kwargs):
+        self.sequence += 1
+        data = None
+        sequenced_data = None
+        if self.replay is not None:
+            sequenced_data = qubes.api.serialize_event(self.app, subject,
+                event, kwargs, sequence=self.sequence)
+            self.replay.append((self.sequence, weakref.ref(subject),
+                getattr(subject, 'name', None), event,
+                {key: str(value) for key, value in kwargs.items()},
+                sequenced_data))
+        for subscriber in self.subscribers:
+            if not subscriber.accepts(subject, event, kwargs):
+                continue
+            if subscriber.sequenced:
+                subscriber.put(subject, event, kwargs, sequenced_data)
+                continue
+            if data is None and subscriber.connection is not None:
+                data = qubes.api.serialize_event(self.app, subject, event,
+                    kwargs)
+            subscriber.put(subject, event, kwargs, data)
+
+    def vm_handler(self, subject, event, **kwargs):
+        '''Handler for all events of all domains'''
+        if event.startswith('mgmt-permission:'):
+            return
+        self._dispatch(subject, event, kwargs)
+
+    def app_handler(self, subject, event, **kwargs):
+        '''Handler for all events of the app'''
+        self._dispatch(subject, event, kwargs)
+
+    def on_domain_add(self, subject, event, vm):
+        # pylint: disable=unused-argument
+        vm.add_handler('*', self.vm_handler)
+
+    def on_domain_delete(self, subject, event, vm):
+        # pylint: disable=unused-argument
+        vm.remove_handler('*', self.vm_handler)
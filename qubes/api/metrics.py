@@ -0,0 +1,309 @@
+# -*- encoding: utf8 -*-
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, see <http://www.gnu.org/licenses/>.
+
+'''Counters and timing of API calls
+
+:py:class:`qubes.api.QubesDaemonProtocol` records each call in
+:py:class:`APIMetrics` of the app: number of calls by method, source qube
+and result, calls in progress by method, and histograms of time spent in
+each phase of a call (see :py:data:`PHASES`) by method.
+:py:class:`qubes.api.scheduler.CallScheduler` records there the number of
+calls waiting in each lane, and calls refused because of too many waiting.
+Delivery statistics of each ``admin.Events`` subscriber (see
+:py:meth:`qubes.api.eventbus.EventBus.stats`) are added when rendering.
+
+The metrics are available in `OpenMetrics
+<https://openmetrics.io/>`_ text format through ``admin.api.Stats`` call and
+on :py:data:`METRICS_SOCKNAME` socket, which sends them to each client
+connecting to it, and closes the connection.
+'''
+
+import asyncio
+import bisect
+import errno
+import os
+import shutil
+import socket
+import weakref
+
+import qubes.api.eventbus
+
+#: socket sending the metrics, see :py:func:`create_metrics_server`
+METRICS_SOCKNAME = '/var/run/qubesd.metrics.sock'
+
+#: phases of a call: waiting for admission (see
+#: :py:mod:`qubes.api.scheduler`), checking permission (``mgmt-permission:``
+#: events), the rest of the method handler, and writing the response
+PHASES = ('queue', 'permission', 'handler', 'write')
+
+#: results of a call
+RESULTS = ('ok', 'permission_denied', 'protocol_error', 'exception',
+    'internal_error')
+
+#: upper bounds of histogram buckets, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+    0.25, 0.5, 1., 2.5, 5., 10.)
+
+#: ``admin.Events`` subscriber statistics rendered, as ``(key in
+#: :py:meth:`qubes.api.eventbus.Subscriber.stats`, metric name, type,
+#: description)``
+SUBSCRIBER_METRICS = (
+    ('received', 'qubesd_events_received', 'counter',
+        'Events accepted by admin.Events subscriber'),
+    ('delivered', 'qubesd_events_delivered', 'counter',
+        'Events written to admin.Events subscriber'),
+    ('dropped', 'qubesd_events_dropped', 'counter',
+        'Events discarded because admin.Events subscriber queue was full'),
+    ('coalesced', 'qubesd_events_coalesced', 'counter',
+        'Events merged into events queued for admin.Events subscriber'),
+    ('queued', 'qubesd_events_queued', 'gauge',
+        'Events queued for admin.Events subscriber'),
+    ('lag', 'qubesd_events_lag_seconds', 'gauge',
+        'How long the oldest event queued for admin.Events subscriber '
+        'waits'),
+)
+
+#: label used for a method or a source qube which does not exist, so
+#: clients can not create arbitrary number of entries
+UNKNOWN = 'unknown'
+
+
+def _escape(value):
+    '''Escape label value'''
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
+
+
+def _labels(**labels):
+    return '{' + ','.join('{}="{}"'.format(key, _escape(value))
+        for key, value in sorted(labels.items())) + '}'
+
+
+class Histogram(object):
+    '''Distribution of observed values
+
+    :param buckets: upper bounds of buckets, sorted
+    '''
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        #: number of observations in each bucket (not cumulative), the last
+        #: one is above the highest bound
+        self.counts = [0] * (len(buckets) + 1)
+        #: sum of all observed values
+        self.sum = 0.
+        #: number of observations
+        self.count = 0
+
+    def observe(self, value):
+        '''Record single observation'''
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class APIMetrics(object):
+    '''Metrics of API calls handled for an app
+
+    Use :py:meth:`get` to get the instance for given app.
+
+    :param buckets: upper bounds of buckets of latency histograms
+    '''
+
+    _instances = weakref.WeakKeyDictionary()
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        #: number of finished calls, by ``(method, source qube, result)``
+        self.calls = {}
+        #: number of calls in progress, by method
+        self.in_flight = {}
+        #: :py:class:`Histogram` of call phases, by ``(method, phase)``
+        self.latency = {}
+        #: number of calls waiting for admission, by lane
+        self.queued = {}
+        #: number of calls refused because of full queue, by lane
+        self.rejected = {}
+
+    @classmethod
+    def get(cls, app):
+        '''Get metrics of given app, create them if needed
+
+        :param qubes.Qubes app: the app
+        :rtype: APIMetrics
+        '''
+        try:
+            return cls._instances[app]
+        except KeyError:
+            metrics = cls._instances[app] = cls()
+            return metrics
+
+    def call_started(self, method):
+        '''Record start of a call
+
+        :param str method: method name, or :py:data:`UNKNOWN`
+        '''
+        self.in_flight[method] = self.in_flight.get(method, 0) + 1
+
+    def call_finished(self, method, source, result, times):
+        '''Record end of a call
+
+        :param str method: method name, or :py:data:`UNKNOWN`
+        :param str source: source qube name, or :py:data:`UNKNOWN`
+        :param str result: one of :py:data:`RESULTS`
+        :param times: time spent in each of :py:data:`PHASES` reached by
+            the call, in seconds, by phase
+        '''
+        self.in_flight[method] -= 1
+        key = (method, source, result)
+        self.calls[key] = self.calls.get(key, 0) + 1
+        for phase, elapsed in times.items():
+            try:
+                histogram = self.latency[method, phase]
+            except KeyError:
+                histogram = self.latency[method, phase] = Histogram(
+                    self.buckets)
+            histogram.observe(elapsed)
+
+    def render(self, subscribers=()):
+        '''Format the metrics in OpenMetrics text format
+
+        :param subscribers: statistics of ``admin.Events`` subscribers, see
+            :py:meth:`qubes.api.eventbus.EventBus.stats`
+        :rtype: str
+        '''
+        lines = [
+            '# TYPE qubesd_api_calls counter',
+            '# HELP qubesd_api_calls Finished API calls',
+        ]
+        for (method, source, result), value in sorted(self.calls.items()):
+            lines.append('qubesd_api_calls_total{} {}'.format(
+                _labels(method=method, source=source, result=result), value))
+
+        lines.extend((
+            '# TYPE qubesd_api_calls_in_flight gauge',
+            '# HELP qubesd_api_calls_in_flight API calls in progress',
+        ))
+        for method, value in sorted(self.in_flight.items()):
+            lines.append('qubesd_api_calls_in_flight{} {}'.format(
+                _labels(method=method), value))
+
+        lines.extend((
+            '# TYPE qubesd_api_calls_queued gauge',
+            '# HELP qubesd_api_calls_queued API calls waiting for admission',
+        ))
+        for lane, value in sorted(self.queued.items()):
+            lines.append('qubesd_api_calls_queued{} {}'.format(
+                _labels(lane=lane), value))
+
+        lines.extend((
+            '# TYPE qubesd_api_calls_rejected counter',
+            '# HELP qubesd_api_calls_rejected API calls refused because of '
+                'too many waiting',
+        ))
+        for lane, value in sorted(self.rejected.items()):
+            lines.append('qubesd_api_calls_rejected_total{} {}'.format(
+                _labels(lane=lane), value))
+
+        lines.extend((
+            '# TYPE qubesd_api_call_duration_seconds histogram',
+            '# HELP qubesd_api_call_duration_seconds Time spent in each '
+                'phase of API calls',
+        ))
+        for (method, phase), histogram in sorted(self.latency.items()):
+            cumulative = 0
+            bounds = [repr(bound) for bound in histogram.buckets] + ['+Inf']
+            for bound, count in zip(bounds, histogram.counts):
+                cumulative += count
+                lines.append('qubesd_api_call_duration_seconds_bucket{} {}'
+                    .format(_labels(method=method, phase=phase, le=bound),
+                        cumulative))
+            labels = _labels(method=method, phase=phase)
+            lines.append('qubesd_api_call_duration_seconds_sum{} {!r}'.format(
+                labels, histogram.sum))
+            lines.append('qubesd_api_call_duration_seconds_count{} {}'.format(
+                labels, histogram.count))
+
+        for key, name, metric_type, description in SUBSCRIBER_METRICS:
+            lines.extend((
+                '# TYPE {} {}'.format(name, metric_type),
+                '# HELP {} {}'.format(name, description),
+            ))
+            sample = name + '_total' if metric_type == 'counter' else name
+            for stats in subscribers:
+                lines.append('{}{} {!r}'.format(sample,
+                    _labels(subscriber=str(stats['id']),
+                        source=stats['source'] or UNKNOWN),
+                    stats[key]))
+
+        lines.append('# EOF')
+        return ''.join(line + '\n' for line in lines)
+
+
+class MetricsProtocol(asyncio.Protocol):
+    '''Send the metrics to the client and close the connection
+
+    :param qubes.Qubes app: the app
+    '''
+
+    def __init__(self, app):
+        self.app = app
+
+    def connection_made(self, transport):
+        transport.write(APIMetrics.get(self.app).render(
+            qubes.api.eventbus.EventBus.get(self.app).stats()).encode('utf-8'))
+        transport.close()
+
+
+@asyncio.coroutine
+def create_metrics_server(app, sockpath=METRICS_SOCKNAME, force=False,
+        loop=None):
+    '''Create server sending the metrics
+
+    :param qubes.Qubes app: the app
+    :param str sockpath: socket path
+    :param bool force: see :py:func:`qubes.api.create_servers`
+    :param asyncio.Loop loop: loop
+    '''
+    loop = loop or asyncio.get_event_loop()
+
+    if os.path.exists(sockpath):
+        if force:
+            os.unlink(sockpath)
+        else:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(sockpath)
+            except ConnectionRefusedError:
+                # dead socket, remove it anyway
+                os.unlink(sockpath)
+            else:
+                sock.close()
+                raise FileExistsError(errno.EEXIST,
+                    'socket already exists: {!r}'.format(sockpath))
+
+    old_umask = os.umask(0o007)
+    try:
+        server = yield from loop.create_unix_server(
+            lambda: MetricsProtocol(app), sockpath)
+    finally:
+        os.umask(old_umask)
+
+    for sock in server.sockets:
+        shutil.chown(sock.getsockname(), group='qubes')
+
+    return server
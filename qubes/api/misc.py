@@ -64,7 +64,7 @@ class QubesMiscAPI(qubes.api.AbstractQubesAPI):
 
         self.src.fire_event('features-request',
             untrusted_features=untrusted_features)
-        self.app.save()
+        self.app.schedule_save()
 
     @qubes.api.method('qubes.NotifyTools', no_payload=True)
     @asyncio.coroutine
@@ -89,7 +89,7 @@ class QubesMiscAPI(qubes.api.AbstractQubesAPI):
 
         self.src.fire_event('features-request',
             untrusted_features=untrusted_features)
-        self.app.save()
+        self.app.schedule_save()
 
     @qubes.api.method('qubes.NotifyUpdates')
     @asyncio.coroutine
@@ -110,7 +110,7 @@ class QubesMiscAPI(qubes.api.AbstractQubesAPI):
         if self.src.updateable:
             # Just trust information from VM itself
             self.src.features['updates-available'] = bool(update_count)
-            self.app.save()
+            self.app.schedule_save()
         elif getattr(self.src, 'template', None) is not None:
             # Hint about updates availability in template
             # If template is running - it will notify about updates itself
@@ -124,4 +124,4 @@ class QubesMiscAPI(qubes.api.AbstractQubesAPI):
                     return
                 self.src.template.features['updates-available'] = bool(
                     update_count)
-                self.app.save()
+                self.app.schedule_save()
@@ -0,0 +1,211 @@
+# -*- encoding: utf8 -*-
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, see <http://www.gnu.org/licenses/>.
+
+'''Admission control of API calls
+
+Each call received by :py:class:`qubes.api.QubesDaemonProtocol` for a
+handler with :py:attr:`qubes.api.AbstractQubesAPI.ADMISSION_CONTROL` set
+(only :py:class:`qubes.api.admin.QubesAdminAPI`, so calls from qubes'
+agents never wait behind management ones) waits in
+:py:class:`CallScheduler` until it may run. Calls are put in one of two
+lanes (see :py:func:`method_lane`): ``read`` for methods only reading the
+state, and ``write`` for everything else (changing the state, or executing
+something), so a source qube running many long operations (like cloning
+volumes or starting qubes) still can list its qubes.
+
+In each lane, a source qube may run only :py:attr:`CallScheduler.source_limits`
+calls at the same time, and all the sources together
+:py:attr:`CallScheduler.lane_limits` calls. When a call finishes, the
+sources waiting in the lane take turns. Calls of
+:py:attr:`CallScheduler.exempt` sources (dom0 tools) never wait.
+
+There are no limits by default; :program:`qubesd` sets them from
+:py:data:`qubes.config.defaults`.
+'''
+
+import asyncio
+import collections
+import weakref
+
+import qubes.api.metrics
+
+#: lanes of calls, see module description
+LANES = ('read', 'write')
+
+
+class QueueFull(Exception):
+    '''Raised when a source has too many calls waiting'''
+    pass
+
+
+def method_lane(handler, method):
+    '''Lane of a method, based on its classifiers (see
+    :py:func:`qubes.api.method`)
+
+    Methods not marked as only reading, and unknown methods, are put in
+    ``write`` lane.
+
+    :param handler: API class (child of
+        :py:class:`qubes.api.AbstractQubesAPI`)
+    :param bytes method: method name, as received from the client
+    :rtype: str
+    '''
+    try:
+        func, _ = handler.method_table()[method.decode('ascii')]
+    except (KeyError, UnicodeDecodeError):
+        return 'write'
+    classifiers = getattr(func, 'classifiers', {})
+    if classifiers.get('read') and not classifiers.get('write') \
+            and not classifiers.get('execute'):
+        return 'read'
+    return 'write'
+
+
+class CallScheduler(object):
+    '''Decides when API calls may run
+
+    Use :py:meth:`get` to get the instance for given app.
+
+    :param qubes.api.metrics.APIMetrics metrics: where to record queue
+        depth and refused calls
+    '''
+
+    #: sources not subject to the limits
+    exempt = frozenset(('dom0',))
+
+    _instances = weakref.WeakKeyDictionary()
+
+    def __init__(self, metrics=None):
+        self.metrics = metrics or qubes.api.metrics.APIMetrics()
+        for lane in LANES:
+            self.metrics.queued.setdefault(lane, 0)
+            self.metrics.rejected.setdefault(lane, 0)
+        #: calls of a single source running at the same time, by lane;
+        #: :py:obj:`None` for no limit
+        self.source_limits = dict.fromkeys(LANES)
+        #: calls of all the sources running at the same time, by lane;
+        #: :py:obj:`None` for no limit
+        self.lane_limits = dict.fromkeys(LANES)
+        #: calls of a single source waiting in a lane, above which new calls
+        #: are refused; :py:obj:`None` for no limit
+        self.max_queued = None
+        #: calls running, by lane
+        self.running = dict.fromkeys(LANES, 0)
+        #: calls running, by ``(lane, source)``
+        self.running_by_source = {}
+        #: futures of waiting calls, by lane and source; sources are in the
+        #: order they take turns
+        self.waiting = {lane: collections.OrderedDict() for lane in LANES}
+
+    @classmethod
+    def get(cls, app):
+        '''Get the scheduler of given app, create it if needed
+
+        :param qubes.Qubes app: the app
+        :rtype: CallScheduler
+        '''
+        try:
+            return cls._instances[app]
+        except KeyError:
+            scheduler = cls._instances[app] = cls(
+                qubes.api.metrics.APIMetrics.get(app))
+            return scheduler
+
+    def can_run(self, source, lane):
+        '''Check if a call of the source would be admitted right now
+
+        :rtype: bool
+        '''
+        if source in self.exempt:
+            return True
+        limit = self.lane_limits[lane]
+        if limit is not None and self.running[lane] >= limit:
+            return False
+        limit = self.source_limits[lane]
+        return limit is None \
+            or self.running_by_source.get((lane, source), 0) < limit
+
+    @asyncio.coroutine
+    def acquire(self, source, lane):
+        '''Wait until a call may run, call :py:meth:`release` when it
+        finishes
+
+        :param str source: name of the source qube
+        :param str lane: one of :py:data:`LANES`
+        :raises QueueFull: when too many calls of the source are waiting
+        '''
+        queue = self.waiting[lane].get(source)
+        if not queue and self.can_run(source, lane):
+            self._start(source, lane)
+            return
+
+        if queue is None:
+            queue = self.waiting[lane][source] = collections.deque()
+        if self.max_queued is not None and len(queue) >= self.max_queued:
+            self.metrics.rejected[lane] += 1
+            raise QueueFull(
+                'too many calls of {} waiting in {} lane'.format(source, lane))
+
+        future = asyncio.get_event_loop().create_future()
+        queue.append(future)
+        self.metrics.queued[lane] += 1
+        try:
+            yield from future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # admitted in the meantime
+                self.release(source, lane)
+            elif future in queue:
+                self._dequeue(source, lane, future)
+            raise
+
+    def release(self, source, lane):
+        '''Mark a call admitted by :py:meth:`acquire` as finished'''
+        self.running[lane] -= 1
+        key = (lane, source)
+        self.running_by_source[key] -= 1
+        if not self.running_by_source[key]:
+            del self.running_by_source[key]
+
+        waiting = self.waiting[lane]
+        for waiting_source in list(waiting):
+            queue = waiting[waiting_source]
+            while queue and queue[0].done():
+                # cancelled, but not removed yet
+                self._dequeue(waiting_source, lane, queue[0])
+            if waiting_source not in waiting \
+                    or not self.can_run(waiting_source, lane):
+                continue
+            future = queue[0]
+            self._dequeue(waiting_source, lane, future)
+            self._start(waiting_source, lane)
+            future.set_result(None)
+            if waiting_source in waiting:
+                # let others go first
+                waiting.move_to_end(waiting_source)
+
+    def _start(self, source, lane):
+        self.running[lane] += 1
+        key = (lane, source)
+        self.running_by_source[key] = self.running_by_source.get(key, 0) + 1
+
+    def _dequeue(self, source, lane, future):
+        queue = self.waiting[lane][source]
+        queue.remove(future)
+        self.metrics.queued[lane] -= 1
+        if not queue:
+            del self.waiting[lane][source]
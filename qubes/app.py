@@ -21,10 +21,14 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 #
 
+import asyncio
 import collections
+import copy
 import errno
 import functools
 import grp
+import itertools
+import json
 import logging
 import os
 import random
@@ -367,6 +371,46 @@ class QubesHost(object):
         return (current_time, current)
 
 
+class VMStub(object):
+    '''Placeholder for a domain which is not loaded yet.
+
+    See *lazy* argument of :py:meth:`Qubes.load`.
+
+    :param qubes.Qubes app: Qubes application context
+    :param lxml.etree._Element node: ``<domain>`` node of the store
+    :param int qid: qid of the domain
+    :param str name: name of the domain
+    '''
+    # pylint: disable=too-few-public-methods
+    __slots__ = ('app', 'node', 'qid', 'name', 'uuid')
+
+    def __init__(self, app, node, qid, name):
+        self.app = app
+        self.node = node
+        self.qid = qid
+        self.name = name
+        #: uuid as stored in XML, or :py:obj:`None` if not (yet) assigned
+        self.uuid = node.findtext('./properties/property[@name="uuid"]')
+
+    @classmethod
+    def fromxml(cls, app, node):
+        '''Create stub from ``<domain>`` node.
+
+        :return: stub or :py:obj:`None` if the node lacks qid or name \
+            (because they have default values), so the domain needs to be \
+            loaded right away
+        '''
+        qid = node.findtext('./properties/property[@name="qid"]')
+        name = node.findtext('./properties/property[@name="name"]')
+        if qid is None or name is None:
+            return None
+        return cls(app, node, int(qid), name)
+
+    def __xml__(self):
+        # untouched domain is saved as it was loaded
+        return copy.deepcopy(self.node)
+
+
 class VMCollection(object):
     '''A collection of Qubes VMs
 
@@ -374,11 +418,62 @@ class VMCollection(object):
     and whole VM object's presence.
 
     Iterating over VMCollection will yield machine objects.
+
+    Collection may also hold :py:class:`VMStub` placeholders of domains not
+    loaded yet (see *lazy* argument of :py:meth:`Qubes.load`). Those are
+    loaded when accessed, but do not need to be for checking presence,
+    counting them or listing their qids and names.
+
+    Lookups by ``name`` and ``uuid`` go through indexes, which are updated
+    when a domain is added, deleted or its ``name`` or ``uuid`` property
+    changes. Similarly, domains are indexed by their ``template`` and
+    ``netvm``, for :py:meth:`get_vms_based_on` and
+    :py:meth:`get_vms_connected_directly_to`.
+
+    Sorted sequences of domains, their qids and names are kept until
+    a domain is added, deleted or renamed, so iterating does not sort the
+    collection each time.
     '''
 
+    #: properties indexed by the collection, see :py:meth:`_on_vm_rekey`
+    _indexed_properties = ('name', 'uuid')
+
+    #: properties referencing other domains, indexed in reverse
+    _relation_properties = ('template', 'netvm')
+
+    #: properties, on change of which relations are indexed again;
+    #: ``provides_network`` selects the default ``netvm``
+    _relation_events = tuple('property-{}:{}'.format(action, prop)
+        for prop in _relation_properties + ('provides_network',)
+        for action in ('set', 'del')) + ('domain-load',)
+
     def __init__(self, app):
         self.app = app
         self._dict = dict()
+        self._stubs = dict()
+        #: qids of both loaded domains and stubs, by name
+        self._by_name = dict()
+        #: qids of both loaded domains and stubs, by uuid
+        self._by_uuid = dict()
+        #: for each of :py:attr:`_relation_properties`, qids of domains
+        #: referencing given qid
+        self._dependents = {prop: dict()
+            for prop in self._relation_properties}
+        #: for each of :py:attr:`_relation_properties`, qid referenced by
+        #: given domain, as currently indexed in :py:attr:`_dependents`
+        self._references = {prop: dict()
+            for prop in self._relation_properties}
+        #: qids of loaded domains, by netid
+        self._netids = dict()
+        #: qids of loaded domains, by dispid
+        self._dispids = dict()
+        #: all qids lower than this are in use
+        self._qid_hint = 1
+        #: cached results of :py:meth:`vms`, :py:meth:`qids` and
+        #: :py:meth:`names`, see :py:meth:`_invalidate_sorted`
+        self._sorted_vms = None
+        self._sorted_qids = None
+        self._sorted_names = None
 
 
     def __repr__(self):
@@ -398,7 +493,10 @@ class VMCollection(object):
         qids are sorted by numerical order.
         '''
 
-        return iter(sorted(self._dict.keys()))
+        if self._sorted_qids is None:
+            self._sorted_qids = sorted(
+                itertools.chain(self._dict, self._stubs))
+        return iter(self._sorted_qids)
 
     keys = qids
 
@@ -409,7 +507,10 @@ class VMCollection(object):
         names are sorted by lexical order.
         '''
 
-        return iter(sorted(vm.name for vm in self._dict.values()))
+        if self._sorted_names is None:
+            self._sorted_names = sorted(vm.name for vm in itertools.chain(
+                self._dict.values(), self._stubs.values()))
+        return iter(self._sorted_names)
 
 
     def vms(self):
@@ -418,11 +519,139 @@ class VMCollection(object):
         vms are sorted by qid.
         '''
 
-        return iter(sorted(self._dict.values()))
+        self._load_stubs()
+        if self._sorted_vms is None:
+            self._sorted_vms = sorted(self._dict.values())
+        return iter(self._sorted_vms)
 
     __iter__ = vms
     values = vms
 
+    def loaded_vms(self):
+        '''Iterate over machines which are already loaded
+
+        Unlike :py:meth:`vms`, this does not load domains held as
+        :py:class:`VMStub`. Order is undefined.
+        '''
+
+        return iter(list(self._dict.values()))
+
+    def xml_vms(self):
+        '''Iterate over machines and stubs, for serialising them
+
+        Stubs are not loaded. Items are sorted by name.
+        '''
+
+        return iter(sorted(
+            itertools.chain(self._dict.values(), self._stubs.values()),
+            key=lambda vm: vm.name))
+
+    def add_stub(self, stub):
+        '''Add placeholder for a domain, which will be loaded on first access
+
+        :param VMStub stub: domain placeholder
+        :raises ValueError: when there is already VM which has equal ``qid`` \
+            or ``name``
+        '''
+
+        if stub.qid in self or stub.name in self:
+            raise ValueError('This collection already holds VM that has '
+                'qid={!r} or name={!r}'.format(stub.qid, stub.name))
+        self._stubs[stub.qid] = stub
+        self._invalidate_sorted()
+        self._index(stub.qid, 'name', stub.name)
+        self._index(stub.qid, 'uuid', self._stub_uuid(stub))
+
+    def _invalidate_sorted(self):
+        # cached lists are replaced, not modified, so iterators already
+        # returned keep working
+        self._sorted_vms = None
+        self._sorted_qids = None
+        self._sorted_names = None
+
+    def _load_stubs(self):
+        for qid in list(self._stubs):
+            self._load_stub(qid)
+
+    def _load_stub(self, qid):
+        stub = self._stubs.pop(qid)
+        self._invalidate_sorted()
+        self._unindex(qid, 'name', stub.name)
+        self._unindex(qid, 'uuid', self._stub_uuid(stub))
+        return self.app.load_domain(stub.node, complete=True)
+
+    @staticmethod
+    def _stub_uuid(stub):
+        try:
+            return uuid.UUID(stub.uuid)
+        except (TypeError, ValueError):
+            return None
+
+    def _index(self, qid, prop, value):
+        if value is None:
+            return
+        if prop == 'name':
+            self._by_name[value] = qid
+        else:
+            self._by_uuid[value] = qid
+
+    def _unindex(self, qid, prop, value):
+        index = self._by_name if prop == 'name' else self._by_uuid
+        # do not drop entry of another domain, which happens to share the value
+        if value is not None and index.get(value) == qid:
+            del index[value]
+
+    def _on_vm_rekey(self, subject, event, name, newvalue=None,
+            oldvalue=None):
+        '''Keep indexes coherent when ``name`` or ``uuid`` changes'''
+        if name == 'name':
+            self._invalidate_sorted()
+        self._unindex(subject.qid, name, oldvalue)
+        if event.startswith('property-set:'):
+            self._index(subject.qid, name, newvalue)
+
+    def _index_relations(self, vm):
+        self._unindex_relations(vm)
+        for prop in self._relation_properties:
+            # during load, properties are not there yet, or may reference
+            # domains of not yet loaded global defaults; domain-load will
+            # bring them here again
+            target = getattr(vm, prop, None)
+            if target is not None:
+                self._references[prop][vm.qid] = target.qid
+                self._add_to_index(self._dependents[prop], target.qid, vm.qid)
+
+    def _unindex_relations(self, vm):
+        for prop in self._relation_properties:
+            self._remove_from_index(self._dependents[prop],
+                self._references[prop].pop(vm.qid, None), vm.qid)
+
+    def _on_vm_relation_change(self, subject, event, **kwargs):
+        '''Keep reverse indexes coherent when ``template`` or ``netvm``
+        changes'''
+        # pylint: disable=unused-argument
+        self._index_relations(subject)
+
+    def refresh_relations(self):
+        '''Index again ``template`` and ``netvm`` of all loaded domains
+
+        This is needed when default values of those change.
+        '''
+        for vm in list(self._dict.values()):
+            self._index_relations(vm)
+
+    @staticmethod
+    def _add_to_index(index, key, qid):
+        if key is not None:
+            index.setdefault(key, set()).add(qid)
+
+    @staticmethod
+    def _remove_from_index(index, key, qid):
+        if key in index:
+            index[key].discard(qid)
+            if not index[key]:
+                del index[key]
+
     def add(self, value, _enable_events=True):
         '''Add VM to collection
 
@@ -446,6 +675,18 @@ class VMCollection(object):
                 .format(value.name))
 
         self._dict[value.qid] = value
+        self._invalidate_sorted()
+        for prop in self._indexed_properties:
+            self._index(value.qid, prop, getattr(value, prop, None))
+            value.add_handler('property-set:' + prop, self._on_vm_rekey)
+            value.add_handler('property-del:' + prop, self._on_vm_rekey)
+        for event in self._relation_events:
+            value.add_handler(event, self._on_vm_relation_change)
+        self._index_relations(value)
+        self._add_to_index(self._netids, getattr(value, 'netid', None),
+            value.qid)
+        self._add_to_index(self._dispids, getattr(value, 'dispid', None),
+            value.qid)
         if _enable_events:
             value.events_enabled = True
             self.app.fire_event('domain-add', vm=value)
@@ -454,21 +695,27 @@ class VMCollection(object):
 
     def __getitem__(self, key):
         if isinstance(key, int):
+            if key in self._stubs:
+                return self._load_stub(key)
             return self._dict[key]
 
         if isinstance(key, str):
-            for vm in self:
-                if vm.name == key:
-                    return vm
-            raise KeyError(key)
+            if key not in self._by_name:
+                raise KeyError(key)
+            return self[self._by_name[key]]
 
         if isinstance(key, qubes.vm.BaseVM):
             key = key.uuid
 
         if isinstance(key, uuid.UUID):
-            for vm in self:
-                if vm.uuid == key:
-                    return vm
+            if key in self._by_uuid:
+                return self[self._by_uuid[key]]
+            for stub in list(self._stubs.values()):
+                # stubs without uuid get one when loaded
+                if stub.uuid is None:
+                    vm = self._load_stub(stub.qid)
+                    if vm.uuid == key:
+                        return vm
             raise KeyError(key)
 
         raise KeyError(key)
@@ -485,21 +732,57 @@ class VMCollection(object):
                 # already undefined
                 pass
         del self._dict[vm.qid]
+        self._invalidate_sorted()
+        for prop in self._indexed_properties:
+            self._unindex(vm.qid, prop, getattr(vm, prop, None))
+            vm.remove_handler('property-set:' + prop, self._on_vm_rekey)
+            vm.remove_handler('property-del:' + prop, self._on_vm_rekey)
+        for event in self._relation_events:
+            vm.remove_handler(event, self._on_vm_relation_change)
+        self._unindex_relations(vm)
+        self._remove_from_index(self._netids, getattr(vm, 'netid', None),
+            vm.qid)
+        self._remove_from_index(self._dispids, getattr(vm, 'dispid', None),
+            vm.qid)
+        self._qid_hint = min(self._qid_hint, vm.qid)
         self.app.fire_event('domain-delete', vm=vm)
 
     def __contains__(self, key):
+        if isinstance(key, int):
+            return key in self._dict or key in self._stubs
+        if isinstance(key, str):
+            return key in self._by_name
+        if isinstance(key, qubes.vm.BaseVM):
+            return self._dict.get(getattr(key, 'qid', None)) is key
         return any((key == vm or key == vm.qid or key == vm.name)
-                   for vm in self)
+                   for vm in self._dict.values())
 
 
     def __len__(self):
-        return len(self._dict)
+        return len(self._dict) + len(self._stubs)
 
 
     def get_vms_based_on(self, template):
         template = self[template]
-        return set(vm for vm in self
-            if hasattr(vm, 'template') and vm.template == template)
+        # stubs are not indexed
+        self._load_stubs()
+        return set(self._dict[qid] for qid
+            in self._dependents['template'].get(template.qid, ()))
+
+
+    def get_vms_connected_directly_to(self, netvm):
+        '''Domains, which have *netvm* set as their ``netvm``
+
+        For all the domains which get network through *netvm*, including
+        indirectly, see :py:meth:`get_vms_connected_to`.
+
+        :rtype: set
+        '''
+        if not isinstance(netvm, qubes.vm.BaseVM):
+            netvm = self[netvm]
+        self._load_stubs()
+        return set(self._dict[qid] for qid
+            in self._dependents['netvm'].get(netvm.qid, ()))
 
 
     def get_vms_connected_to(self, netvm):
@@ -525,25 +808,27 @@ class VMCollection(object):
     # XXX with Qubes Admin Api this will probably lead to race condition
     # whole process of creating and adding should be synchronised
     def get_new_unused_qid(self):
-        used_ids = set(self.qids())
-        for i in range(1, qubes.config.max_qid):
-            if i not in used_ids:
+        for i in range(self._qid_hint, qubes.config.max_qid):
+            if i not in self._dict and i not in self._stubs:
+                # the qid is not reserved until the domain is added
+                self._qid_hint = i
                 return i
         raise LookupError("Cannot find unused qid!")
 
 
     def get_new_unused_netid(self):
-        used_ids = set([vm.netid for vm in self])  # if vm.is_netvm()])
+        self._load_stubs()
         for i in range(1, qubes.config.max_netid):
-            if i not in used_ids:
+            if i not in self._netids:
                 return i
         raise LookupError("Cannot find unused netid!")
 
 
     def get_new_unused_dispid(self):
+        self._load_stubs()
         for _ in range(int(qubes.config.max_dispid ** 0.5)):
             dispid = random.SystemRandom().randrange(qubes.config.max_dispid)
-            if not any(getattr(vm, 'dispid', None) == dispid for vm in self):
+            if dispid not in self._dispids:
                 return dispid
         raise LookupError((
             'https://xkcd.com/221/',
@@ -590,6 +875,21 @@ def _setter_pool(app, prop, value):
         raise qubes.exc.QubesPropertyValueError(app, prop, value,
             'No such storage pool')
 
+#: ``(container, tag, attribute)`` of XML nodes changed by journal records, by
+#: operation; *attribute* tells which node it is (with record's ``name``)
+_journal_nodes = {
+    'domain-set': (None, 'domain', None),
+    'domain-del': (None, 'domain', None),
+    'property-set': ('properties', 'property', 'name'),
+    'property-del': ('properties', 'property', 'name'),
+    'feature-set': ('features', 'feature', 'name'),
+    'feature-del': ('features', 'feature', 'name'),
+    'tag-add': ('tags', 'tag', 'name'),
+    'tag-del': ('tags', 'tag', 'name'),
+    'devices': (None, 'devices', 'class'),
+    'volume-config': (None, 'volume-config', 'class'),
+}
+
 class Qubes(qubes.PropertyHolder):
     '''Main Qubes application
 
@@ -614,6 +914,9 @@ class Qubes(qubes.PropertyHolder):
     5.  In the fifth stage there are some fixups to ensure sane system
         operation.
 
+    Before the first stage, changes from the journal (see
+    :py:attr:`journal_enabled`) are applied to the parsed store.
+
     This class emits following events:
 
         .. event:: domain-add (subject, event, vm)
@@ -698,7 +1001,7 @@ class Qubes(qubes.PropertyHolder):
         doc='check for updates inside qubes')
 
     def __init__(self, store=None, load=True, offline_mode=None, lock=False,
-            **kwargs):
+            lazy=False, **kwargs):
         #: logger instance for logging global messages
         self.log = logging.getLogger('app')
 
@@ -731,6 +1034,31 @@ class Qubes(qubes.PropertyHolder):
 
         self.__load_timestamp = None
         self.__locked_fh = None
+        # is :py:attr:`__locked_fh` actually locked; after :py:meth:`save`
+        # it is the new store, opened but not locked
+        self.__lock_held = False
+
+        #: delay (in seconds) of saves requested with :py:meth:`schedule_save`,
+        #: :py:obj:`None` means saving immediately
+        self.save_delay = None
+        #: number of saves requested with :py:meth:`schedule_save`
+        self.saves_requested = 0
+        #: number of times :file:`qubes.xml` was actually written
+        self.saves_performed = 0
+        self._save_handle = None
+
+        #: append changes requested with :py:meth:`schedule_save` to
+        #: :py:attr:`journal_path` instead of rewriting whole
+        #: :file:`qubes.xml`
+        self.journal_enabled = False
+        #: size (in bytes) of the journal, above which it is compacted
+        self.journal_max_size = qubes.config.defaults['journal_max_size']
+        #: changes not written to the journal yet: set of (qid, kind, name)
+        self._journal_dirty = set()
+        self._compact_handle = None
+        self.__journal_base = None
+        self.__journal_end = 0
+        self.__journal_size = None
 
         #: jinja2 environment for libvirt XML templates
         self.env = jinja2.Environment(
@@ -741,7 +1069,7 @@ class Qubes(qubes.PropertyHolder):
             undefined=jinja2.StrictUndefined)
 
         if load:
-            self.load(lock=lock)
+            self.load(lock=lock, lazy=lazy)
 
         self.events_enabled = True
 
@@ -749,16 +1077,32 @@ class Qubes(qubes.PropertyHolder):
     def store(self):
         return self._store
 
-    def load(self, lock=False):
+    @property
+    def journal_path(self):
+        '''Path to the journal of changes not yet written to the store'''
+        return self._store + '.journal'
+
+    def load(self, lock=False, lazy=False):
         '''Open qubes.xml
 
+        When *lazy* is true, domains are not loaded in the second and fourth
+        stage, but only when first accessed through :py:attr:`domains` (see
+        :py:class:`VMStub`). Domains referenced by others (like template or
+        netvm) are loaded as they are needed. This is meant for tools, which
+        deal only with a few domains.
+
+        :param bool lock: keep store (exclusively) locked after loading
+        :param bool lazy: load domains on first access
         :throws EnvironmentError: failure on parsing store
         :throws xml.parsers.expat.ExpatError: failure on parsing store
         :raises lxml.etree.XMLSyntaxError: on syntax error in qubes.xml
         '''
 
-        fh = self._acquire_lock()
+        # unless asked to keep the store locked for later save, a shared lock
+        # is enough and does not block other readers
+        fh = self._acquire_lock(shared=not lock)
         self.xml = lxml.etree.parse(fh)
+        self._journal_replay(os.fstat(fh.fileno()))
 
         # stage 1: load labels and pools
         for node in self.xml.xpath('./labels/label'):
@@ -774,13 +1118,13 @@ class Qubes(qubes.PropertyHolder):
                 self.log.error(str(e))
 
         # stage 2: load VMs
+        loaded = []
         for node in self.xml.xpath('./domains/domain'):
-            # pylint: disable=no-member
-            cls = self.get_vm_class(node.get('class'))
-            vm = cls(self, node)
-            vm.load_properties(load_stage=2)
-            vm.init_log()
-            self.domains.add(vm, _enable_events=False)
+            stub = VMStub.fromxml(self, node) if lazy else None
+            if stub is not None:
+                self.domains.add_stub(stub)
+            else:
+                loaded.append(self.load_domain(node))
 
         if 0 not in self.domains:
             self.domains.add(
@@ -790,8 +1134,9 @@ class Qubes(qubes.PropertyHolder):
         # stage 3: load global properties
         self.load_properties(load_stage=3)
 
-        # stage 4: fill all remaining VM properties
-        for vm in self.domains:
+        # stage 4: fill all remaining VM properties; domains loaded lazily
+        # (during stage 3) have those already
+        for vm in loaded:
             vm.load_properties(load_stage=4)
             vm.load_extras()
 
@@ -814,9 +1159,8 @@ class Qubes(qubes.PropertyHolder):
             else:
                 self.clockvm.features['service/ntpd'] = ''
 
-        for vm in self.domains:
-            vm.events_enabled = True
-            vm.fire_event('domain-load')
+        for vm in self.domains.loaded_vms():
+            self._domain_loaded(vm)
 
         # get a file timestamp (before closing it - still holding the lock!),
         #  to detect whether anyone else have modified it in the meantime
@@ -826,6 +1170,40 @@ class Qubes(qubes.PropertyHolder):
             self._release_lock()
 
 
+    def load_domain(self, node, complete=False):
+        '''Load a domain from ``<domain>`` node of the store.
+
+        This is the second stage of :py:meth:`load`; with *complete* also
+        the fourth one, and if the store is already loaded, the domain is
+        made ready for use.
+
+        :param lxml.etree._Element node: ``<domain>`` node
+        :param bool complete: load also properties referencing other domains
+        :rtype: :py:class:`qubes.vm.BaseVM`
+        '''
+
+        # pylint: disable=no-member
+        cls = self.get_vm_class(node.get('class'))
+        vm = cls(self, node)
+        vm.load_properties(load_stage=2)
+        vm.init_log()
+        # add before loading the rest, as domains may reference each other
+        self.domains.add(vm, _enable_events=False)
+
+        if complete:
+            vm.load_properties(load_stage=4)
+            vm.load_extras()
+            # during load(), events are enabled at the very end
+            if self.events_enabled:
+                self._domain_loaded(vm)
+
+        return vm
+
+    def _domain_loaded(self, vm):
+        vm.add_handler('*', self._journal_mark_domain)
+        vm.events_enabled = True
+        vm.fire_event('domain-load')
+
     def __xml__(self):
         element = lxml.etree.Element('qubes')
 
@@ -842,7 +1220,7 @@ class Qubes(qubes.PropertyHolder):
         element.append(self.xml_properties())
 
         domains = lxml.etree.Element('domains')
-        for vm in self.domains:
+        for vm in self.domains.xml_vms():
             domains.append(vm.__xml__())
         element.append(domains)
 
@@ -888,18 +1266,94 @@ class Qubes(qubes.PropertyHolder):
         # but they should instantly block on the new descriptor
         self.__locked_fh.close()
         self.__locked_fh = fh_new
+        self.__lock_held = False
+
+        # everything is in the store now, so start over with the journal
+        self._journal_reset()
+
+        self._save_done()
 
         if not lock:
             self._release_lock()
 
+    def schedule_save(self):
+        '''Request saving :file:`qubes.xml`, possibly postponed.
+
+        If :py:attr:`save_delay` is set, the actual save is done after that
+        many seconds, so all the changes requested in the meantime are
+        written at once. Otherwise this is the same as :py:meth:`save`.
+
+        Use :py:meth:`flush_save` when the changes need to be written before
+        proceeding.
+        '''
+
+        self.saves_requested += 1
+        if self.save_delay is None:
+            self._write_changes()
+            return
 
-    def _acquire_lock(self, for_save=False):
+        if self._save_handle is None:
+            self._save_handle = asyncio.get_event_loop().call_later(
+                self.save_delay, self._scheduled_save)
+
+    def flush_save(self):
+        '''Write changes postponed by :py:meth:`schedule_save`, if any.
+
+        :throws EnvironmentError: failure on saving
+        '''
+
+        if self._save_handle is not None:
+            self._write_changes()
+
+    @property
+    def save_pending(self):
+        '''Is there any save postponed by :py:meth:`schedule_save`'''
+        return self._save_handle is not None
+
+    def _save_done(self):
+        self.saves_performed += 1
+        # everything is written, no need for postponed save anymore
+        if self._save_handle is not None:
+            self._save_handle.cancel()
+            self._save_handle = None
+
+    def _write_changes(self):
+        if self.journal_enabled and self._journal_commit():
+            self._save_done()
+        else:
+            self.save()
+
+    def _scheduled_save(self):
+        self._save_handle = None
+        try:
+            self._write_changes()
+        except Exception:  # pylint: disable=broad-except
+            self.log.exception('Failed to save qubes.xml, will retry')
+            if self._save_handle is None:
+                self._save_handle = asyncio.get_event_loop().call_later(
+                    self.save_delay or 0, self._scheduled_save)
+
+
+    def _acquire_lock(self, for_save=False, shared=False):
+        '''Lock the store
+
+        Writers take an exclusive lock. Readers, which only parse the store,
+        may take a *shared* one, so any number of them can load concurrently
+        and only wait for a writer. The store is always replaced with
+        :py:func:`os.rename`, so a writer never modifies a file a reader holds
+        locked.
+
+        :param bool for_save: create the store if it does not exist
+        :param bool shared: take a shared (read) lock instead of exclusive one
+        '''
         assert self.__locked_fh is None, 'double lock'
+        assert not (for_save and shared), 'cannot save under shared lock'
 
         while True:
             try:
                 fd = os.open(self._store,
-                    os.O_RDWR | (os.O_CREAT * int(for_save)))
+                    (os.O_RDONLY if shared else os.O_RDWR) |
+                    (os.O_CREAT * int(for_save)))
             except OSError as e:
                 if not for_save and e.errno == errno.ENOENT:
                     raise qubes.exc.QubesException(
@@ -907,32 +1361,39 @@ class Qubes(qubes.PropertyHolder):
                         'use qubes-create tool'.format(self._store))
                 raise
 
+            if os.name == 'posix':
+                fcntl.lockf(fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            elif os.name == 'nt':
+                # pylint: disable=protected-access
+                overlapped = pywintypes.OVERLAPPED()
+                win32file.LockFileEx(
+                    win32file._get_osfhandle(fd),
+                    0 if shared else win32con.LOCKFILE_EXCLUSIVE_LOCK,
+                    0, -0x10000, overlapped)
+
             # While we were waiting for lock, someone could have unlink()ed
             # (or rename()d) our file out of the filesystem. We have to
             # ensure we got lock on something linked to filesystem.
             # If not, try again.
-            if os.fstat(fd) != os.stat(self._store):
+            try:
+                linked = os.fstat(fd) == os.stat(self._store)
+            except FileNotFoundError:
+                linked = False
+            if not linked:
                 os.close(fd)
                 continue
 
-            if self.__load_timestamp and \
-                    os.path.getmtime(self._store) != self.__load_timestamp:
+            if self.__load_timestamp and (
+                    os.path.getmtime(self._store) != self.__load_timestamp or
+                    self._journal_stat_size() != self.__journal_size):
                 os.close(fd)
                 raise qubes.exc.QubesException(
                     'Someone else modified qubes.xml in the meantime')
 
             break
 
-        if os.name == 'posix':
-            fcntl.lockf(fd, fcntl.LOCK_EX)
-        elif os.name == 'nt':
-            # pylint: disable=protected-access
-            overlapped = pywintypes.OVERLAPPED()
-            win32file.LockFileEx(
-                win32file._get_osfhandle(fd),
-                win32con.LOCKFILE_EXCLUSIVE_LOCK, 0, -0x10000, overlapped)
-
-        self.__locked_fh = os.fdopen(fd, 'r+b')
+        self.__locked_fh = os.fdopen(fd, 'rb' if shared else 'r+b')
+        self.__lock_held = True
         return self.__locked_fh
 
 
@@ -943,6 +1404,342 @@ class Qubes(qubes.PropertyHolder):
         # before all buffers are flushed
         self.__locked_fh.close()
         self.__locked_fh = None
+        self.__lock_held = False
+
+    #
+    # journal
+    #
+
+    @staticmethod
+    def _journal_fingerprint(stat):
+        # identifies the store the journal was started for; qubes.xml is
+        # always replaced with a new file, so any full save changes it
+        return [stat.st_ino, stat.st_size, stat.st_mtime_ns]
+
+    def _journal_stat_size(self):
+        try:
+            return os.stat(self.journal_path).st_size
+        except FileNotFoundError:
+            return None
+
+    def _journal_replay(self, store_stat):
+        '''Apply changes from the journal to just parsed store.
+
+        Journal which was not started for this very store (because store was
+        written after it) is ignored, as is anything after the last complete
+        entry, which may be left by a crash.
+        '''
+
+        self.__journal_base = None
+        self.__journal_end = 0
+        self.__journal_size = None
+
+        try:
+            with open(self.journal_path, 'rb') as fh:
+                data = fh.read()
+        except FileNotFoundError:
+            return
+        self.__journal_size = len(data)
+
+        base = self._journal_fingerprint(store_stat)
+        lines = data.splitlines(keepends=True)
+        header = None
+        if lines and lines[0].endswith(b'\n'):
+            try:
+                header = json.loads(lines[0].decode())
+            except ValueError:
+                pass
+        if not isinstance(header, dict) or header.get('base') != base:
+            self.log.warning('Ignoring stale journal %s', self.journal_path)
+            return
+
+        self.__journal_base = base
+        self.__journal_end = len(lines[0])
+        # only dom0 has default qid, so it is not saved
+        domains = {
+            int(node.findtext('./properties/property[@name="qid"]') or 0): node
+            for node in self.xml.xpath('./domains/domain')}
+
+        for line in lines[1:]:
+            if not line.endswith(b'\n'):
+                self.log.warning('Ignoring incomplete journal entry')
+                break
+            # check all records of the entry before applying any, so an
+            # invalid one does not leave the entry applied halfway
+            qids = set(domains)
+            try:
+                records = [self._journal_check(qids, record)
+                    for record in json.loads(line.decode())]
+            except (ValueError, KeyError, TypeError,
+                    lxml.etree.XMLSyntaxError) as e:
+                self.log.error('Ignoring invalid journal entry: %s', e)
+                break
+            for record in records:
+                self._journal_apply(domains, record)
+            self.__journal_end += len(line)
+
+    @staticmethod
+    def _journal_check(qids, record):
+        '''Check single journal record before it is applied
+
+        :param set qids: qids of domains present when the record is applied; \
+            updated by domain records
+        :param dict record: the record, as read from the journal
+        :returns: copy of the record, with XML already parsed
+        :raises ValueError, KeyError, TypeError: when the record is invalid
+        :raises lxml.etree.XMLSyntaxError: when the record has invalid XML
+        '''
+        operation = record['op']
+        if operation not in _journal_nodes:
+            raise ValueError('unknown operation {!r}'.format(operation))
+
+        qid = record['qid']
+        if operation in ('domain-set', 'domain-del'):
+            if not isinstance(qid, int):
+                raise TypeError('invalid qid {!r}'.format(qid))
+            if operation == 'domain-set':
+                qids.add(qid)
+            else:
+                qids.discard(qid)
+        elif qid is not None and qid not in qids:
+            raise KeyError(qid)
+
+        name = record.get('name')
+        if _journal_nodes[operation][2] == 'name' \
+                and not isinstance(name, str):
+            raise TypeError('invalid name {!r}'.format(name))
+        if operation == 'feature-set' \
+                and not isinstance(record['value'], (str, type(None))):
+            raise TypeError('invalid value {!r}'.format(record['value']))
+
+        record = dict(record)
+        if record.get('xml') is not None:
+            record['xml'] = lxml.etree.fromstring(record['xml'])
+        elif operation in ('domain-set', 'property-set', 'volume-config'):
+            raise KeyError('xml')
+        return record
+
+    def _journal_apply(self, domains, record):
+        '''Apply single journal record, checked by :py:meth:`_journal_check`,
+        to :py:attr:`xml`'''
+        operation = record['op']
+
+        if operation in ('domain-set', 'domain-del'):
+            node = domains.pop(record['qid'], None)
+            if node is not None:
+                node.getparent().remove(node)
+            if operation == 'domain-set':
+                node = record['xml']
+                self.xml.find('./domains').append(node)
+                domains[record['qid']] = node
+            return
+
+        if record['qid'] is None:
+            parent = self.xml.getroot()
+        else:
+            parent = domains[record['qid']]
+
+        container, tag, attr = _journal_nodes[operation]
+        if container is not None:
+            if parent.find(container) is None:
+                lxml.etree.SubElement(parent, container)
+            parent = parent.find(container)
+        for node in parent.findall(tag):
+            if node.get(attr) == record.get('name'):
+                parent.remove(node)
+
+        if operation == 'feature-set':
+            node = lxml.etree.SubElement(parent, tag, name=record['name'])
+            node.text = record['value']
+        elif operation == 'tag-add':
+            lxml.etree.SubElement(parent, tag, name=record['name'])
+        elif record.get('xml') is not None:
+            parent.append(record['xml'])
+
+    def _journal_records(self):
+        '''Turn changes marked in :py:attr:`_journal_dirty` into records'''
+
+        def tostring(node):
+            return lxml.etree.tostring(node, encoding='unicode')
+
+        records = []
+        nodes = {}
+        dirty = self._journal_dirty
+
+        for qid in {qid for qid, kind, _ in dirty if kind == 'domain'}:
+            if qid in self.domains:
+                records.append({'op': 'domain-set', 'qid': qid,
+                    'xml': tostring(self.domains[qid].__xml__())})
+            else:
+                records.append({'op': 'domain-del', 'qid': qid})
+            nodes[qid] = None
+
+        for qid, kind, name in sorted(dirty, key=lambda item: (
+                item[0] is not None, item[0] or 0, item[1], item[2] or '')):
+            if qid not in nodes:
+                if qid is None:
+                    nodes[qid] = self
+                elif qid in self.domains:
+                    nodes[qid] = self.domains[qid].__xml__()
+                    node = nodes[qid].find('volume-config')
+                    if node is not None:
+                        records.append({'op': 'volume-config', 'qid': qid,
+                            'xml': tostring(node)})
+                else:
+                    nodes[qid] = None
+            node = nodes[qid]
+            if node is None:
+                # whole domain already recorded
+                continue
+
+            if kind == 'property':
+                properties = node.xml_properties() if qid is None \
+                    else node.find('properties')
+                found = [prop for prop in properties
+                    if prop.get('name') == name]
+                if found:
+                    records.append({'op': 'property-set', 'qid': qid,
+                        'name': name, 'xml': tostring(found[0])})
+                else:
+                    records.append({'op': 'property-del', 'qid': qid,
+                        'name': name})
+            elif kind == 'feature':
+                found = [feature for feature in node.find('features')
+                    if feature.get('name') == name]
+                if found:
+                    records.append({'op': 'feature-set', 'qid': qid,
+                        'name': name, 'value': found[0].text})
+                else:
+                    records.append({'op': 'feature-del', 'qid': qid,
+                        'name': name})
+            elif kind == 'tag':
+                found = [tag for tag in node.find('tags')
+                    if tag.get('name') == name]
+                records.append({'op': ('tag-add' if found else 'tag-del'),
+                    'qid': qid, 'name': name})
+            elif kind == 'devices':
+                found = [devices for devices in node.findall('devices')
+                    if devices.get('class') == name]
+                records.append({'op': 'devices', 'qid': qid, 'name': name,
+                    'xml': (tostring(found[0]) if found else None)})
+
+        return records
+
+    def _journal_commit(self):
+        '''Append changes to the journal.
+
+        :return: :py:obj:`False` if the store needs to be written instead
+        :throws EnvironmentError: failure on writing
+        '''
+
+        if not os.path.exists(self._store):
+            return False
+
+        loop = asyncio.get_event_loop()
+        if self.__journal_end > self.journal_max_size \
+                and not loop.is_running():
+            # can't compact in background, so write the store right away
+            return False
+
+        # like save(), lock the store for the time of writing, unless the
+        # caller holds the lock already
+        caller_locked = self.__lock_held
+        if not caller_locked:
+            if self.__locked_fh:
+                # left unlocked by save()
+                self.__locked_fh.close()
+                self.__locked_fh = None
+            self._acquire_lock(for_save=True)
+        try:
+            self._journal_append()
+        finally:
+            if not caller_locked:
+                self._release_lock()
+
+        if self.__journal_end > self.journal_max_size \
+                and self._compact_handle is None and loop.is_running():
+            self._compact_handle = loop.call_soon(self._journal_compact)
+        return True
+
+    def _journal_append(self):
+        records = self._journal_records()
+        if records:
+            entry = json.dumps(records).encode() + b'\n'
+            if self.__journal_base is None:
+                # store was written without journal, start a new one
+                self.__journal_base = self._journal_fingerprint(
+                    os.stat(self._store))
+                self.__journal_end = 0
+                entry = json.dumps({'base': self.__journal_base}).encode() \
+                    + b'\n' + entry
+
+            fd = os.open(self.journal_path, os.O_WRONLY | os.O_CREAT, 0o660)
+            try:
+                # drop incomplete entry left by a crash, if any
+                os.ftruncate(fd, self.__journal_end)
+                os.lseek(fd, self.__journal_end, os.SEEK_SET)
+                os.write(fd, entry)
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            self.__journal_end += len(entry)
+            self.__journal_size = self.__journal_end
+
+        self._journal_dirty.clear()
+
+    def _journal_compact(self):
+        self._compact_handle = None
+        if self.__journal_end <= self.journal_max_size:
+            return
+        try:
+            self.save()
+        except Exception:  # pylint: disable=broad-except
+            self.log.exception('Failed to compact journal into qubes.xml')
+
+    def _journal_reset(self):
+        '''Start over with the journal, after the store was written'''
+
+        self._journal_dirty.clear()
+        if self._compact_handle is not None:
+            self._compact_handle.cancel()
+            self._compact_handle = None
+
+        self.__journal_base = None
+        self.__journal_end = 0
+        self.__journal_size = None
+
+        if not self.journal_enabled:
+            try:
+                os.unlink(self.journal_path)
+            except FileNotFoundError:
+                pass
+            return
+
+        self.__journal_base = self._journal_fingerprint(os.stat(self._store))
+        header = json.dumps({'base': self.__journal_base}).encode() + b'\n'
+        fh_new = tempfile.NamedTemporaryFile(
+            prefix=self.journal_path, delete=False)
+        with fh_new:
+            fh_new.write(header)
+        os.chmod(fh_new.name, 0o660)
+        os.rename(fh_new.name, self.journal_path)
+        self.__journal_end = self.__journal_size = len(header)
+
+    def _journal_mark_domain(self, subject, event, **kwargs):
+        '''Mark changes in domain, to be written to the journal'''
+        if event.startswith(('property-set:', 'property-del:')):
+            key = ('property', event.split(':', 1)[1])
+        elif event in ('domain-feature-set', 'domain-feature-delete'):
+            key = ('feature', kwargs['feature'])
+        elif event in ('domain-tag-add', 'domain-tag-delete'):
+            key = ('tag', kwargs['tag'])
+        elif event.startswith(('device-attach:', 'device-detach:')):
+            key = ('devices', event.split(':', 1)[1])
+        elif event == 'clone-properties':
+            key = ('domain', None)
+        else:
+            return
+        self._journal_dirty.add((subject.qid,) + key)
 
 
     def load_initial_values(self):
@@ -1115,6 +1912,25 @@ class Qubes(qubes.PropertyHolder):
             raise qubes.exc.QubesException('No driver %s for pool %s' %
                                            (driver, name))
 
+    @qubes.events.handler('*')
+    def on_property_change_journal(self, event, **kwargs):
+        '''Mark changes in global properties, to be written to the journal'''
+        # pylint: disable=unused-argument
+        if event.startswith(('property-set:', 'property-del:')):
+            self._journal_dirty.add((None, 'property', event.split(':', 1)[1]))
+
+    @qubes.events.handler('domain-add')
+    def on_domain_add_journal(self, event, vm):
+        # pylint: disable=unused-argument
+        vm.add_handler('*', self._journal_mark_domain)
+        self._journal_dirty.add((vm.qid, 'domain', None))
+
+    @qubes.events.handler('domain-delete')
+    def on_domain_delete_journal(self, event, vm):
+        # pylint: disable=unused-argument
+        vm.remove_handler('*', self._journal_mark_domain)
+        self._journal_dirty.add((vm.qid, 'domain', None))
+
     @qubes.events.handler('domain-pre-delete')
     def on_domain_pre_deleted(self, event, vm):
         # pylint: disable=unused-argument
@@ -1183,6 +1999,15 @@ class Qubes(qubes.PropertyHolder):
                     name='netvm', newvalue=newvalue, oldvalue=oldvalue)
 
 
+    @qubes.events.handler(
+        'property-set:default_netvm', 'property-del:default_netvm',
+        'property-set:default_fw_netvm', 'property-del:default_fw_netvm')
+    def on_property_change_default_netvm_relations(self, event, name,
+            **kwargs):
+        # pylint: disable=unused-argument
+        self.domains.refresh_relations()
+
+
     @qubes.events.handler('property-set:default_netvm')
     def on_property_set_default_netvm(self, event, name, newvalue,
             oldvalue=None):
@@ -93,6 +93,35 @@ defaults = {
     # before killing them (when used qvm-run with --wait option),
     'shutdown_counter_max': 60,
 
+    # how long (in sec) qubesd may postpone writing qubes.xml, to save
+    # changes requested in the meantime at once
+    'save_delay': 0.5,
+
+    # size (in bytes) of qubes.xml.journal, above which qubes.xml is rewritten
+    'journal_max_size': 1024*1024,
+
+    # Admin API calls running at the same time, by lane (see
+    # qubes.api.scheduler): of a single source qube, and of all of them
+    # (None for no limit)
+    'api_source_limits': {'read': 32, 'write': 4},
+    'api_lane_limits': {'read': None, 'write': 16},
+    # Admin API calls of a single source qube waiting in a lane, above which
+    # new calls are refused
+    'api_max_queued': 64,
+
+    # limits of asynchronous handlers of events fired while starting a qube,
+    # so a stuck extension does not hold the start forever: (seconds each
+    # handler may run, how many may run at the same time); see
+    # qubes.events.set_async_limits
+    'async_handler_limits': {
+        'domain-pre-start': (60, 4),
+        'domain-spawn': (60, 4),
+    },
+
+    # event handler calls taking longer (in seconds) are logged, when
+    # profiling is enabled
+    'slow_handler_threshold': 0.1,
+
     'vm_default_netmask': "255.255.255.0",
 
     'appvm_label': 'red',
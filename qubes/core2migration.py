@@ -232,7 +232,9 @@ class Core2Qubes(qubes.Qubes):
             if 'vm' in locals():
                 del self.domains[vm]
 
-    def load(self, lock=False):
+    def load(self, lock=False, lazy=False):
+        # pylint: disable=unused-argument
+        # old format is always converted as a whole, so lazy is ignored
         fh = self._acquire_lock()
 
         try:
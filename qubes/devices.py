@@ -66,6 +66,8 @@ class DeviceAlreadyAttached(qubes.exc.QubesException, KeyError):
 class DeviceAssignment(object): # pylint: disable=too-few-public-methods
     ''' Maps a device to a frontend_domain. '''
 
+    __slots__ = ('backend_domain', 'ident', 'options', 'persistent', 'bus')
+
     def __init__(self, backend_domain, ident, options=None, persistent=False,
             bus=None):
         self.backend_domain = backend_domain
@@ -270,19 +272,23 @@ class DeviceCollection(object):
 
         :param bool persistent: only include devices which are or are not
         attached persistently.
+
+        Persistent assignments are known without asking the VM (and so the
+        hypervisor), so listing only those does not fire
+        ``device-list-attached`` event. This is what :file:`qubes.xml`
+        is saved from.
         '''
 
+        if persistent is True:
+            return set(self._set)
+
         try:
             devices = self._vm.fire_event('device-list-attached:' + self._bus,
                 persistent=persistent)
         except Exception as e:  # pylint: disable=broad-except
             self._vm.log.exception(e, 'Failed to list {} devices'.format(
                 self._bus))
-            if persistent is True:
-                # don't break app.save()
-                return self._set
-            else:
-                raise
+            raise
         result = set()
         for dev, options in devices:
             if dev in self._set and not persistent:
@@ -348,6 +354,12 @@ class DeviceManager(dict):
 class DeviceInfo(object):
     ''' Holds all information about a device '''
     # pylint: disable=too-few-public-methods
+
+    # __dict__ is allocated only when some extra attribute (exposed through
+    # admin.vm.device.*.Available) is set
+    __slots__ = ('backend_domain', 'ident', 'description', 'frontend_domain',
+        '__dict__')
+
     def __init__(self, backend_domain, ident, description=None,
                  frontend_domain=None):
         #: domain providing this device
@@ -399,6 +411,8 @@ class UnknownDevice(DeviceInfo):
     # pylint: disable=too-few-public-methods
     '''Unknown device - for example exposed by domain not running currently'''
 
+    __slots__ = ()
+
     def __init__(self, backend_domain, ident, description=None,
             frontend_domain=None):
         if description is None:
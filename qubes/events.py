@@ -26,8 +26,10 @@ etc.
 '''
 import asyncio
 import collections
+import logging
+import time
 
-import itertools
+import qubes.exc
 
 
 def handler(*events):
@@ -40,6 +42,9 @@ def handler(*events):
     should be set to :py:obj:``True``.
     See appropriate event documentation for details.
 
+    Event ``'*'`` hooks all events, and event like ``'property-set:*'``
+    hooks all events named with that prefix (like ``'property-set:name'``).
+
     .. note::
         For hooking events from extensions, see :py:func:`qubes.ext.handler`.
 
@@ -68,11 +73,215 @@ def ishandler(obj):
         and hasattr(obj, 'ha_events')
 
 
+#: timing statistics of handlers, when enabled with :py:func:`enable_profiling`
+profile = None
+
+
+def handler_name(func):
+    '''Name of a handler, for reporting'''
+    try:
+        return '{}.{}'.format(func.__module__, func.__qualname__)
+    except AttributeError:
+        return repr(func)
+
+
+class HandlerProfile(object):
+    '''Timing statistics of event handlers
+
+    :param float slow_threshold: warn about handler calls taking longer than \
+        this many seconds; :py:obj:`None` to not warn
+    '''
+
+    def __init__(self, slow_threshold=None):
+        self.slow_threshold = slow_threshold
+        #: ``[calls, total time, max time]``, by ``(event, handler name)``
+        self.stats = {}
+        self.log = logging.getLogger('qubes.events')
+
+    def reset(self):
+        '''Forget all collected statistics'''
+        self.stats.clear()
+
+    def record(self, event, func, elapsed):
+        '''Record a call of a handler
+
+        :param str event: event name
+        :param func: handler
+        :param float elapsed: wall time of the call, in seconds
+        '''
+        name = handler_name(func)
+        try:
+            stat = self.stats[event, name]
+        except KeyError:
+            stat = self.stats[event, name] = [0, 0.0, 0.0]
+        stat[0] += 1
+        stat[1] += elapsed
+        stat[2] = max(stat[2], elapsed)
+        if self.slow_threshold is not None and elapsed > self.slow_threshold:
+            self.log.warning('Slow handler %s for event %s: %.3fs',
+                name, event, elapsed)
+
+
+def enable_profiling(slow_threshold=None):
+    '''Start collecting timing statistics of all event handlers
+
+    Statistics collected so far, if any, are discarded.
+
+    :param float slow_threshold: see :py:class:`HandlerProfile`
+    :rtype: HandlerProfile
+    '''
+    global profile  # pylint: disable=global-statement
+    profile = HandlerProfile(slow_threshold)
+    return profile
+
+
+def disable_profiling():
+    '''Stop collecting timing statistics of event handlers'''
+    global profile  # pylint: disable=global-statement
+    profile = None
+
+
+#: limits of asynchronous handlers, by event, see :py:func:`set_async_limits`;
+#: :program:`qubesd` sets them from ``async_handler_limits`` in
+#: :py:data:`qubes.config.defaults`
+async_limits = {}
+
+
+def set_async_limits(event, timeout=None, max_parallel=None):
+    '''Limit asynchronous handlers of an event
+
+    Each handler running longer than *timeout* is cancelled, and
+    :py:meth:`Emitter.fire_event_async` raises
+    :py:class:`qubes.exc.QubesEventHandlerTimeoutError` naming all of them,
+    after the remaining ones finish. Calling without limits removes them.
+
+    :param str event: event name, or ``'*'`` for events without own limits
+    :param float timeout: seconds each handler may run; :py:obj:`None` for \
+        no limit
+    :param int max_parallel: how many handlers may run at the same time; \
+        :py:obj:`None` for no limit
+    '''
+    if timeout is None and max_parallel is None:
+        async_limits.pop(event, None)
+    else:
+        async_limits[event] = (timeout, max_parallel)
+
+
+@asyncio.coroutine
+def _limit_coroutine(func, coro, timeout, semaphore, timed_out):
+    try:
+        if semaphore is not None:
+            yield from semaphore.acquire()
+        try:
+            return (yield from asyncio.wait_for(coro, timeout))
+        except asyncio.TimeoutError:
+            timed_out.append(func)
+            return None
+        finally:
+            if semaphore is not None:
+                semaphore.release()
+    finally:
+        # in case it was cancelled before being started
+        coro.close()
+
+
+@asyncio.coroutine
+def _profile_coroutine(handler_profile, event, func, coro):
+    start = time.perf_counter()
+    try:
+        return (yield from coro)
+    finally:
+        handler_profile.record(event, func, time.perf_counter() - start)
+
+
+#: incremented on each change of class-level handlers, to invalidate
+#: dispatch tables of all classes (changes may affect subclasses)
+_handlers_generation = 0
+
+
+def _handlers_changed():
+    global _handlers_generation  # pylint: disable=global-statement
+    _handlers_generation += 1
+
+
+class _HandlerSet(set):
+    '''Set of class-level handlers of one event, noting its changes'''
+    # pylint: disable=missing-docstring
+
+    def add(self, func):
+        super(_HandlerSet, self).add(func)
+        _handlers_changed()
+
+    def remove(self, func):
+        super(_HandlerSet, self).remove(func)
+        _handlers_changed()
+
+    def discard(self, func):
+        super(_HandlerSet, self).discard(func)
+        _handlers_changed()
+
+    def update(self, *others):
+        super(_HandlerSet, self).update(*others)
+        _handlers_changed()
+
+    def clear(self):
+        super(_HandlerSet, self).clear()
+        _handlers_changed()
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+
+class _HandlerDict(collections.defaultdict):
+    '''Class-level handlers, by event, noting changes'''
+    # pylint: disable=missing-docstring
+
+    def __init__(self):
+        super(_HandlerDict, self).__init__(_HandlerSet)
+
+    def __setitem__(self, event, handlers):
+        if not isinstance(handlers, _HandlerSet):
+            handlers = _HandlerSet(handlers)
+        super(_HandlerDict, self).__setitem__(event, handlers)
+        _handlers_changed()
+
+    def __delitem__(self, event):
+        super(_HandlerDict, self).__delitem__(event)
+        _handlers_changed()
+
+
+def _matching_handlers(handlers_dict, event):
+    '''Handlers from *handlers_dict* hooked to *event*, also through ``'*'``
+    or ``'prefix:*'``'''
+    handlers = handlers_dict.get(event, set())
+    if '*' in handlers_dict:
+        handlers = handlers_dict['*'] | handlers
+    if ':' in event:
+        wildcard = event.split(':', 1)[0] + ':*'
+        if wildcard in handlers_dict:
+            handlers = handlers_dict[wildcard] | handlers
+    return handlers
+
+
+def _order_handlers(handlers):
+    '''Order handlers of one class: those defined in the class itself first,
+    then those from extensions'''
+    return [(func, asyncio.iscoroutinefunction(func))
+        for func in sorted(handlers,
+            key=(lambda handler: hasattr(handler, 'ha_bound')),
+            reverse=True)]
+
+
 class EmitterMeta(type):
     '''Metaclass for :py:class:`Emitter`'''
     def __init__(cls, name, bases, dict_):
         super(EmitterMeta, cls).__init__(name, bases, dict_)
-        cls.__handlers__ = collections.defaultdict(set)
+        cls.__handlers__ = _HandlerDict()
+        #: dispatch tables: ordered handlers of the class and its bases, by
+        #: ``(event, pre_event)``, see :py:meth:`Emitter._class_handlers`
+        cls.__dispatch__ = {}
+        cls.__dispatch_generation__ = _handlers_generation
 
         try:
             propnames = set(prop.__name__ for prop in cls.property_list())
@@ -98,6 +307,11 @@ class Emitter(object, metaclass=EmitterMeta):
 
     By default all events are disabled not to interfere with loading from XML.
     To enable event dispatch, set :py:attr:`events_enabled` to :py:obj:`True`.
+
+    Handlers are ordered once per class, event and *pre_event*, and kept
+    until any class-level handler is added or removed (including through
+    extensions). Instances with their own handlers keep such tables too,
+    dropped also by :py:meth:`add_handler` and :py:meth:`remove_handler`.
     '''
 
     def __init__(self, *args, **kwargs):
@@ -118,6 +332,7 @@ class Emitter(object, metaclass=EmitterMeta):
 
         # pylint: disable=no-member
         self.__handlers__[event].add(func)
+        self.__dict__.pop('__instance_dispatch__', None)
 
     def remove_handler(self, event, func):
         '''Remove event handler from subject's class.
@@ -133,6 +348,66 @@ class Emitter(object, metaclass=EmitterMeta):
 
         # pylint: disable=no-member
         self.__handlers__[event].remove(func)
+        self.__dict__.pop('__instance_dispatch__', None)
+
+    @classmethod
+    def _class_handlers(cls, event, pre_event):
+        '''Ordered handlers of the class and its bases
+
+        :returns: tuple of ``(handler, is_coroutine)`` pairs
+        '''
+
+        if cls.__dispatch_generation__ != _handlers_generation:
+            cls.__dispatch__ = {}
+            cls.__dispatch_generation__ = _handlers_generation
+
+        try:
+            return cls.__dispatch__[event, pre_event]
+        except KeyError:
+            pass
+
+        order = cls.__mro__ if pre_event else reversed(cls.__mro__)
+        handlers = []
+        for class_ in order:
+            # own handlers of the class; object has none
+            handlers_dict = class_.__dict__.get('__handlers__')
+            if not handlers_dict:
+                continue
+            handlers.extend(_order_handlers(
+                _matching_handlers(handlers_dict, event)))
+
+        handlers = tuple(handlers)
+        cls.__dispatch__[event, pre_event] = handlers
+        return handlers
+
+    def _instance_handlers(self, event, pre_event):
+        '''Ordered handlers of the class, its bases and this instance
+
+        :returns: tuple of ``(handler, is_coroutine)`` pairs
+        '''
+
+        dispatch = self.__dict__.get('__instance_dispatch__')
+        if dispatch is None or dispatch[0] != _handlers_generation:
+            dispatch = (_handlers_generation, {})
+            self.__dict__['__instance_dispatch__'] = dispatch
+
+        try:
+            return dispatch[1][event, pre_event]
+        except KeyError:
+            pass
+
+        handlers = self._class_handlers(event, pre_event)
+        handlers_dict = self.__dict__['__handlers__']
+        instance_handlers = _matching_handlers(handlers_dict, event)
+        if instance_handlers:
+            instance_handlers = tuple(_order_handlers(instance_handlers))
+            if pre_event:
+                handlers = instance_handlers + handlers
+            else:
+                handlers = handlers + instance_handlers
+
+        dispatch[1][event, pre_event] = handlers
+        return handlers
 
     def _fire_event(self, event, kwargs, pre_event=False):
         '''Fire event for classes in given order.
@@ -143,28 +418,44 @@ class Emitter(object, metaclass=EmitterMeta):
         if not self.events_enabled:
             return [], []
 
-        order = itertools.chain((self,), self.__class__.__mro__)
-        if not pre_event:
-            order = reversed(list(order))
+        if self.__dict__.get('__handlers__'):
+            handlers = self._instance_handlers(event, pre_event)
+        else:
+            handlers = self._class_handlers(event, pre_event)
+        if not handlers:
+            return [], []
+        if profile is not None:
+            return self._fire_event_profiled(event, kwargs, handlers, profile)
 
         effects = []
         async_effects = []
-        for i in order:
+        for func, is_coroutine in handlers:
+            effect = func(self, event, **kwargs)
+            if is_coroutine:
+                async_effects.append((func, effect))
+            elif effect is not None:
+                effects.extend(effect)
+        return effects, async_effects
+
+    def _fire_event_profiled(self, event, kwargs, handlers, handler_profile):
+        '''Like :py:meth:`_fire_event`, but record handlers' timing'''
+
+        effects = []
+        async_effects = []
+        for func, is_coroutine in handlers:
+            start = time.perf_counter()
             try:
-                handlers_dict = i.__handlers__
-            except AttributeError:
-                continue
-            handlers = handlers_dict.get(event, set())
-            if '*' in handlers_dict:
-                handlers = handlers_dict['*'] | handlers
-            for func in sorted(handlers,
-                    key=(lambda handler: hasattr(handler, 'ha_bound')),
-                    reverse=True):
                 effect = func(self, event, **kwargs)
-                if asyncio.iscoroutinefunction(func):
-                    async_effects.append(effect)
+                if is_coroutine:
+                    async_effects.append((func, _profile_coroutine(
+                        handler_profile, event, func, effect)))
                 elif effect is not None:
+                    # handlers being generators run only now
                     effects.extend(effect)
+            finally:
+                if not is_coroutine:
+                    handler_profile.record(event, func,
+                        time.perf_counter() - start)
         return effects, async_effects
 
     def fire_event(self, event, pre_event=False, **kwargs):
@@ -194,9 +485,11 @@ class Emitter(object, metaclass=EmitterMeta):
         sync_effects, async_effects = self._fire_event(event, kwargs,
             pre_event=pre_event)
         if async_effects:
+            for _, coro in async_effects:
+                coro.close()
             raise RuntimeError(
                 'unexpected async-handler(s) {!r} for sync event {!s}'.format(
-                    async_effects, event))
+                    [handler_name(func) for func, _ in async_effects], event))
         return sync_effects
 
 
@@ -211,7 +504,8 @@ class Emitter(object, metaclass=EmitterMeta):
         from above, remaining order is undefined.
 
         This method call both synchronous and asynchronous handlers. Order of
-        asynchronous calls is, by definition, undefined.
+        asynchronous calls is, by definition, undefined. Their run time and
+        parallelism may be limited, see :py:func:`set_async_limits`.
 
         .. seealso::
             :py:meth:`fire_event`
@@ -219,6 +513,8 @@ class Emitter(object, metaclass=EmitterMeta):
         :param str event: event identifier
         :param pre_event: is this -pre- event? reverse handlers calling order
         :returns: list of effects
+        :raises qubes.exc.QubesEventHandlerTimeoutError: when some handlers \
+            timed out
 
         All *kwargs* are passed verbatim. They are different for different
         events.
@@ -228,9 +524,28 @@ class Emitter(object, metaclass=EmitterMeta):
             kwargs, pre_event=pre_event)
         effects = sync_effects
         if async_effects:
-            async_tasks, _ = yield from asyncio.wait(async_effects)
+            limits = async_limits.get(event, async_limits.get('*'))
+            timed_out = []
+            if limits is None:
+                coros = [coro for _, coro in async_effects]
+            else:
+                timeout, max_parallel = limits
+                semaphore = (asyncio.Semaphore(max_parallel)
+                    if max_parallel else None)
+                coros = [
+                    _limit_coroutine(func, coro, timeout, semaphore, timed_out)
+                    for func, coro in async_effects]
+            async_tasks, _ = yield from asyncio.wait(coros)
             for task in async_tasks:
                 effect = task.result()
                 if effect is not None:
                     effects.extend(effect)
+            if timed_out:
+                names = [handler_name(func) for func in timed_out]
+                for name in names:
+                    logging.getLogger('qubes.events').warning(
+                        'Handler %s for event %s of %s timed out',
+                        name, event, self)
+                raise qubes.exc.QubesEventHandlerTimeoutError(
+                    self, event, names)
         return effects
@@ -171,3 +171,15 @@ class QubesTagNotFoundError(QubesException, KeyError):
             domain, tag))
         self.vm = domain
         self.tag = tag
+
+
+class QubesEventHandlerTimeoutError(QubesException):
+    '''Asynchronous handler(s) of an event did not finish in time'''
+
+    def __init__(self, subject, event, handlers):
+        super().__init__('Handler(s) of event {} of {!s} timed out: {}'.format(
+            event, subject, ', '.join(handlers)))
+        self.subject = subject
+        self.event = event
+        #: names of handlers, which timed out
+        self.handlers = handlers
@@ -35,6 +35,8 @@ import qubes.vm.qubesvm
 
 
 class RuleOption(object):
+    __slots__ = ('_value',)
+
     def __init__(self, untrusted_value):
         # subset of string.punctuation
         safe_set = string.ascii_letters + string.digits + \
@@ -60,6 +62,8 @@ class RuleOption(object):
 # noinspection PyAbstractClass
 class RuleChoice(RuleOption):
     # pylint: disable=abstract-method
+    __slots__ = ('allowed_values',)
+
     def __init__(self, untrusted_value):
         # preliminary validation
         super(RuleChoice, self).__init__(untrusted_value)
@@ -72,6 +76,7 @@ class RuleChoice(RuleOption):
 
 
 class Action(RuleChoice):
+    __slots__ = ()
     accept = 'accept'
     drop = 'drop'
 
@@ -81,6 +86,7 @@ class Action(RuleChoice):
 
 
 class Proto(RuleChoice):
+    __slots__ = ()
     tcp = 'tcp'
     udp = 'udp'
     icmp = 'icmp'
@@ -92,6 +98,8 @@ class Proto(RuleChoice):
 
 class DstHost(RuleOption):
     '''Represent host/network address: either IPv4, IPv6, or DNS name'''
+    __slots__ = ('prefixlen', 'type')
+
     def __init__(self, untrusted_value, prefixlen=None):
         if untrusted_value.count('/') > 1:
             raise ValueError('Too many /: ' + untrusted_value)
@@ -158,6 +166,8 @@ class DstHost(RuleOption):
 
 
 class DstPorts(RuleOption):
+    __slots__ = ('range',)
+
     def __init__(self, untrusted_value):
         if isinstance(untrusted_value, int):
             untrusted_value = str(untrusted_value)
@@ -181,6 +191,8 @@ class DstPorts(RuleOption):
 
 
 class IcmpType(RuleOption):
+    __slots__ = ()
+
     def __init__(self, untrusted_value):
         untrusted_value = int(untrusted_value)
         if untrusted_value < 0 or untrusted_value > 255:
@@ -193,6 +205,7 @@ class IcmpType(RuleOption):
 
 
 class SpecialTarget(RuleChoice):
+    __slots__ = ()
     dns = 'dns'
 
     @property
@@ -201,6 +214,8 @@ class SpecialTarget(RuleChoice):
 
 
 class Expire(RuleOption):
+    __slots__ = ('datetime',)
+
     def __init__(self, untrusted_value):
         super(Expire, self).__init__(untrusted_value)
         self.datetime = datetime.datetime.utcfromtimestamp(int(untrusted_value))
@@ -219,6 +234,8 @@ class Expire(RuleOption):
 
 
 class Comment(RuleOption):
+    __slots__ = ()
+
     # noinspection PyMissingConstructor
     def __init__(self, untrusted_value):
         # pylint: disable=super-init-not-called
@@ -238,7 +255,56 @@ class Comment(RuleOption):
         return 'comment=' + str(self)
 
 
-class Rule(qubes.PropertyHolder):
+def _check_dstports(proto):
+    '''Check if destination ports may be set for the protocol'''
+    if proto not in ('tcp', 'udp'):
+        raise ValueError(
+            'dstports valid only for \'tcp\' and \'udp\' protocols')
+
+
+def _check_icmptype(proto):
+    '''Check if ICMP type may be set for the protocol'''
+    if proto not in ('icmp',):
+        raise ValueError('icmptype valid only for \'icmp\' protocol')
+
+
+class _RuleBase(object):
+    '''Formatting and comparison of :py:class:`Rule` and
+    :py:class:`RuleValue`'''
+    __slots__ = ()
+
+    def _options(self):
+        '''Values of rule options in property order, :py:obj:`None` for
+        those not set'''
+        raise NotImplementedError()
+
+    @property
+    def rule(self):
+        options = [value for value in self._options() if value is not None]
+        if any(isinstance(value, Expire) and value.expired
+                for value in options):
+            return None
+        return ' '.join(value.rule for value in options
+            if value.rule is not None)
+
+    @property
+    def api_rule(self):
+        options = [value for value in self._options() if value is not None]
+        # put comment at the end
+        options.sort(key=(lambda value: isinstance(value, Comment)))
+        return ' '.join(value.api_rule for value in options
+            if value.api_rule is not None)
+
+    def __eq__(self, other):
+        if isinstance(other, _RuleBase):
+            return self.api_rule == other.api_rule
+        return self.api_rule == str(other)
+
+    def __hash__(self):
+        return hash(self.api_rule)
+
+
+class Rule(_RuleBase, qubes.PropertyHolder):
     def __init__(self, xml=None, **kwargs):
         '''Single firewall rule
 
@@ -306,16 +372,13 @@ class Rule(qubes.PropertyHolder):
     @qubes.events.handler('property-pre-set:dstports')
     def on_set_dstports(self, event, name, newvalue, oldvalue=None):
         # pylint: disable=unused-argument
-        if self.proto not in ('tcp', 'udp'):
-            raise ValueError(
-                'dstports valid only for \'tcp\' and \'udp\' protocols')
+        _check_dstports(self.proto)
 
     # noinspection PyUnusedLocal
     @qubes.events.handler('property-pre-set:icmptype')
     def on_set_icmptype(self, event, name, newvalue, oldvalue=None):
         # pylint: disable=unused-argument
-        if self.proto not in ('icmp',):
-            raise ValueError('icmptype valid only for \'icmp\' protocol')
+        _check_icmptype(self.proto)
 
     # noinspection PyUnusedLocal
     @qubes.events.handler('property-set:proto')
@@ -332,33 +395,9 @@ class Rule(qubes.PropertyHolder):
         self.dstports = qubes.property.DEFAULT
         self.icmptype = qubes.property.DEFAULT
 
-    @property
-    def rule(self):
-        if self.expire and self.expire.expired:
-            return None
-        values = []
-        for prop in self.property_list():
-            value = getattr(self, prop.__name__)
-            if value is None:
-                continue
-            if value.rule is None:
-                continue
-            values.append(value.rule)
-        return ' '.join(values)
-
-    @property
-    def api_rule(self):
-        values = []
-        # put comment at the end
-        for prop in sorted(self.property_list(),
-                key=(lambda p: p.__name__ == 'comment')):
-            value = getattr(self, prop.__name__)
-            if value is None:
-                continue
-            if value.api_rule is None:
-                continue
-            values.append(value.api_rule)
-        return ' '.join(values)
+    def _options(self):
+        return [getattr(self, prop.__name__)
+            for prop in self.property_list()]
 
     @classmethod
     def from_xml_v1(cls, node, action):
@@ -437,20 +476,80 @@ class Rule(qubes.PropertyHolder):
 
         return cls(**kwargs)
 
-    def __eq__(self, other):
-        if isinstance(other, Rule):
-            return self.api_rule == other.api_rule
-        return self.api_rule == str(other)
 
-    def __hash__(self):
-        return hash(self.api_rule)
+class RuleValue(_RuleBase):
+    '''Read-only firewall rule, as kept in :py:attr:`Firewall.rules`
+
+    Accepts and validates the same options as :py:class:`Rule`, but is not an
+    event emitter, so is much smaller. Being immutable, it can also be shared
+    between firewalls. Use :py:class:`Rule` to build a rule step by step.
+
+    :param kwargs: rule elements
+    '''
+
+    __slots__ = tuple(prop.__name__ for prop in Rule.property_list())
+
+    def __init__(self, **kwargs):
+        for name in self.__slots__:
+            value = kwargs.pop(name, None)
+            if value is not None:
+                option_type = Rule.property_get_def(name).type
+                if not isinstance(value, option_type):
+                    value = option_type(value)
+            object.__setattr__(self, name, value)
+        if kwargs:
+            raise TypeError('Unknown firewall rule option(s): {}'.format(
+                ', '.join(sorted(kwargs))))
+
+        if self.action is None:
+            raise AssertionError('Required property \'action\' not set')
+        if self.dstports is not None:
+            _check_dstports(self.proto)
+        if self.icmptype is not None:
+            _check_icmptype(self.proto)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('firewall rule is read-only')
+
+    def __delattr__(self, name):
+        raise AttributeError('firewall rule is read-only')
+
+    @classmethod
+    def from_rule(cls, rule):
+        '''Make read-only copy of a rule
+
+        :param rule: :py:class:`Rule` or :py:class:`RuleValue` to copy
+        '''
+        return cls(**{name: getattr(rule, name) for name in cls.__slots__})
+
+    @classmethod
+    def from_xml(cls, xml):
+        '''Load rule from ``<rule>`` element of firewall XML (version 2)'''
+        return cls(**{node.get('name'): node.text
+            for node in xml.xpath('./properties/property')})
+
+    def _options(self):
+        return [getattr(self, name) for name in self.__slots__]
+
+    def xml_properties(self):
+        '''XML element with options of this rule, like
+        :py:meth:`qubes.PropertyHolder.xml_properties`'''
+        properties = lxml.etree.Element('properties')
+        for name in self.__slots__:
+            value = getattr(self, name)
+            if value is None:
+                continue
+            element = lxml.etree.Element('property', name=name)
+            element.text = str(value)
+            properties.append(element)
+        return properties
 
 
 class Firewall(object):
     def __init__(self, vm, load=True):
         assert hasattr(vm, 'firewall_conf')
         self.vm = vm
-        #: firewall rules
+        #: firewall rules, loaded ones are :py:class:`RuleValue` instances
         self.rules = []
 
         if load:
@@ -468,7 +567,7 @@ class Firewall(object):
 
     def load_defaults(self):
         '''Load default firewall settings'''
-        self.rules = [Rule(None, action='accept')]
+        self.rules = [RuleValue(action='accept')]
 
     def clone(self, other):
         '''Clone firewall settings from other instance.
@@ -476,12 +575,8 @@ class Firewall(object):
 
         :param other: other :py:class:`Firewall` instance
         '''
-        rules = []
-        for rule in other.rules:
-            new_rule = Rule()
-            new_rule.clone_properties(rule)
-            rules.append(new_rule)
-        self.rules = rules
+        self.rules = [rule if isinstance(rule, RuleValue)
+            else RuleValue.from_rule(rule) for rule in other.rules]
 
     def load(self):
         '''Load firewall settings from a file'''
@@ -513,11 +608,11 @@ class Firewall(object):
                 return Action.accept
             return Action.drop
 
-        self.rules.append(Rule(None,
+        self.rules.append(RuleValue(
             action=_translate_action('dns'),
             specialtarget=SpecialTarget('dns')))
 
-        self.rules.append(Rule(None,
+        self.rules.append(RuleValue(
             action=_translate_action('icmp'),
             proto=Proto.icmp))
 
@@ -528,15 +623,15 @@ class Firewall(object):
 
         for element in xml_root:
             rule = Rule.from_xml_v1(element, rule_action)
-            self.rules.append(rule)
+            self.rules.append(RuleValue.from_rule(rule))
         if default_policy_is_accept:
-            self.rules.append(Rule(None, action='accept'))
+            self.rules.append(RuleValue(action='accept'))
 
     def load_v2(self, xml_root):
         '''Load new (Qubes >= 4.0) firewall XML format'''
         xml_rules = xml_root.find('rules')
         for xml_rule in xml_rules:
-            rule = Rule(xml_rule)
+            rule = RuleValue.from_xml(xml_rule)
             self.rules.append(rule)
 
     def save(self):
@@ -142,7 +142,8 @@ class SystemState(object):
                 dom_name = self.xs.read('', '/local/domain/%s/name' % str(i))
                 if dom_name is not None:
                     try:
-                        qubes.Qubes().domains[str(dom_name)].fire_event(
+                        app = qubes.Qubes(lazy=True)
+                        app.domains[str(dom_name)].fire_event(
                             'status:no-error', status='no-error',
                             msg=slow_memset_react_msg)
                     except LookupError:
@@ -154,7 +155,8 @@ class SystemState(object):
                 dom_name = self.xs.read('', '/local/domain/%s/name' % str(i))
                 if dom_name is not None:
                     try:
-                        qubes.Qubes().domains[str(dom_name)].fire_event(
+                        app = qubes.Qubes(lazy=True)
+                        app.domains[str(dom_name)].fire_event(
                             'status:no-error', status='no-error',
                             msg=no_progress_msg)
                     except LookupError:
@@ -344,7 +346,7 @@ class SystemState(object):
                                 dom_name = self.xs.read('', '/local/domain/%s/name' % str(dom2))
                                 if dom_name is not None:
                                     try:
-                                        qubes.Qubes().domains[str(
+                                        qubes.Qubes(lazy=True).domains[str(
                                             dom_name)].fire_event(
                                             'status:error', status='error',
                                             msg=no_progress_msg)
@@ -360,7 +362,7 @@ class SystemState(object):
                                 dom_name = self.xs.read('', '/local/domain/%s/name' % str(dom2))
                                 if dom_name is not None:
                                     try:
-                                        qubes.Qubes().domains[str(
+                                        qubes.Qubes(lazy=True).domains[str(
                                             dom_name)].fire_event(
                                             'status:error', status='error',
                                             msg=slow_memset_react_msg)
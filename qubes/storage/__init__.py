@@ -82,6 +82,9 @@ class Volume(object):
     #: for sparse volumes
     usage = 0
 
+    __slots__ = ('name', 'pool', 'revisions_to_keep', 'rw', 'save_on_stop',
+        '_size', 'snap_on_start', 'source', 'vid')
+
     def __init__(self, name, pool, vid,
             revisions_to_keep=0, rw=False, save_on_stop=False, size=0,
             snap_on_start=False, source=None, **kwargs):
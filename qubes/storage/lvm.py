@@ -159,6 +159,7 @@ class ThinVolume(qubes.storage.Volume):
     ''' Default LVM thin volume implementation
     '''  # pylint: disable=too-few-public-methods
 
+    __slots__ = ('volume_group', 'log', '_vid_snap')
 
     def __init__(self, volume_group, size=0, **kwargs):
         self.volume_group = volume_group
@@ -86,6 +86,10 @@ in_dom0 = False
 #: path to root of the directory otherwise
 in_git = False
 
+#: :py:obj:`True` if benchmarks were requested (by setting
+#: :envvar:`QUBES_TEST_BENCHMARK` environment variable)
+run_benchmarks = bool(os.environ.get('QUBES_TEST_BENCHMARK', ''))
+
 try:
     import libvirt
     libvirt.openReadOnly(qubes.config.defaults['libvirt_uri']).close()
@@ -125,6 +129,17 @@ def skipUnlessGit(test_item):
     return unittest.skipUnless(in_git, 'outside git tree')(test_item)
 
 
+def skipUnlessBenchmark(test_item):
+    '''Decorator that skips test unless benchmarks were requested.
+
+    Benchmarks take a long time and their results are only meaningful to
+    a human, so they are run only when :envvar:`QUBES_TEST_BENCHMARK` is set.
+    '''
+
+    return unittest.skipUnless(run_benchmarks, 'benchmarks not requested')(
+        test_item)
+
+
 class TestEmitter(qubes.events.Emitter):
     '''Dummy event emitter which records events fired on it.
 
@@ -977,7 +992,11 @@ def load_tests(loader, tests, pattern): # pylint: disable=unused-argument
             'qubes.tests.tarwriter',
             'qubes.tests.api',
             'qubes.tests.api_admin',
+            'qubes.tests.api_eventbus',
+            'qubes.tests.api_metrics',
+            'qubes.tests.api_scheduler',
             'qubes.tests.api_misc',
+            'qubes.tests.benchmark',
             'qubespolicy.tests',
             ):
         tests.addTests(loader.loadTestsFromName(modname))
@@ -19,15 +19,25 @@
 # with this program; if not, see <http://www.gnu.org/licenses/>.
 
 import asyncio
+import os
+import shutil
 import socket
+import tempfile
 import unittest.mock
 
 import qubes.api
+import qubes.api.metrics
+import qubes.api.scheduler
 import qubes.tests
+import qubes.tools.qubesd_query
 
 
 class TestMgmt(object):
-    def __init__(self, app, src, method, dest, arg, send_event=None):
+    ADMISSION_CONTROL = True
+    permission_time = 0.
+
+    def __init__(self, app, src, method, dest, arg, send_event=None,
+            connection=None):
         self.app = app
         self.src = src
         self.method = method
@@ -45,6 +55,10 @@ class TestMgmt(object):
         except KeyError:
             raise qubes.api.ProtocolError('Invalid method')
 
+    @classmethod
+    def method_table(cls):
+        return {}
+
     def execute(self, untrusted_payload):
         self.task = asyncio.Task(self.function(
             untrusted_payload=untrusted_payload))
@@ -171,3 +185,317 @@ class TC_00_QubesDaemonProtocol(qubes.tests.QubesTestCase):
         with self.assertNotRaises(asyncio.TimeoutError):
             self.loop.run_until_complete(
                 asyncio.wait_for(self.protocol.mgmt.task, 1))
+
+    def call_frame(self, request_id, body):
+        return qubes.api.QubesDaemonProtocol.v2_header.pack(
+            request_id, qubes.api.FRAME_CALL, len(body)) + body
+
+    def read_frame(self):
+        header = qubes.api.QubesDaemonProtocol.v2_header
+        request_id, frame_type, length = header.unpack(
+            self.loop.run_until_complete(asyncio.wait_for(
+                self.reader.readexactly(header.size), 1)))
+        data = self.loop.run_until_complete(asyncio.wait_for(
+            self.reader.readexactly(length), 1))
+        return request_id, frame_type, data
+
+    def read_responses(self, count):
+        responses = {}
+        finished = {}
+        while len(finished) < count:
+            request_id, frame_type, data = self.read_frame()
+            if frame_type == qubes.api.FRAME_DATA:
+                responses[request_id] = responses.get(request_id, b'') + data
+            else:
+                finished[request_id] = frame_type
+        return responses, finished
+
+    def test_010_multiplexed(self):
+        magic = qubes.api.QubesDaemonProtocol.v2_magic
+        self.writer.write(magic)
+        self.writer.write(self.call_frame(1,
+            b'dom0\0mgmt.success\0dom0\0arg\0payload'))
+        self.writer.write(self.call_frame(2,
+            b'dom0\0mgmt.qubesexception\0dom0\0arg\0'))
+        self.writer.write(self.call_frame(3,
+            b'dom0\0mgmt.exception\0dom0\0arg\0'))
+        self.writer.write(self.call_frame(4, b'dom0\0mgmt.success'))
+        with self.assertNotRaises(asyncio.TimeoutError):
+            self.assertEqual(self.loop.run_until_complete(asyncio.wait_for(
+                self.reader.readexactly(len(magic)), 1)), magic)
+            responses, finished = self.read_responses(4)
+        self.assertEqual(responses, {
+            1: b"0\0src: b'dom0', dest: b'dom0', arg: b'arg', "
+               b"payload: b'payload'",
+            2: b"2\0QubesException\0\0qubes-exception\0",
+        })
+        self.assertEqual(finished, {
+            1: qubes.api.FRAME_END,
+            2: qubes.api.FRAME_END,
+            3: qubes.api.FRAME_ABORT,
+            4: qubes.api.FRAME_ABORT,
+        })
+
+        # closing client side closes the connection
+        self.writer.write_eof()
+        with self.assertNotRaises(asyncio.TimeoutError):
+            self.assertEqual(self.loop.run_until_complete(
+                asyncio.wait_for(self.reader.read(), 1)), b'')
+
+    def test_011_multiplexed_cancel(self):
+        magic = qubes.api.QubesDaemonProtocol.v2_magic
+        self.writer.write(magic)
+        self.writer.write(self.call_frame(1,
+            b'dom0\0mgmt.event\0dom0\0arg\0payload'))
+        with self.assertNotRaises(asyncio.TimeoutError):
+            self.loop.run_until_complete(asyncio.wait_for(
+                self.reader.readexactly(len(magic)), 1))
+            self.assertEqual(self.read_frame(), (1, qubes.api.FRAME_DATA,
+                b"1\0subject\0event\0payload\0payload\0\0"))
+        call = self.protocol.calls[1]
+
+        self.writer.write(qubes.api.QubesDaemonProtocol.v2_header.pack(
+            1, qubes.api.FRAME_CANCEL, 0))
+        with self.assertNotRaises(asyncio.TimeoutError):
+            self.loop.run_until_complete(
+                asyncio.wait_for(call.mgmt.task, 1))
+        self.writer.write_eof()
+        with self.assertNotRaises(asyncio.TimeoutError):
+            # no more frames for cancelled call
+            self.assertEqual(self.loop.run_until_complete(
+                asyncio.wait_for(self.reader.read(), 1)), b'')
+        self.assertEqual(self.protocol.calls, {})
+
+    def test_012_multiplexed_invalid(self):
+        self.writer.write(b'\0QubesAPI/9\n')
+        with self.assertNotRaises(asyncio.TimeoutError):
+            self.assertEqual(self.loop.run_until_complete(
+                asyncio.wait_for(self.reader.read(), 1)), b'')
+
+    def test_013_multiplexed_too_long(self):
+        magic = qubes.api.QubesDaemonProtocol.v2_magic
+        self.writer.write(magic)
+        self.writer.write(qubes.api.QubesDaemonProtocol.v2_header.pack(
+            1, qubes.api.FRAME_CALL,
+            qubes.api.QubesDaemonProtocol.buffer_size + 1))
+        with self.assertNotRaises(asyncio.TimeoutError):
+            self.assertEqual(self.loop.run_until_complete(
+                asyncio.wait_for(self.reader.read(), 1)), magic)
+
+    def test_020_flow_control(self):
+        self.assertFalse(self.protocol.writing_paused)
+        self.loop.run_until_complete(self.protocol.drain())
+
+        self.protocol.pause_writing()
+        self.assertTrue(self.protocol.writing_paused)
+        drain = asyncio.ensure_future(self.protocol.drain())
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.assertFalse(drain.done())
+
+        self.protocol.resume_writing()
+        self.assertFalse(self.protocol.writing_paused)
+        with self.assertNotRaises(asyncio.TimeoutError):
+            self.loop.run_until_complete(asyncio.wait_for(drain, 1))
+
+
+    def test_030_metrics(self):
+        self.writer.write(b'dom0\0mgmt.success\0dom0\0arg\0payload')
+        self.writer.write_eof()
+        with self.assertNotRaises(asyncio.TimeoutError):
+            self.loop.run_until_complete(
+                asyncio.wait_for(self.reader.read(), 1))
+        metrics = qubes.api.metrics.APIMetrics.get(self.app)
+        self.assertEqual(metrics.calls, {('mgmt.success', 'dom0', 'ok'): 1})
+        self.assertEqual(metrics.in_flight, {'mgmt.success': 0})
+        self.assertEqual(sorted(metrics.latency), [
+            ('mgmt.success', 'handler'),
+            ('mgmt.success', 'permission'),
+            ('mgmt.success', 'queue'),
+            ('mgmt.success', 'write'),
+        ])
+
+    def test_031_metrics_unknown_method(self):
+        self.writer.write(b'dom0\0mgmt.no-such-method\0dom0\0arg\0')
+        self.writer.write_eof()
+        with self.assertNotRaises(asyncio.TimeoutError):
+            self.loop.run_until_complete(
+                asyncio.wait_for(self.reader.read(), 1))
+        metrics = qubes.api.metrics.APIMetrics.get(self.app)
+        self.assertEqual(metrics.calls,
+            {('unknown', 'unknown', 'protocol_error'): 1})
+        self.assertEqual(metrics.latency, {})
+
+
+    def test_032_admission(self):
+        scheduler = qubes.api.scheduler.CallScheduler.get(self.app)
+        scheduler.source_limits = {'read': 1, 'write': 1}
+        self.loop.run_until_complete(scheduler.acquire('test-vm', 'write'))
+        self.writer.write(b'test-vm\0mgmt.success\0dom0\0arg\0')
+        self.writer.write_eof()
+        self.loop.run_until_complete(asyncio.sleep(0.01))
+        self.assertIsNone(self.protocol.mgmt)
+        self.assertEqual(scheduler.metrics.queued['write'], 1)
+
+        scheduler.release('test-vm', 'write')
+        with self.assertNotRaises(asyncio.TimeoutError):
+            response = self.loop.run_until_complete(
+                asyncio.wait_for(self.reader.read(), 1))
+        self.assertTrue(response.startswith(b'0\0'))
+        self.assertEqual(scheduler.running['write'], 0)
+        self.assertEqual(scheduler.metrics.queued['write'], 0)
+
+    def test_033_admission_connection_lost(self):
+        scheduler = qubes.api.scheduler.CallScheduler.get(self.app)
+        scheduler.source_limits = {'read': 1, 'write': 1}
+        self.loop.run_until_complete(scheduler.acquire('test-vm', 'write'))
+        self.writer.write(b'test-vm\0mgmt.success\0dom0\0arg\0')
+        self.writer.write_eof()
+        self.loop.run_until_complete(asyncio.sleep(0.01))
+        self.protocol.connection_lost(None)
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.assertEqual(scheduler.metrics.queued['write'], 0)
+        scheduler.release('test-vm', 'write')
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.assertIsNone(self.protocol.mgmt)
+        self.assertEqual(scheduler.running['write'], 0)
+
+    def test_034_no_admission_control(self):
+        class TestMgmtNoAdmission(TestMgmt):
+            ADMISSION_CONTROL = False
+        self.protocol.handler = TestMgmtNoAdmission
+        scheduler = qubes.api.scheduler.CallScheduler.get(self.app)
+        scheduler.source_limits = {'read': 1, 'write': 1}
+        self.loop.run_until_complete(scheduler.acquire('test-vm', 'write'))
+        self.writer.write(b'test-vm\0mgmt.success\0dom0\0arg\0')
+        self.writer.write_eof()
+        with self.assertNotRaises(asyncio.TimeoutError):
+            response = self.loop.run_until_complete(
+                asyncio.wait_for(self.reader.read(), 1))
+        self.assertTrue(response.startswith(b'0\0'))
+        self.assertEqual(scheduler.metrics.queued['write'], 0)
+        scheduler.release('test-vm', 'write')
+
+
+class TC_01_QubesdConnection(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super(TC_01_QubesdConnection, self).setUp()
+        self.app = unittest.mock.Mock()
+        self.app.log = self.log
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.tmpdir = tempfile.mkdtemp()
+        self.sock_path = os.path.join(self.tmpdir, 'qubesd.sock')
+        self.server = self.loop.run_until_complete(
+            self.loop.create_unix_server(
+                lambda: qubes.api.QubesDaemonProtocol(TestMgmt, app=self.app),
+                self.sock_path))
+
+    def tearDown(self):
+        self.server.close()
+        self.loop.run_until_complete(self.server.wait_closed())
+        self.loop.stop()
+        self.loop.run_forever()
+        self.loop.close()
+        shutil.rmtree(self.tmpdir)
+        super(TC_01_QubesdConnection, self).tearDown()
+
+    def test_000_call(self):
+        conn = self.loop.run_until_complete(
+            qubes.tools.qubesd_query.QubesdConnection.connect(self.sock_path))
+        calls = [
+            conn.call('dom0', 'mgmt.success', 'dom0', str(i), b'payload')
+            for i in range(10)]
+        calls.append(conn.call('dom0', 'mgmt.exception', 'dom0'))
+        with self.assertNotRaises(asyncio.TimeoutError):
+            responses = self.loop.run_until_complete(
+                asyncio.wait_for(asyncio.gather(*calls), 1))
+        self.assertEqual(responses[:10], [
+            "0\0src: b'dom0', dest: b'dom0', arg: b'{}', payload: b'payload'"
+            .format(i).encode() for i in range(10)])
+        self.assertEqual(responses[10], b'')
+        self.loop.run_until_complete(conn.close())
+
+    def test_001_cancel(self):
+        conn = self.loop.run_until_complete(
+            qubes.tools.qubesd_query.QubesdConnection.connect(self.sock_path))
+        call = asyncio.ensure_future(
+            conn.call('dom0', 'mgmt.event', 'dom0', '', b'payload'))
+        self.loop.run_until_complete(asyncio.sleep(0.05))
+        call.cancel()
+        # the connection is still usable
+        with self.assertNotRaises(asyncio.TimeoutError):
+            self.assertEqual(self.loop.run_until_complete(asyncio.wait_for(
+                conn.call('dom0', 'mgmt.success_none', 'dom0'), 1)),
+                b'0\0')
+        self.assertTrue(call.cancelled())
+        self.loop.run_until_complete(conn.close())
+
+    def test_002_v1_server(self):
+        self.server.close()
+        self.loop.run_until_complete(self.server.wait_closed())
+        os.unlink(self.sock_path)
+
+        @asyncio.coroutine
+        def v1_only(reader, writer):
+            yield from reader.read()
+            writer.close()
+        self.server = self.loop.run_until_complete(
+            asyncio.start_unix_server(v1_only, self.sock_path))
+        with self.assertRaises(ConnectionError):
+            self.loop.run_until_complete(
+                qubes.tools.qubesd_query.QubesdConnection.connect(
+                    self.sock_path, timeout=0.1))
+
+
+class TestAPI(qubes.api.AbstractQubesAPI):
+    @qubes.api.method('test.Simple', no_payload=True)
+    @asyncio.coroutine
+    def simple(self):
+        return 'simple'
+
+    @qubes.api.method('test.{endpoint}.Get', endpoints=('one', 'two'),
+        no_payload=True)
+    @asyncio.coroutine
+    def with_endpoint(self, endpoint):
+        return endpoint
+
+
+class TestAPIChild(TestAPI):
+    @qubes.api.method('test.Child', no_payload=True)
+    @asyncio.coroutine
+    def child(self):
+        return 'child'
+
+
+class TC_10_AbstractQubesAPI(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.app = unittest.mock.Mock()
+        self.app.domains = {'dom0': unittest.mock.sentinel.dom0}
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.addCleanup(self.loop.close)
+
+    def call(self, cls, method):
+        mgmt = cls(self.app, b'dom0', method, b'dom0', b'')
+        return self.loop.run_until_complete(
+            mgmt.execute(untrusted_payload=b''))
+
+    def test_000_method_table(self):
+        self.assertEqual(TestAPI.method_table(), {
+            'test.Simple': (TestAPI.simple, None),
+            'test.one.Get': (TestAPI.with_endpoint, 'one'),
+            'test.two.Get': (TestAPI.with_endpoint, 'two'),
+        })
+        self.assertEqual(set(TestAPIChild.method_table()),
+            {'test.Simple', 'test.one.Get', 'test.two.Get', 'test.Child'})
+        self.assertNotIn('test.Child', TestAPI.method_table())
+
+    def test_001_dispatch(self):
+        self.assertEqual(self.call(TestAPI, b'test.Simple'), 'simple')
+        self.assertEqual(self.call(TestAPI, b'test.two.Get'), 'two')
+        self.assertEqual(self.call(TestAPIChild, b'test.Child'), 'child')
+        with self.assertRaises(qubes.api.ProtocolError):
+            self.call(TestAPI, b'test.Child')
+        with self.assertRaises(qubes.api.ProtocolError):
+            self.call(TestAPI, b'test.three.Get')
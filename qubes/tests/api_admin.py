@@ -30,9 +30,13 @@ import libvirt
 
 import qubes
 import qubes.devices
+import qubes.events
 import qubes.firewall
 import qubes.api.admin
+import qubes.api.eventbus
+import qubes.api.metrics
 import qubes.tests
+import qubes.tests.api_eventbus
 import qubes.storage
 
 # properties defined in API
@@ -146,6 +150,43 @@ class TC_00_VMs(AdminAPITestCase):
             b'netvm')
         self.assertEqual(value, 'default=True type=vm ')
 
+    def test_026_vm_property_getall(self):
+        value = self.call_mgmt_func(b'admin.vm.property.GetAll', b'test-vm1')
+        expected = ''
+        for prop in self.vm.property_list():
+            expected += 'test-vm1 {} {}\n'.format(prop.__name__,
+                self.call_mgmt_func(b'admin.vm.property.Get', b'test-vm1',
+                    prop.__name__.encode()))
+        self.assertEqual(value, expected)
+        self.assertFalse(self.app.save.called)
+
+    def test_027_vm_property_getall_all(self):
+        value = self.call_mgmt_func(b'admin.vm.property.GetAll', b'dom0')
+        lines = value.splitlines()
+        for vm in self.app.domains:
+            self.assertEqual(
+                len([line for line in lines
+                    if line.startswith(vm.name + ' ')]),
+                len(list(vm.property_list())))
+        self.assertIn('test-vm1 label default=False type=label red', lines)
+        self.assertIn('dom0 label default=False type=label black', lines)
+        self.assertIn('test-template updateable default=True '
+            'type=bool True', lines)
+
+    def test_028_vm_property_getall_filter(self):
+        fire_event = self.emitter.fire_event
+
+        def filtering_fire_event(event, **kwargs):
+            fire_event(event, **kwargs)
+            return [lambda entry: entry[0].name != 'test-template',
+                lambda entry: entry[1] == 'label']
+        self.app.domains[0].fire_event = filtering_fire_event
+
+        value = self.call_mgmt_func(b'admin.vm.property.GetAll', b'dom0')
+        self.assertEqual(value,
+            'dom0 label default=False type=label black\n'
+            'test-vm1 label default=False type=label red\n')
+
     def test_030_vm_property_set_vm(self):
         netvm = self.app.add_new_vm('AppVM', label='red', name='test-net',
             template='test-template', provides_network=True)
@@ -273,6 +314,79 @@ class TC_00_VMs(AdminAPITestCase):
             self.assertFalse(mock.called)
         self.assertFalse(self.app.save.called)
 
+    def test_045_vm_property_setmany(self):
+        with unittest.mock.patch.object(self.vm, 'fire_event',
+                wraps=self.vm.fire_event) as mock_fire_event:
+            value = self.call_mgmt_func(b'admin.vm.property.SetMany',
+                b'test-vm1', b'',
+                b'include_in_backups False\nvcpus 2\n'
+                b'kernelopts a\\\\b\\nc\nnetvm \n')
+        self.assertIsNone(value)
+        self.assertFalse(self.vm.include_in_backups)
+        self.assertEqual(self.vm.vcpus, 2)
+        self.assertEqual(self.vm.kernelopts, 'a\\b\nc')
+        self.assertIsNone(self.vm.netvm)
+        self.assertFalse(self.vm.property_is_default('netvm'))
+        self.assertEqual(
+            [call[1][0] for call in mock_fire_event.mock_calls
+                if call[1][0].startswith('property-set:')],
+            ['property-set:include_in_backups', 'property-set:vcpus',
+                'property-set:kernelopts', 'property-set:netvm'])
+        self.app.save.assert_called_once_with()
+
+    def test_046_vm_property_setmany_invalid(self):
+        with self.assertRaises(qubes.exc.QubesValueError):
+            self.call_mgmt_func(b'admin.vm.property.SetMany', b'test-vm1',
+                b'', b'vcpus 2\nautostart maybe\n')
+        self.assertTrue(self.vm.property_is_default('vcpus'))
+        with self.assertRaises(qubes.exc.QubesValueError):
+            self.call_mgmt_func(b'admin.vm.property.SetMany', b'test-vm1',
+                b'', b'vcpus 2\nkernelopts a\\tb\n')
+        self.assertTrue(self.vm.property_is_default('vcpus'))
+        with self.assertRaises(qubes.exc.QubesValueError):
+            self.call_mgmt_func(b'admin.vm.property.SetMany', b'test-vm1',
+                b'', b'vcpus 2\nvcpus 3\n')
+        self.assertTrue(self.vm.property_is_default('vcpus'))
+        with self.assertRaises(qubes.exc.QubesNoSuchPropertyError):
+            self.call_mgmt_func(b'admin.vm.property.SetMany', b'test-vm1',
+                b'', b'vcpus 2\nno_such_property 1\n')
+        self.assertTrue(self.vm.property_is_default('vcpus'))
+        self.assertFalse(self.app.save.called)
+
+    def test_047_vm_property_setmany_rollback(self):
+        self.vm.memory = 500
+        with self.assertRaises(KeyError):
+            self.call_mgmt_func(b'admin.vm.property.SetMany', b'test-vm1',
+                b'', b'vcpus 2\nmemory 600\nlabel no-such-label\n')
+        self.assertTrue(self.vm.property_is_default('vcpus'))
+        self.assertEqual(self.vm.memory, 500)
+        self.assertEqual(self.vm.label, self.app.labels[1])
+        self.assertFalse(self.app.save.called)
+
+    def test_048_vm_property_setmany_permission(self):
+        self.call_mgmt_func(b'admin.vm.property.SetMany', b'test-vm1',
+            b'', b'vcpus 2\nmemory 600\n')
+        self.assertEventFired(self.emitter,
+            'mgmt-permission:admin.vm.property.Set',
+            kwargs={'arg': 'vcpus', 'newvalue': 2})
+        self.assertEventFired(self.emitter,
+            'mgmt-permission:admin.vm.property.Set',
+            kwargs={'arg': 'memory', 'newvalue': 600})
+        self.app.save.reset_mock()
+
+        def fire_event(event, **kwargs):
+            if event == 'mgmt-permission:admin.vm.property.Set' \
+                    and kwargs['arg'] == 'memory':
+                raise qubes.api.PermissionDenied()
+            return self.emitter.fire_event(event, **kwargs)
+        self.app.domains[0].fire_event = fire_event
+        with self.assertRaises(qubes.api.PermissionDenied):
+            self.call_mgmt_func(b'admin.vm.property.SetMany', b'test-vm1',
+                b'', b'vcpus 3\nmemory 700\n')
+        self.assertEqual(self.vm.vcpus, 2)
+        self.assertEqual(self.vm.memory, 600)
+        self.assertFalse(self.app.save.called)
+
     def test_050_vm_property_help(self):
         value = self.call_mgmt_func(b'admin.vm.property.Help', b'test-vm1',
             b'label')
@@ -941,12 +1055,183 @@ class TC_00_VMs(AdminAPITestCase):
                 unittest.mock.call(vm2, 'test-event2', arg1='abc'),
             ])
 
+    def test_274_events_resume(self):
+        def call_events(arg, fire_event):
+            connection = qubes.tests.api_eventbus.Connection()
+            mgmt_obj = qubes.api.admin.QubesAdminAPI(self.app, b'dom0',
+                b'admin.Events', b'dom0', arg, connection=connection)
+
+            @asyncio.coroutine
+            def fire_and_cancel():
+                fire_event()
+                mgmt_obj.cancel()
+
+            loop = asyncio.get_event_loop()
+            execute_task = asyncio.ensure_future(
+                mgmt_obj.execute(untrusted_payload=b''))
+            asyncio.ensure_future(fire_and_cancel())
+            loop.run_until_complete(execute_task)
+            return connection.sent
+
+        sent = call_events(b'0.0',
+            lambda: self.vm.fire_event('test-event', arg1='a'))
+        epoch = qubes.api.eventbus.EventBus.get(self.app).epoch
+        self.assertEqual(sent, [
+            '1\x000\x00\x00connection-established\x00epoch\x00{}\x00'
+            'resumed\x00False\x00\x00'.format(epoch).encode(),
+            b'1\x001\x00test-vm1\x00test-event\x00arg1\x00a\x00\x00',
+        ])
+
+        # missed while disconnected
+        self.vm.fire_event('test-event', arg1='b')
+
+        sent = call_events('{}.1'.format(epoch).encode(),
+            lambda: self.vm.fire_event('test-event', arg1='c'))
+        self.assertEqual(sent, [
+            '1\x001\x00\x00connection-established\x00epoch\x00{}\x00'
+            'resumed\x00True\x00\x00'.format(epoch).encode(),
+            b'1\x002\x00test-vm1\x00test-event\x00arg1\x00b\x00\x00',
+            b'1\x003\x00test-vm1\x00test-event\x00arg1\x00c\x00\x00',
+        ])
+
+        # different epoch, events cannot be replayed
+        sent = call_events(b'0.1', lambda: None)
+        self.assertEqual(sent, [
+            '1\x003\x00\x00connection-established\x00epoch\x00{}\x00'
+            'resumed\x00False\x00\x00'.format(epoch).encode(),
+        ])
+
+    def test_275_events_invalid_arg(self):
+        for arg in (b'abc', b'coalesce-abc', b'nopre+nopre', b'0.0+1.1',
+                b'overflow-abc', b'overflow-drop+overflow-drop'):
+            with self.subTest(arg):
+                with self.assertRaises(AssertionError):
+                    self.call_mgmt_func(b'admin.Events', b'dom0', arg)
+        self.assertFalse(self.emitter.fired_events)
+
+    def test_276_events_coalesce(self):
+        send_event = unittest.mock.Mock(spec=[])
+        mgmt_obj = qubes.api.admin.QubesAdminAPI(self.app, b'dom0',
+            b'admin.Events', b'dom0', b'coalesce-10+nopre',
+            send_event=send_event)
+
+        @asyncio.coroutine
+        def fire_event():
+            for value in ('1', '2', '3'):
+                self.vm.fire_event('property-pre-set:kernelopts',
+                    pre_event=True, name='kernelopts', newvalue=value)
+                self.vm.fire_event('property-set:kernelopts',
+                    name='kernelopts', newvalue=value)
+            self.vm.fire_event('domain-feature-set', feature='a', value='1')
+            yield from asyncio.sleep(0.05)
+            mgmt_obj.cancel()
+
+        loop = asyncio.get_event_loop()
+        execute_task = asyncio.ensure_future(
+            mgmt_obj.execute(untrusted_payload=b''))
+        asyncio.ensure_future(fire_event())
+        loop.run_until_complete(execute_task)
+        self.assertEqual(send_event.mock_calls, [
+            unittest.mock.call(self.app, 'connection-established'),
+            unittest.mock.call(self.vm, 'property-set:kernelopts',
+                name='kernelopts', newvalue='3'),
+            unittest.mock.call(self.vm, 'domain-feature-set',
+                feature='a', value='1'),
+        ])
+
+    def test_279_events_overflow(self):
+        send_event = unittest.mock.Mock(spec=[])
+        bus = qubes.api.eventbus.EventBus.get(self.app)
+        subscribers = []
+        for arg in (b'', b'overflow-drop'):
+            mgmt_obj = qubes.api.admin.QubesAdminAPI(self.app, b'dom0',
+                b'admin.Events', b'dom0', arg, send_event=send_event)
+
+            @asyncio.coroutine
+            def fire_event():
+                subscribers.extend(bus.subscribers)
+                mgmt_obj.cancel()
+
+            execute_task = asyncio.ensure_future(
+                mgmt_obj.execute(untrusted_payload=b''))
+            asyncio.ensure_future(fire_event())
+            self.loop.run_until_complete(execute_task)
+        self.assertEqual([subscriber.overflow for subscriber in subscribers],
+            ['disconnect', 'drop'])
+        self.assertEqual(subscribers[0].source, 'dom0')
+
+    def test_277_api_stats(self):
+        metrics = qubes.api.metrics.APIMetrics.get(self.app)
+        metrics.call_started('admin.vm.List')
+        metrics.call_finished('admin.vm.List', 'dom0', 'ok',
+            {'handler': 0.001})
+        bus = qubes.api.eventbus.EventBus.get(self.app)
+        subscriber = bus.subscribe(unittest.mock.Mock(spec=[]),
+            source='test-vm1')
+        self.addCleanup(bus.unsubscribe, subscriber)
+        value = self.call_mgmt_func(b'admin.api.Stats', b'dom0')
+        self.assertEqual(value, metrics.render(bus.stats()))
+        self.assertIn('qubesd_api_calls_total{method="admin.vm.List",'
+            'result="ok",source="dom0"} 1\n', value)
+        self.assertIn('qubesd_events_lag_seconds{{source="test-vm1",'
+            'subscriber="{}"}} 0.0\n'.format(subscriber.ident), value)
+
+    def test_278_api_stats_dom0_only(self):
+        with self.assertRaises(AssertionError):
+            self.call_mgmt_func(b'admin.api.Stats', b'test-vm1')
+        self.assertFalse(self.emitter.fired_events)
+
+    def test_272_events_profile(self):
+        handler_profile = qubes.events.enable_profiling()
+        self.addCleanup(qubes.events.disable_profiling)
+        handler_profile.stats[('domain-start', 'test.on_start')] = \
+            [2, 0.5, 0.3]
+        handler_profile.stats[('domain-stop', 'test.on_stop')] = \
+            [1, 1.0, 1.0]
+        value = self.call_mgmt_func(b'admin.events.Profile', b'dom0')
+        self.assertEqual(value,
+            'domain-stop test.on_stop calls=1 total=1.000000 max=1.000000\n'
+            'domain-start test.on_start calls=2 total=0.500000 '
+            'max=0.300000\n')
+
+    def test_273_events_profile_reset(self):
+        handler_profile = qubes.events.enable_profiling()
+        self.addCleanup(qubes.events.disable_profiling)
+        handler_profile.stats[('domain-start', 'test.on_start')] = \
+            [2, 0.5, 0.3]
+        value = self.call_mgmt_func(b'admin.events.ProfileReset', b'dom0')
+        self.assertIsNone(value)
+        self.assertEqual(handler_profile.stats, {})
+        self.assertEqual(
+            self.call_mgmt_func(b'admin.events.Profile', b'dom0'), '')
+
+    def test_274_events_profile_disabled(self):
+        with self.assertRaises(qubes.exc.QubesException):
+            self.call_mgmt_func(b'admin.events.Profile', b'dom0')
+        with self.assertRaises(qubes.exc.QubesException):
+            self.call_mgmt_func(b'admin.events.ProfileReset', b'dom0')
+
     def test_280_feature_list(self):
         self.vm.features['test-feature'] = 'some-value'
         value = self.call_mgmt_func(b'admin.vm.feature.List', b'test-vm1')
         self.assertEqual(value, 'test-feature\n')
         self.assertFalse(self.app.save.called)
 
+    def test_281_feature_getall(self):
+        self.vm.features['test-feature'] = 'some-value'
+        self.vm.features['multiline'] = 'line1\nline2 \\n'
+        self.template.features['other-feature'] = ''
+        value = self.call_mgmt_func(b'admin.vm.feature.GetAll', b'dom0')
+        self.assertEqual(value,
+            'test-template other-feature \n'
+            'test-vm1 multiline line1\\nline2 \\\\n\n'
+            'test-vm1 test-feature some-value\n')
+        value = self.call_mgmt_func(b'admin.vm.feature.GetAll', b'test-vm1')
+        self.assertEqual(value,
+            'test-vm1 multiline line1\\nline2 \\\\n\n'
+            'test-vm1 test-feature some-value\n')
+        self.assertFalse(self.app.save.called)
+
     def test_290_feature_get(self):
         self.vm.features['test-feature'] = 'some-value'
         value = self.call_mgmt_func(b'admin.vm.feature.Get', b'test-vm1',
@@ -1650,6 +1935,24 @@ class TC_00_VMs(AdminAPITestCase):
         self.assertEqual(value, 'tag1\ntag2\n')
         self.assertFalse(self.app.save.called)
 
+    def test_531_tag_listall(self):
+        self.vm.tags.add('tag1')
+        self.vm.tags.add('tag2')
+        self.template.tags.add('tag3')
+        value = self.call_mgmt_func(b'admin.vm.tag.ListAll', b'dom0')
+        self.assertEqual(value,
+            ''.join('dom0 {}\n'.format(tag)
+                for tag in sorted(self.app.domains[0].tags)) +
+            ''.join('test-template {}\n'.format(tag)
+                for tag in sorted(self.template.tags)) +
+            ''.join('test-vm1 {}\n'.format(tag)
+                for tag in sorted(self.vm.tags)))
+        self.assertIn('test-vm1 tag1\ntest-vm1 tag2\n', value)
+        self.assertIn('test-template tag3\n', value)
+        value = self.call_mgmt_func(b'admin.vm.tag.ListAll', b'test-vm1')
+        self.assertNotIn('tag3', value)
+        self.assertFalse(self.app.save.called)
+
     def test_540_tag_get(self):
         self.vm.tags.add('tag1')
         value = self.call_mgmt_func(b'admin.vm.tag.Get', b'test-vm1',
@@ -1822,11 +2125,14 @@ class TC_00_VMs(AdminAPITestCase):
             b'admin.vm.property.Help',
             b'admin.vm.property.HelpRst',
             b'admin.vm.property.Reset',
+            b'admin.vm.property.GetAll',
             b'admin.vm.feature.List',
             b'admin.vm.feature.Get',
+            b'admin.vm.feature.GetAll',
             b'admin.vm.feature.CheckWithTemplate',
             b'admin.vm.feature.Remove',
             b'admin.vm.tag.List',
+            b'admin.vm.tag.ListAll',
             b'admin.vm.tag.Get',
             b'admin.vm.tag.Remove',
             b'admin.vm.tag.Set',
@@ -1881,8 +2187,12 @@ class TC_00_VMs(AdminAPITestCase):
             b'admin.vm.Clone',
             b'admin.vm.Remove',
             b'admin.vm.property.List',
+            b'admin.vm.property.GetAll',
+            b'admin.vm.property.SetMany',
             b'admin.vm.feature.List',
+            b'admin.vm.feature.GetAll',
             b'admin.vm.tag.List',
+            b'admin.vm.tag.ListAll',
             b'admin.vm.firewall.Get',
             b'admin.vm.firewall.Set',
             b'admin.vm.firewall.Reload',
@@ -1924,6 +2234,9 @@ class TC_00_VMs(AdminAPITestCase):
         methods_with_no_payload = [
             b'admin.vmclass.List',
             b'admin.vm.List',
+            b'admin.vm.property.GetAll',
+            b'admin.vm.feature.GetAll',
+            b'admin.vm.tag.ListAll',
             b'admin.label.List',
             b'admin.label.Get',
             b'admin.label.Remove',
@@ -1938,6 +2251,9 @@ class TC_00_VMs(AdminAPITestCase):
             b'admin.pool.Remove',
             b'admin.backup.Execute',
             b'admin.Events',
+            b'admin.events.Profile',
+            b'admin.events.ProfileReset',
+            b'admin.api.Stats',
         ]
         # make sure also no methods on actual VM gets called
         vm_mock = unittest.mock.MagicMock()
@@ -1965,11 +2281,17 @@ class TC_00_VMs(AdminAPITestCase):
         methods_with_no_argument = [
             b'admin.vmclass.List',
             b'admin.vm.List',
+            b'admin.vm.property.GetAll',
+            b'admin.vm.feature.GetAll',
+            b'admin.vm.tag.ListAll',
             b'admin.label.List',
             b'admin.property.List',
             b'admin.pool.List',
             b'admin.pool.ListDrivers',
             b'admin.Events',
+            b'admin.events.Profile',
+            b'admin.events.ProfileReset',
+            b'admin.api.Stats',
         ]
         # make sure also no methods on actual VM gets called
         vm_mock = unittest.mock.MagicMock()
@@ -2025,6 +2347,9 @@ class TC_00_VMs(AdminAPITestCase):
             b'admin.backup.Execute',
             b'admin.backup.Info',
             b'admin.backup.Restore',
+            b'admin.events.Profile',
+            b'admin.events.ProfileReset',
+            b'admin.api.Stats',
         ]
         # make sure also no methods on actual VM gets called
         vm_mock = unittest.mock.MagicMock()
@@ -2073,6 +2398,7 @@ class TC_00_VMs(AdminAPITestCase):
             b'admin.vm.property.List',
             b'admin.vm.property.Get',
             b'admin.vm.property.Set',
+            b'admin.vm.property.SetMany',
             b'admin.vm.property.Help',
             b'admin.vm.property.HelpRst',
             b'admin.vm.property.Reset',
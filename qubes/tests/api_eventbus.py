@@ -0,0 +1,447 @@
+# -*- encoding: utf8 -*-
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import gc
+import unittest.mock
+import weakref
+
+import qubes.api.eventbus
+import qubes.tests
+
+
+class Connection(object):
+    def __init__(self):
+        self.writing_paused = False
+        self.resumed = asyncio.Event()
+        self.sent = []
+
+    def send_serialized_event(self, data):
+        self.sent.append(data)
+
+    def pause(self):
+        self.writing_paused = True
+        self.resumed.clear()
+
+    def resume(self):
+        self.writing_paused = False
+        self.resumed.set()
+
+    @asyncio.coroutine
+    def drain(self):
+        while self.writing_paused:
+            yield from self.resumed.wait()
+
+
+class Subject(object):
+    def __init__(self, name):
+        self.name = name
+
+
+class TC_00_Subscriber(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super(TC_00_Subscriber, self).setUp()
+        self.tasks = []
+        self.send_event = unittest.mock.Mock(spec=[])
+        self.connection = Connection()
+        self.vm = Subject('test-vm')
+
+    def subscribe(self, **kwargs):
+        subscriber = qubes.api.eventbus.Subscriber(self.send_event,
+            connection=self.connection, **kwargs)
+        self.tasks.append(asyncio.ensure_future(subscriber.run()))
+        return subscriber
+
+    def tearDown(self):
+        for task in self.tasks:
+            task.cancel()
+        if self.tasks:
+            self.loop.run_until_complete(asyncio.wait(self.tasks))
+        super(TC_00_Subscriber, self).tearDown()
+
+    def run_pending(self):
+        for _ in range(3):
+            self.loop.run_until_complete(asyncio.sleep(0))
+
+    def put(self, subscriber, event, arg):
+        subscriber.put(self.vm, event, {'arg': arg},
+            '{}:{}'.format(event, arg).encode())
+
+    def test_000_direct(self):
+        subscriber = self.subscribe()
+        self.put(subscriber, 'test-event', 1)
+        # written right away, without waiting for the task
+        self.assertEqual(self.connection.sent, [b'test-event:1'])
+        self.assertEqual(subscriber.stats()['delivered'], 1)
+        self.assertEqual(subscriber.stats()['queued'], 0)
+
+    def test_001_queue_while_paused(self):
+        subscriber = self.subscribe()
+        self.connection.pause()
+        self.put(subscriber, 'test-event', 1)
+        self.put(subscriber, 'test-event', 2)
+        self.run_pending()
+        self.assertEqual(self.connection.sent, [])
+        self.assertEqual(subscriber.stats()['queued'], 2)
+        self.assertGreater(subscriber.lag, 0)
+
+        self.connection.resume()
+        # new event must not overtake queued ones
+        self.put(subscriber, 'test-event', 3)
+        self.run_pending()
+        self.assertEqual(self.connection.sent,
+            [b'test-event:1', b'test-event:2', b'test-event:3'])
+        stats = subscriber.stats()
+        self.assertEqual(stats['delivered'], 3)
+        self.assertEqual(stats['queued'], 0)
+        self.assertEqual(stats['max_queued'], 3)
+        self.assertEqual(stats['lag'], 0)
+
+    def test_002_overflow_drop(self):
+        subscriber = self.subscribe(queue_size=2, overflow='drop')
+        self.connection.pause()
+        for i in range(4):
+            self.put(subscriber, 'test-event', i)
+        self.connection.resume()
+        self.run_pending()
+        self.assertEqual(self.connection.sent,
+            [b'test-event:2', b'test-event:3'])
+        self.assertEqual(subscriber.stats()['dropped'], 2)
+        self.assertEqual(subscriber.stats()['received'], 4)
+
+    def test_003_overflow_coalesce(self):
+        subscriber = self.subscribe(queue_size=2, overflow='coalesce')
+        self.connection.pause()
+        self.put(subscriber, 'test-event', 1)
+        self.put(subscriber, 'other-event', 1)
+        self.put(subscriber, 'test-event', 2)
+        self.put(subscriber, 'test-event', 3)
+        self.put(subscriber, 'third-event', 1)
+        self.connection.resume()
+        self.run_pending()
+        self.assertEqual(self.connection.sent,
+            [b'test-event:3', b'other-event:1'])
+        self.assertEqual(subscriber.stats()['coalesced'], 2)
+        self.assertEqual(subscriber.stats()['dropped'], 1)
+
+    def test_004_overflow_disconnect(self):
+        # the default policy
+        subscriber = self.subscribe(queue_size=2)
+        self.connection.pause()
+        for i in range(3):
+            self.put(subscriber, 'test-event', i)
+        self.assertTrue(subscriber.disconnected)
+        self.connection.resume()
+        with self.assertNotRaises(asyncio.TimeoutError):
+            self.loop.run_until_complete(
+                asyncio.wait_for(subscriber.run(), 1))
+        self.put(subscriber, 'test-event', 4)
+        self.assertEqual(self.connection.sent, [])
+
+    def test_006_coalesce(self):
+        subscriber = self.subscribe(coalesce=0.01)
+        vm2 = Subject('test-vm2')
+        events = [
+            (self.vm, 'property-set:memory',
+                {'name': 'memory', 'newvalue': 1}),
+            (vm2, 'property-set:memory', {'name': 'memory', 'newvalue': 1}),
+            (self.vm, 'property-set:vcpus', {'name': 'vcpus', 'newvalue': 1}),
+            (self.vm, 'domain-tag-add', {'tag': 'a'}),
+            (self.vm, 'domain-tag-add', {'tag': 'b'}),
+            (self.vm, 'property-set:memory',
+                {'name': 'memory', 'newvalue': 2}),
+            (self.vm, 'domain-tag-add', {'tag': 'a'}),
+        ]
+        for subject, event, kwargs in events:
+            subscriber.put(subject, event, kwargs, '{}:{}:{}'.format(
+                subject.name, event,
+                kwargs.get('newvalue', kwargs.get('tag'))).encode())
+        self.run_pending()
+        self.assertEqual(self.connection.sent, [])
+        self.assertEqual(subscriber.stats()['pending'], 5)
+
+        self.loop.run_until_complete(asyncio.sleep(0.02))
+        # the newer event replaces the older one, in its own position
+        self.assertEqual(self.connection.sent, [
+            b'test-vm2:property-set:memory:1',
+            b'test-vm:property-set:vcpus:1',
+            b'test-vm:domain-tag-add:b',
+            b'test-vm:property-set:memory:2',
+            b'test-vm:domain-tag-add:a',
+        ])
+        stats = subscriber.stats()
+        self.assertEqual(stats['received'], 7)
+        self.assertEqual(stats['coalesced'], 2)
+        self.assertEqual(stats['delivered'], 5)
+        self.assertEqual(stats['pending'], 0)
+
+    def test_007_close(self):
+        subscriber = self.subscribe(coalesce=0.01)
+        self.put(subscriber, 'test-event', 1)
+        subscriber.close()
+        self.loop.run_until_complete(asyncio.sleep(0.02))
+        self.assertEqual(self.connection.sent, [])
+
+    def test_008_drop_pre(self):
+        subscriber = qubes.api.eventbus.Subscriber(self.send_event,
+            drop_pre=True)
+        self.assertFalse(subscriber.accepts(self.vm,
+            'property-pre-set:memory', {}))
+        self.assertFalse(subscriber.accepts(self.vm, 'domain-pre-start', {}))
+        self.assertTrue(subscriber.accepts(self.vm, 'property-set:memory', {}))
+        self.assertTrue(qubes.api.eventbus.Subscriber(self.send_event)
+            .accepts(self.vm, 'domain-pre-start', {}))
+
+    def test_005_filters(self):
+        bus = qubes.api.eventbus.EventBus(unittest.mock.Mock(domains=[]))
+        subscriber = bus.subscribe(self.send_event, [
+            lambda entry: entry[1] != 'hidden-event',
+            lambda entry: entry[2].get('arg') != 'hidden',
+        ])
+        bus.app_handler(self.vm, 'test-event', arg='visible')
+        bus.app_handler(self.vm, 'test-event', arg='hidden')
+        bus.app_handler(self.vm, 'hidden-event', arg='visible')
+        self.assertEqual(self.send_event.mock_calls, [
+            unittest.mock.call(self.vm, 'test-event', arg='visible')])
+        self.assertEqual(subscriber.received, 1)
+
+
+class TC_01_EventBus(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super(TC_01_EventBus, self).setUp()
+        self.app = qubes.tests.TestEmitter()
+        self.app.events_enabled = True
+        self.vm1 = qubes.tests.TestEmitter()
+        self.vm1.events_enabled = True
+        self.vm1.name = 'vm1'
+        self.vm2 = qubes.tests.TestEmitter()
+        self.vm2.events_enabled = True
+        self.vm2.name = 'vm2'
+        self.app.domains = [self.vm1, self.vm2]
+        self.bus = qubes.api.eventbus.EventBus.get(self.app)
+
+    def test_000_get(self):
+        self.assertIs(qubes.api.eventbus.EventBus.get(self.app), self.bus)
+        self.assertIsNot(
+            qubes.api.eventbus.EventBus.get(qubes.tests.TestEmitter()),
+            self.bus)
+
+    def test_010_fanout(self):
+        send1 = unittest.mock.Mock(spec=[])
+        send2 = unittest.mock.Mock(spec=[])
+        send3 = unittest.mock.Mock(spec=[])
+        subscriber1 = self.bus.subscribe(send1)
+        self.bus.subscribe(send2)
+        subscriber3 = self.bus.subscribe(send3, dest=self.vm2)
+        # one handler, regardless of number of subscribers
+        self.assertEqual(self.vm1.__handlers__['*'], {self.bus.vm_handler})
+
+        self.app.fire_event('app-event', arg='a')
+        self.vm1.fire_event('test-event', arg='b')
+        self.vm2.fire_event('test-event', arg='c')
+        self.vm2.fire_event('mgmt-permission:admin.Events')
+        self.assertEqual(send1.mock_calls, [
+            unittest.mock.call(self.app, 'app-event', arg='a'),
+            unittest.mock.call(self.vm1, 'test-event', arg='b'),
+            unittest.mock.call(self.vm2, 'test-event', arg='c'),
+        ])
+        self.assertEqual(send2.mock_calls, send1.mock_calls)
+        self.assertEqual(send3.mock_calls, [
+            unittest.mock.call(self.vm2, 'test-event', arg='c'),
+        ])
+
+        self.bus.unsubscribe(subscriber1)
+        self.vm1.fire_event('test-event', arg='d')
+        self.assertEqual(len(send1.mock_calls), 3)
+        self.assertEqual(len(send2.mock_calls), 4)
+        self.assertEqual(len(self.bus.stats()), 2)
+        self.bus.unsubscribe(subscriber3)
+        self.assertEqual(self.bus.stats(), [
+            {'id': 2, 'source': None,
+                'received': 4, 'delivered': 4, 'dropped': 0, 'coalesced': 0,
+                'queued': 0, 'pending': 0, 'max_queued': 0, 'lag': 0.,
+                'disconnected': False}])
+
+    def test_011_detach(self):
+        subscriber = self.bus.subscribe(unittest.mock.Mock(spec=[]))
+        self.bus.unsubscribe(subscriber)
+        self.assertFalse(self.app.__handlers__['*'])
+        self.assertFalse(self.vm1.__handlers__['*'])
+        self.assertFalse(self.vm2.__handlers__['*'])
+
+    def test_012_domain_add(self):
+        send = unittest.mock.Mock(spec=[])
+        self.bus.subscribe(send)
+        vm3 = qubes.tests.TestEmitter()
+        vm3.events_enabled = True
+        vm3.name = 'vm3'
+        self.app.domains.append(vm3)
+        self.app.fire_event('domain-add', vm=vm3)
+        vm3.fire_event('test-event')
+        self.app.fire_event('domain-delete', vm=vm3)
+        vm3.fire_event('test-event2')
+        self.assertEqual(send.mock_calls, [
+            unittest.mock.call(self.app, 'domain-add', vm=vm3),
+            unittest.mock.call(vm3, 'test-event'),
+            unittest.mock.call(self.app, 'domain-delete', vm=vm3),
+        ])
+
+    def test_013_serialize_once(self):
+        connection1 = Connection()
+        connection2 = Connection()
+        self.bus.subscribe(None, connection=connection1)
+        self.bus.subscribe(None, connection=connection2)
+        self.vm1.fire_event('test-event', arg='abc')
+        self.app.fire_event('app-event')
+        self.assertEqual(connection1.sent, [
+            b'1\0vm1\0test-event\0arg\0abc\0\0',
+            b'1\0\0app-event\0\0',
+        ])
+        self.assertIs(connection1.sent[0], connection2.sent[0])
+
+    def test_014_sequence(self):
+        send = unittest.mock.Mock(spec=[])
+        connection = Connection()
+        self.bus.subscribe(send)
+        subscriber = self.bus.subscribe(None, connection=connection,
+            sequenced=True)
+        self.vm1.fire_event('test-event', arg='abc')
+        self.app.fire_event('app-event')
+        self.assertEqual(connection.sent, [
+            b'1\0001\0vm1\0test-event\0arg\0abc\0\0',
+            b'1\0002\0\0app-event\0\0',
+        ])
+        self.assertEqual(send.mock_calls, [
+            unittest.mock.call(self.vm1, 'test-event', arg='abc'),
+            unittest.mock.call(self.app, 'app-event'),
+        ])
+        self.assertEqual(self.bus.sequence, 2)
+
+        # events are recorded also without subscribers
+        self.bus.unsubscribe(subscriber)
+        self.bus.unsubscribe(self.bus.subscribers[0])
+        self.vm2.fire_event('test-event', arg='def')
+        self.assertEqual([entry[0] for entry in self.bus.replay], [1, 2, 3])
+
+    def test_015_resume(self):
+        subscriber = self.bus.subscribe(None, connection=Connection(),
+            sequenced=True)
+        self.vm1.fire_event('test-event', arg='a')
+        self.vm2.fire_event('test-event', arg='b')
+        self.vm1.fire_event('test-event', arg='c')
+        self.bus.unsubscribe(subscriber)
+
+        connection = Connection()
+        subscriber = self.bus.subscribe(None, dest=self.vm1,
+            connection=connection, sequenced=True)
+        self.assertTrue(self.bus.can_resume(self.bus.epoch, 1))
+        self.bus.resume(subscriber, 1)
+        self.assertEqual(connection.sent, [
+            b'1\0003\0vm1\0test-event\0arg\0c\0\0',
+        ])
+        self.assertTrue(self.bus.can_resume(self.bus.epoch, 3))
+        self.assertFalse(self.bus.can_resume(self.bus.epoch, 4))
+        self.assertFalse(self.bus.can_resume('0', 1))
+
+    def test_016_resume_lost(self):
+        self.bus.replay_size = 2
+        self.bus.subscribe(None, connection=Connection(), sequenced=True)
+        for i in range(4):
+            self.vm1.fire_event('test-event', arg=i)
+        self.assertFalse(self.bus.can_resume(self.bus.epoch, 1))
+        self.assertTrue(self.bus.can_resume(self.bus.epoch, 2))
+
+    def test_017_replay_not_pinning(self):
+        subscriber = self.bus.subscribe(None, connection=Connection(),
+            sequenced=True)
+        vm3 = qubes.tests.TestEmitter()
+        vm3.events_enabled = True
+        vm3.name = 'vm3'
+        self.app.domains.append(vm3)
+        self.app.fire_event('domain-add', vm=vm3)
+        vm3.fire_event('test-event', arg='a')
+        self.vm1.fire_event('test-event', arg=vm3)
+        self.app.fire_event('domain-delete', vm=vm3)
+        self.app.domains.remove(vm3)
+        # TestEmitter keeps arguments of fired events
+        self.app.fired_events.clear()
+        self.vm1.fired_events.clear()
+        vm3_ref = weakref.ref(vm3)
+        del vm3
+        gc.collect()
+        self.assertIsNone(vm3_ref())
+        self.bus.unsubscribe(subscriber)
+
+        connection = Connection()
+        filters = []
+        subscriber = self.bus.subscribe(None, [filters.append],
+            connection=connection, sequenced=True)
+        self.bus.resume(subscriber, 0)
+        # events of removed vm3 are not given to filters
+        self.assertEqual([entry[0] for entry in filters],
+            [self.app, self.vm1, self.app])
+        self.assertIsInstance(filters[1][2]['arg'], str)
+
+        connection = Connection()
+        subscriber = self.bus.subscribe(None, connection=connection,
+            sequenced=True)
+        self.bus.resume(subscriber, 1)
+        self.assertEqual(connection.sent[0],
+            b'1\0002\0vm3\0test-event\0arg\0a\0\0')
+        self.assertEqual(len(connection.sent), 3)
+
+    def test_018_replay_dropped(self):
+        self.bus.replay_keep = 0
+        subscriber = self.bus.subscribe(None, connection=Connection(),
+            sequenced=True)
+        self.vm1.fire_event('test-event')
+        self.bus.unsubscribe(subscriber)
+        self.assertIsNotNone(self.bus.replay)
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.assertIsNone(self.bus.replay)
+        self.assertFalse(self.app.__handlers__['*'])
+        self.assertFalse(self.bus.can_resume(self.bus.epoch, 1))
+
+        # a new sequenced subscriber keeps the events
+        self.bus.replay_keep = 60
+        subscriber = self.bus.subscribe(None, connection=Connection(),
+            sequenced=True)
+        self.bus.unsubscribe(subscriber)
+        self.bus.subscribe(None, connection=Connection(), sequenced=True)
+        self.vm1.fire_event('test-event')
+        # pylint: disable=protected-access
+        self.assertIsNone(self.bus._replay_drop_handle)
+        self.assertTrue(self.bus.can_resume(self.bus.epoch, 1))
+
+    def test_019_resume_after_drop(self):
+        connection = Connection()
+        subscriber = self.bus.subscribe(None, connection=connection,
+            sequenced=True)
+        self.vm1.fire_event('test-event', arg='a')
+        epoch, sequence = self.bus.epoch, self.bus.sequence
+        with unittest.mock.patch.object(self.loop, 'call_later') as call_later:
+            self.bus.unsubscribe(subscriber)
+        (_, drop_replay), _ = call_later.call_args
+        drop_replay()
+
+        # missed while the bus was detached
+        self.vm1.fire_event('test-event', arg='b')
+        subscriber = self.bus.subscribe(None, connection=Connection(),
+            sequenced=True)
+        self.vm1.fire_event('test-event', arg='c')
+        self.assertNotEqual(self.bus.epoch, epoch)
+        self.assertFalse(self.bus.can_resume(epoch, sequence))
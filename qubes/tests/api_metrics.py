@@ -0,0 +1,165 @@
+# -*- encoding: utf8 -*-
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import os
+import shutil
+import tempfile
+import unittest.mock
+
+import qubes.api.metrics
+import qubes.tests
+
+
+class TC_00_APIMetrics(qubes.tests.QubesTestCase):
+    def test_000_histogram(self):
+        histogram = qubes.api.metrics.Histogram((0.1, 1.))
+        for value in (0.05, 0.1, 0.5, 2.):
+            histogram.observe(value)
+        self.assertEqual(histogram.counts, [2, 1, 1])
+        self.assertEqual(histogram.count, 4)
+        self.assertAlmostEqual(histogram.sum, 2.65)
+
+    def test_010_get(self):
+        app = unittest.mock.Mock()
+        metrics = qubes.api.metrics.APIMetrics.get(app)
+        self.assertIs(qubes.api.metrics.APIMetrics.get(app), metrics)
+        self.assertIsNot(
+            qubes.api.metrics.APIMetrics.get(unittest.mock.Mock()), metrics)
+
+    def test_020_record(self):
+        metrics = qubes.api.metrics.APIMetrics()
+        metrics.call_started('admin.vm.List')
+        metrics.call_started('admin.vm.List')
+        self.assertEqual(metrics.in_flight, {'admin.vm.List': 2})
+        metrics.call_finished('admin.vm.List', 'dom0', 'ok',
+            {'permission': 0.0001, 'handler': 0.002, 'write': 0.0001})
+        self.assertEqual(metrics.in_flight, {'admin.vm.List': 1})
+        self.assertEqual(metrics.calls, {('admin.vm.List', 'dom0', 'ok'): 1})
+        self.assertEqual(sorted(metrics.latency),
+            [('admin.vm.List', phase) for phase in
+                ('handler', 'permission', 'write')])
+        self.assertEqual(metrics.latency['admin.vm.List', 'handler'].count, 1)
+
+    def test_030_render(self):
+        metrics = qubes.api.metrics.APIMetrics(buckets=(0.1,))
+        metrics.call_started('admin.vm.List')
+        metrics.call_finished('admin.vm.List', 'dom0', 'ok',
+            {'handler': 0.5})
+        metrics.call_started(qubes.api.metrics.UNKNOWN)
+        metrics.call_finished(qubes.api.metrics.UNKNOWN,
+            qubes.api.metrics.UNKNOWN, 'protocol_error', {})
+        self.assertEqual(metrics.render(),
+            '# TYPE qubesd_api_calls counter\n'
+            '# HELP qubesd_api_calls Finished API calls\n'
+            'qubesd_api_calls_total{method="admin.vm.List",result="ok",'
+                'source="dom0"} 1\n'
+            'qubesd_api_calls_total{method="unknown",result="protocol_error",'
+                'source="unknown"} 1\n'
+            '# TYPE qubesd_api_calls_in_flight gauge\n'
+            '# HELP qubesd_api_calls_in_flight API calls in progress\n'
+            'qubesd_api_calls_in_flight{method="admin.vm.List"} 0\n'
+            'qubesd_api_calls_in_flight{method="unknown"} 0\n'
+            '# TYPE qubesd_api_calls_queued gauge\n'
+            '# HELP qubesd_api_calls_queued API calls waiting for '
+                'admission\n'
+            '# TYPE qubesd_api_calls_rejected counter\n'
+            '# HELP qubesd_api_calls_rejected API calls refused because of '
+                'too many waiting\n'
+            '# TYPE qubesd_api_call_duration_seconds histogram\n'
+            '# HELP qubesd_api_call_duration_seconds Time spent in each '
+                'phase of API calls\n'
+            'qubesd_api_call_duration_seconds_bucket{le="0.1",'
+                'method="admin.vm.List",phase="handler"} 0\n'
+            'qubesd_api_call_duration_seconds_bucket{le="+Inf",'
+                'method="admin.vm.List",phase="handler"} 1\n'
+            'qubesd_api_call_duration_seconds_sum{method="admin.vm.List",'
+                'phase="handler"} 0.5\n'
+            'qubesd_api_call_duration_seconds_count{method="admin.vm.List",'
+                'phase="handler"} 1\n'
+            + ''.join('# TYPE {0} {1}\n# HELP {0} {2}\n'.format(
+                name, metric_type, description)
+                for _, name, metric_type, description in
+                    qubes.api.metrics.SUBSCRIBER_METRICS) +
+            '# EOF\n')
+
+    def test_031_render_escape(self):
+        metrics = qubes.api.metrics.APIMetrics()
+        metrics.call_started('a"b\\c\nd')
+        self.assertIn('{method="a\\"b\\\\c\\nd"} 1\n', metrics.render())
+
+
+    def test_032_render_subscribers(self):
+        metrics = qubes.api.metrics.APIMetrics()
+        stats = {'id': 3, 'source': 'test-vm', 'received': 5, 'delivered': 4,
+            'dropped': 0, 'coalesced': 1, 'queued': 1, 'pending': 0,
+            'max_queued': 2, 'lag': 0.5, 'disconnected': False}
+        value = metrics.render([stats, dict(stats, id=4, source=None)])
+        for line in (
+                'qubesd_events_received_total{source="test-vm",'
+                    'subscriber="3"} 5\n',
+                'qubesd_events_queued{source="test-vm",subscriber="3"} 1\n',
+                'qubesd_events_lag_seconds{source="test-vm",subscriber="3"} '
+                    '0.5\n',
+                'qubesd_events_delivered_total{source="unknown",'
+                    'subscriber="4"} 4\n'):
+            self.assertIn(line, value)
+
+
+class TC_01_MetricsServer(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super(TC_01_MetricsServer, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.sockpath = os.path.join(self.tmpdir, 'metrics.sock')
+        patch = unittest.mock.patch('shutil.chown')
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.app = unittest.mock.Mock()
+
+    def test_000_serve(self):
+        metrics = qubes.api.metrics.APIMetrics.get(self.app)
+        metrics.call_started('admin.vm.List')
+        server = self.loop.run_until_complete(
+            qubes.api.metrics.create_metrics_server(self.app, self.sockpath))
+
+        @asyncio.coroutine
+        def read():
+            reader, writer = yield from asyncio.open_unix_connection(
+                self.sockpath)
+            data = yield from reader.read()
+            writer.close()
+            return data
+
+        try:
+            data = self.loop.run_until_complete(asyncio.wait_for(read(), 1))
+        finally:
+            server.close()
+            self.loop.run_until_complete(server.wait_closed())
+        self.assertEqual(data, metrics.render().encode())
+
+    def test_001_socket_exists(self):
+        server = self.loop.run_until_complete(
+            qubes.api.metrics.create_metrics_server(self.app, self.sockpath))
+        try:
+            with self.assertRaises(FileExistsError):
+                self.loop.run_until_complete(
+                    qubes.api.metrics.create_metrics_server(self.app,
+                        self.sockpath))
+        finally:
+            server.close()
+            self.loop.run_until_complete(server.wait_closed())
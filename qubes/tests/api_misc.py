@@ -61,7 +61,7 @@ class TC_00_API_Misc(qubes.tests.QubesTestCase):
         response = self.call_mgmt_func(b'qubes.FeaturesRequest')
         self.assertIsNone(response)
         self.assertEqual(self.app.mock_calls, [
-            mock.call.save()
+            mock.call.schedule_save()
         ])
         self.assertEqual(self.src.mock_calls, [
             mock.call.qdb.list('/features-request/'),
@@ -77,7 +77,7 @@ class TC_00_API_Misc(qubes.tests.QubesTestCase):
         response = self.call_mgmt_func(b'qubes.FeaturesRequest')
         self.assertIsNone(response)
         self.assertEqual(self.app.mock_calls, [
-            mock.call.save()
+            mock.call.schedule_save()
         ])
         self.assertEqual(self.src.mock_calls, [
             mock.call.qdb.list('/features-request/'),
@@ -122,7 +122,7 @@ class TC_00_API_Misc(qubes.tests.QubesTestCase):
         response = self.call_mgmt_func(b'qubes.NotifyTools')
         self.assertIsNone(response)
         self.assertEqual(self.app.mock_calls, [
-            mock.call.save()
+            mock.call.schedule_save()
         ])
         self.assertEqual(self.src.mock_calls, [
             mock.call.qdb.read('/qubes-tools/qrexec'),
@@ -133,7 +133,7 @@ class TC_00_API_Misc(qubes.tests.QubesTestCase):
                 'default-user': 'user',
                 'qrexec': '1'}),
         ])
-        self.assertEqual(self.app.mock_calls, [mock.call.save()])
+        self.assertEqual(self.app.mock_calls, [mock.call.schedule_save()])
 
     def test_013_notify_tools_no_version(self):
         qdb_entries = {
@@ -154,7 +154,7 @@ class TC_00_API_Misc(qubes.tests.QubesTestCase):
                 'default-user': 'user',
                 'qrexec': '1'}),
         ])
-        self.assertEqual(self.app.mock_calls, [mock.call.save()])
+        self.assertEqual(self.app.mock_calls, [mock.call.schedule_save()])
 
     def test_015_notify_tools_invalid_value_qrexec(self):
         qdb_entries = {
@@ -197,7 +197,7 @@ class TC_00_API_Misc(qubes.tests.QubesTestCase):
             mock.call.updateable.__bool__(),
             mock.call.features.__setitem__('updates-available', True),
         ])
-        self.assertEqual(self.app.mock_calls, [mock.call.save()])
+        self.assertEqual(self.app.mock_calls, [mock.call.schedule_save()])
 
     def test_021_notify_updates_standalone2(self):
         del self.src.template
@@ -208,7 +208,7 @@ class TC_00_API_Misc(qubes.tests.QubesTestCase):
             mock.call.features.__setitem__('updates-available', False),
         ])
         self.assertEqual(self.app.mock_calls, [
-            mock.call.save()
+            mock.call.schedule_save()
         ])
 
     def test_022_notify_updates_invalid(self):
@@ -248,7 +248,7 @@ class TC_00_API_Misc(qubes.tests.QubesTestCase):
             mock.call.template.features.__setitem__('updates-available', True),
         ])
         self.assertEqual(self.app.mock_calls, [
-            mock.call.save()
+            mock.call.schedule_save()
         ])
 
     def test_026_notify_updates_template_based_outdated(self):
@@ -0,0 +1,133 @@
+# -*- encoding: utf8 -*-
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+
+import qubes.api.admin
+import qubes.api.scheduler
+import qubes.tests
+
+
+class TC_00_CallScheduler(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super(TC_00_CallScheduler, self).setUp()
+        self.scheduler = qubes.api.scheduler.CallScheduler()
+        self.scheduler.source_limits = {'read': 2, 'write': 1}
+        self.scheduler.lane_limits = {'read': None, 'write': 2}
+        self.tasks = []
+        self.admitted = []
+
+    def tearDown(self):
+        for task in self.tasks:
+            task.cancel()
+        if self.tasks:
+            self.loop.run_until_complete(asyncio.wait(self.tasks))
+        super(TC_00_CallScheduler, self).tearDown()
+
+    def acquire(self, source, lane):
+        @asyncio.coroutine
+        def coro():
+            yield from self.scheduler.acquire(source, lane)
+            self.admitted.append(source)
+        task = asyncio.ensure_future(coro())
+        self.tasks.append(task)
+        self.run_pending()
+        return task
+
+    def run_pending(self):
+        for _ in range(3):
+            self.loop.run_until_complete(asyncio.sleep(0))
+
+    def test_000_method_lane(self):
+        handler = qubes.api.admin.QubesAdminAPI
+        for method, lane in (
+                (b'admin.vm.List', 'read'),
+                (b'admin.vm.property.Get', 'read'),
+                (b'admin.vm.property.Set', 'write'),
+                (b'admin.vm.Start', 'write'),
+                (b'admin.vm.volume.Clone', 'write'),
+                (b'admin.no.such.method', 'write'),
+                (b'\xff', 'write')):
+            with self.subTest(method):
+                self.assertEqual(
+                    qubes.api.scheduler.method_lane(handler, method), lane)
+
+    def test_010_source_limit(self):
+        for _ in range(3):
+            self.acquire('test-vm1', 'read')
+        self.assertEqual(self.admitted, ['test-vm1', 'test-vm1'])
+        self.assertEqual(self.scheduler.metrics.queued,
+            {'read': 1, 'write': 0})
+
+        # other sources and lanes are not affected
+        self.acquire('test-vm2', 'read')
+        self.acquire('test-vm1', 'write')
+        self.assertEqual(len(self.admitted), 4)
+
+        self.scheduler.release('test-vm1', 'read')
+        self.run_pending()
+        self.assertEqual(len(self.admitted), 5)
+        self.assertEqual(self.scheduler.metrics.queued,
+            {'read': 0, 'write': 0})
+        self.assertEqual(self.scheduler.waiting['read'], {})
+
+    def test_011_take_turns(self):
+        self.scheduler.source_limits['write'] = 2
+        self.acquire('test-vm1', 'write')
+        self.acquire('test-vm1', 'write')
+        self.acquire('test-vm1', 'write')
+        self.acquire('test-vm1', 'write')
+        self.acquire('test-vm2', 'write')
+        self.acquire('test-vm2', 'write')
+        self.assertEqual(self.admitted, ['test-vm1', 'test-vm1'])
+        for _ in range(4):
+            self.scheduler.release(self.admitted[0], 'write')
+            self.run_pending()
+        self.assertEqual(self.admitted[2:],
+            ['test-vm1', 'test-vm2', 'test-vm1', 'test-vm2'])
+
+    def test_012_exempt(self):
+        self.acquire('test-vm1', 'write')
+        self.acquire('test-vm2', 'write')
+        self.acquire('test-vm3', 'write')
+        for _ in range(3):
+            self.acquire('dom0', 'write')
+        self.assertEqual(self.admitted,
+            ['test-vm1', 'test-vm2', 'dom0', 'dom0', 'dom0'])
+
+    def test_013_queue_full(self):
+        self.scheduler.max_queued = 1
+        self.acquire('test-vm1', 'write')
+        self.acquire('test-vm1', 'write')
+        task = self.acquire('test-vm1', 'write')
+        self.assertIsInstance(task.exception(), qubes.api.scheduler.QueueFull)
+        self.assertEqual(self.scheduler.metrics.rejected,
+            {'read': 0, 'write': 1})
+
+    def test_014_cancel_waiting(self):
+        self.acquire('test-vm1', 'write')
+        task = self.acquire('test-vm1', 'write')
+        self.acquire('test-vm1', 'write')
+        task.cancel()
+        self.scheduler.release('test-vm1', 'write')
+        self.run_pending()
+        # the slot went to the next call
+        self.assertEqual(self.admitted, ['test-vm1', 'test-vm1'])
+        self.assertEqual(self.scheduler.running_by_source,
+            {('write', 'test-vm1'): 1})
+        self.assertEqual(self.scheduler.metrics.queued,
+            {'read': 0, 'write': 0})
@@ -21,9 +21,20 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 #
 
+import asyncio
+import copy
+import fcntl
+import gc
+import json
 import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest.mock
 import uuid
 
+import libvirt
 import lxml.etree
 
 import qubes
@@ -47,7 +58,7 @@ class TC_30_VMCollection(qubes.tests.QubesTestCase):
             None, None, qid=2, name='testvm2')
 
     def test_000_contains(self):
-        self.vms._dict = {1: self.testvm1}
+        self.vms.add(self.testvm1)
 
         self.assertIn(1, self.vms)
         self.assertIn('testvm1', self.vms)
@@ -58,7 +69,7 @@ class TC_30_VMCollection(qubes.tests.QubesTestCase):
         self.assertNotIn(self.testvm2, self.vms)
 
     def test_001_getitem(self):
-        self.vms._dict = {1: self.testvm1}
+        self.vms.add(self.testvm1)
 
         self.assertIs(self.vms[1], self.testvm1)
         self.assertIs(self.vms['testvm1'], self.testvm1)
@@ -127,6 +138,44 @@ class TC_30_VMCollection(qubes.tests.QubesTestCase):
         self.assertEventFired(self.app, 'domain-delete',
             kwargs={'vm': self.testvm2})
 
+    def test_009_rename(self):
+        self.vms.add(self.testvm1)
+        self.testvm1.name = 'testvm3'
+
+        self.assertIs(self.vms['testvm3'], self.testvm1)
+        self.assertIn('testvm3', self.vms)
+        self.assertNotIn('testvm1', self.vms)
+        with self.assertRaises(KeyError):
+            self.vms['testvm1']
+
+    def test_010_uuid(self):
+        self.vms.add(self.testvm1)
+        self.assertIs(self.vms[self.testvm1.uuid], self.testvm1)
+        self.assertIs(self.vms[self.testvm1], self.testvm1)
+
+        del self.vms['testvm1']
+        with self.assertRaises(KeyError):
+            self.vms[self.testvm1.uuid]
+        self.assertNotIn('testvm1', self.vms)
+
+    def test_011_sorted(self):
+        self.vms.add(self.testvm2)
+        self.assertEqual(list(self.vms), [self.testvm2])
+        self.vms.add(self.testvm1)
+        self.assertEqual(list(self.vms), [self.testvm1, self.testvm2])
+        self.assertEqual(list(self.vms.qids()), [1, 2])
+
+        self.testvm1.name = 'testvm3'
+        self.assertEqual(list(self.vms), [self.testvm2, self.testvm1])
+        self.assertEqual(list(self.vms.names()), ['testvm2', 'testvm3'])
+
+        # deleting while iterating
+        for vm in self.vms:
+            del self.vms[vm.qid]
+        self.assertEqual(list(self.vms), [])
+        self.assertEqual(list(self.vms.qids()), [])
+        self.assertEqual(list(self.vms.names()), [])
+
     def test_100_get_new_unused_qid(self):
         self.vms.add(self.testvm1)
         self.vms.add(self.testvm2)
@@ -146,6 +195,547 @@ class TC_30_VMCollection(qubes.tests.QubesTestCase):
 #       pass
 
 
+class TC_80_SaveScheduler(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.store = os.path.join(self.tmpdir, 'qubes.xml')
+        self.app = qubes.Qubes(self.store, load=False, offline_mode=True)
+
+    def test_000_schedule_immediate(self):
+        self.app.schedule_save()
+        self.assertTrue(os.path.exists(self.store))
+        self.assertFalse(self.app.save_pending)
+        self.assertEqual(self.app.saves_requested, 1)
+        self.assertEqual(self.app.saves_performed, 1)
+
+    def test_001_schedule_coalesce(self):
+        self.app.save_delay = 0.1
+        for _ in range(5):
+            self.app.schedule_save()
+        self.assertTrue(self.app.save_pending)
+        self.assertFalse(os.path.exists(self.store))
+        self.loop.run_until_complete(asyncio.sleep(0.2))
+        self.assertTrue(os.path.exists(self.store))
+        self.assertFalse(self.app.save_pending)
+        self.assertEqual(self.app.saves_requested, 5)
+        self.assertEqual(self.app.saves_performed, 1)
+
+    def test_002_flush(self):
+        self.app.save_delay = 100
+        self.app.schedule_save()
+        self.app.schedule_save()
+        self.app.flush_save()
+        self.assertTrue(os.path.exists(self.store))
+        self.assertFalse(self.app.save_pending)
+        self.app.flush_save()
+        self.assertEqual(self.app.saves_requested, 2)
+        self.assertEqual(self.app.saves_performed, 1)
+
+    def test_003_save_cancels_scheduled(self):
+        self.app.save_delay = 0.1
+        self.app.schedule_save()
+        self.app.save()
+        self.assertFalse(self.app.save_pending)
+        self.loop.run_until_complete(asyncio.sleep(0.2))
+        self.assertEqual(self.app.saves_performed, 1)
+
+
+class StoreTestCase(qubes.tests.QubesTestCase):
+    '''Base class for tests saving and loading actual qubes.xml'''
+
+    def setUp(self):
+        super().setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        for patch in (
+                unittest.mock.patch.dict(qubes.config.system_path,
+                    {'qubes_base_dir': self.tmpdir}),
+                unittest.mock.patch('qubes.config.qubes_base_dir',
+                    self.tmpdir)):
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.store = os.path.join(self.tmpdir, 'qubes.xml')
+        self.journal = self.store + '.journal'
+
+        app = qubes.Qubes(self.store, load=False)
+        app.vmm = unittest.mock.Mock(spec=qubes.app.VMMConnection)
+        app.vmm.configure_mock(**{
+            'libvirt_conn.lookupByUUID.return_value.isActive.return_value':
+                False,
+            'libvirt_conn.lookupByUUID.return_value.state.return_value':
+                [libvirt.VIR_DOMAIN_SHUTOFF],
+        })
+        app.load_initial_values()
+        app.default_kernel = '1.0'
+        app.default_netvm = None
+        app.clockvm = None
+        app.updatevm = None
+        app.default_template = app.add_new_vm('TemplateVM', label='black',
+            name='test-template')
+        self.vm = app.add_new_vm('AppVM', label='red', name='test-vm1',
+            template='test-template')
+        app.save()
+        self.app = app
+
+    def load(self, **kwargs):
+        return qubes.Qubes(self.store, offline_mode=True, **kwargs)
+
+    @staticmethod
+    def state(app):
+        return {
+            'default_kernel': app.default_kernel,
+            'domains': {vm.name: (
+                dict(vm.features),
+                set(vm.tags),
+                lxml.etree.tostring(vm.xml_properties()),
+                ) for vm in app.domains},
+        }
+
+
+class TC_81_Journal(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.app.journal_enabled = True
+
+    def test_000_append(self):
+        with open(self.store, 'rb') as fh:
+            store_data = fh.read()
+        self.vm.features['test-feature'] = 'value'
+        self.vm.tags.add('test-tag')
+        self.vm.memory = 1234
+        self.app.default_kernel = '2.0'
+        self.app.schedule_save()
+        with open(self.store, 'rb') as fh:
+            self.assertEqual(fh.read(), store_data)
+        self.assertTrue(os.path.exists(self.journal))
+        self.assertEqual(self.app.saves_performed, 2)
+        self.assertEqual(self.state(self.load()), self.state(self.app))
+
+        del self.vm.features['test-feature']
+        self.vm.tags.remove('test-tag')
+        del self.vm.memory
+        self.app.schedule_save()
+        self.assertEqual(self.state(self.load()), self.state(self.app))
+
+    def test_001_domain_add_delete(self):
+        vm2 = self.app.add_new_vm('AppVM', label='red', name='test-vm2',
+            template='test-template')
+        vm2.features['test-feature'] = 'value'
+        del self.app.domains['test-vm1']
+        self.app.schedule_save()
+        app = self.load()
+        self.assertEqual(self.state(app), self.state(self.app))
+        self.assertEqual(app.domains['test-vm2'].uuid, vm2.uuid)
+        self.assertEqual(app.domains['test-vm2'].volume_config['root']['vid'],
+            vm2.volume_config['root']['vid'])
+
+    def test_002_save_compacts(self):
+        self.vm.features['test-feature'] = 'value'
+        self.app.schedule_save()
+        self.app.save()
+        with open(self.journal, 'rb') as fh:
+            self.assertEqual(len(fh.read().splitlines()), 1)
+        self.assertEqual(self.state(self.load()), self.state(self.app))
+
+        self.app.journal_enabled = False
+        self.app.save()
+        self.assertFalse(os.path.exists(self.journal))
+
+    def test_003_stale_journal(self):
+        self.vm.features['test-feature'] = 'value'
+        self.app.schedule_save()
+        with open(self.journal, 'rb') as fh:
+            journal_data = fh.read()
+        del self.vm.features['test-feature']
+        self.app.save()
+        with open(self.journal, 'wb') as fh:
+            fh.write(journal_data)
+        self.assertEqual(self.state(self.load()), self.state(self.app))
+
+    def test_004_truncated(self):
+        states = [self.state(self.app)]
+        for change in (
+                lambda: self.vm.features.__setitem__('test-feature', 'value'),
+                lambda: self.vm.tags.add('test-tag'),
+                lambda: setattr(self.vm, 'memory', 1234),
+                lambda: self.app.add_new_vm('AppVM', label='red',
+                    name='test-vm2', template='test-template'),
+                lambda: self.app.domains['test-vm2'].tags.add('test-tag2'),
+                ):
+            change()
+            self.app.schedule_save()
+            states.append(self.state(self.app))
+
+        with open(self.journal, 'rb') as fh:
+            journal_data = fh.read()
+        lines = journal_data.splitlines(keepends=True)
+        self.assertEqual(len(lines), len(states))
+
+        # (length, expected state index)
+        points = [(0, 0), (1, 0), (len(lines[0]) - 1, 0)]
+        start = 0
+        for i, line in enumerate(lines):
+            end = start + len(line)
+            if i > 0:
+                points.extend([(start + 1, i - 1), ((start + end) // 2, i - 1),
+                    (end - 1, i - 1)])
+            points.append((end, i))
+            start = end
+
+        for length, expected in points:
+            with self.subTest(length=length):
+                with open(self.journal, 'wb') as fh:
+                    fh.write(journal_data[:length])
+                self.assertEqual(self.state(self.load()), states[expected])
+
+        # new entries after an incomplete one are not lost
+        with open(self.journal, 'wb') as fh:
+            fh.write(journal_data[:len(lines[0]) + len(lines[1]) // 2])
+        app = self.load()
+        app.journal_enabled = True
+        app.domains['test-vm1'].features['other-feature'] = 'value'
+        app.schedule_save()
+        state = copy.deepcopy(states[0])
+        state['domains']['test-vm1'][0]['other-feature'] = 'value'
+        self.assertEqual(self.state(self.load()), state)
+
+    def test_005_compact_when_big(self):
+        self.app.journal_max_size = 0
+        self.vm.features['test-feature'] = 'value'
+        self.app.schedule_save()
+        with open(self.journal, 'rb') as fh:
+            self.assertEqual(len(fh.read().splitlines()), 2)
+        self.vm.features['test-feature'] = 'value2'
+        self.app.schedule_save()
+        with open(self.journal, 'rb') as fh:
+            self.assertEqual(len(fh.read().splitlines()), 1)
+        self.assertEqual(self.state(self.load()), self.state(self.app))
+
+    def test_006_compact_in_background(self):
+        self.app.journal_max_size = 0
+        @asyncio.coroutine
+        def change():
+            self.vm.features['test-feature'] = 'value'
+            self.app.schedule_save()
+            with open(self.journal, 'rb') as fh:
+                self.assertEqual(len(fh.read().splitlines()), 2)
+            yield from asyncio.sleep(0)
+        self.loop.run_until_complete(change())
+        with open(self.journal, 'rb') as fh:
+            self.assertEqual(len(fh.read().splitlines()), 1)
+        self.assertEqual(self.state(self.load()), self.state(self.app))
+
+    def test_007_lock_released(self):
+        # qubesd keeps running after journaling a change, other processes
+        # must still be able to load the store
+        load = [sys.executable, '-c',
+            'import qubes, sys; '
+            'app = qubes.Qubes(sys.argv[1], offline_mode=True); '
+            'print(app.domains["test-vm1"].features.get("test-feature"))',
+            self.store]
+        loaded = self.load()
+        loaded.journal_enabled = True
+        # just loaded (not holding the store), and after save()
+        for app, value in ((loaded, 'value'), (loaded, 'value2'),
+                (self.app, 'value3')):
+            if app is self.app:
+                self.app.save()
+            app.domains['test-vm1'].features['test-feature'] = value
+            app.schedule_save()
+            output = subprocess.check_output(load, timeout=20,
+                env=dict(os.environ, PYTHONPATH=':'.join(sys.path)))
+            self.assertEqual(output.decode().strip(), value)
+
+    def test_008_invalid_record(self):
+        state = self.state(self.app)
+        self.vm.features['test-feature'] = 'value'
+        self.vm.memory = 1234
+        self.vm.tags.add('test-tag')
+        self.app.schedule_save()
+        with open(self.journal, 'rb') as fh:
+            header, entry = fh.read().splitlines(keepends=True)
+        records = json.loads(entry.decode())
+        operations = [record['op'] for record in records]
+        middle = operations.index('property-set')
+        self.assertIn('feature-set', operations[:middle])
+        self.assertIn('tag-add', operations[middle:])
+
+        # an invalid record in the middle of the entry must not leave the
+        # records before it applied
+        for corrupt in ({'op': 'no-such-op'}, {'xml': '<property'},
+                {'qid': 1234}, {'name': 1}):
+            with self.subTest(corrupt=corrupt):
+                corrupted = copy.deepcopy(records)
+                corrupted[middle].update(corrupt)
+                with open(self.journal, 'wb') as fh:
+                    fh.write(header + json.dumps(corrupted).encode() + b'\n')
+                self.assertEqual(self.state(self.load()), state)
+
+
+class TC_82_LazyLoad(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.vm2 = self.app.add_new_vm('AppVM', label='red', name='test-vm2',
+            template='test-template')
+        self.vm2.features['test-feature'] = 'value'
+        self.app.save()
+
+    def test_000_stubs(self):
+        app = self.load(lazy=True)
+        # only dom0 (without qid saved) and default template
+        self.assertCountEqual(app.domains._dict, [0, 1])
+        self.assertEqual(len(app.domains), 4)
+        self.assertEqual(list(app.domains.qids()), [0, 1, 2, 3])
+        self.assertEqual(list(app.domains.names()),
+            ['dom0', 'test-template', 'test-vm1', 'test-vm2'])
+        self.assertIn('test-vm2', app.domains)
+        self.assertIn(3, app.domains)
+        self.assertNotIn('test-vm3', app.domains)
+        self.assertCountEqual(app.domains._dict, [0, 1])
+
+    def test_001_load_on_access(self):
+        app = self.load(lazy=True)
+        vm = app.domains['test-vm2']
+        self.assertCountEqual(app.domains._dict, [0, 1, 3])
+        self.assertIs(app.domains[3], vm)
+        self.assertIs(vm.template, app.domains['test-template'])
+        self.assertEqual(vm.features['test-feature'], 'value')
+        self.assertTrue(vm.events_enabled)
+        self.assertIs(app.domains[self.vm.uuid], app.domains[2])
+
+    def test_002_iterate(self):
+        app = self.load(lazy=True)
+        self.assertEqual(self.state(app), self.state(self.load()))
+        self.assertEqual(app.domains._stubs, {})
+
+    def test_003_save(self):
+        app = self.load(lazy=True)
+        app.domains['test-vm1'].features['test-feature2'] = 'value2'
+        app.save()
+        self.assertCountEqual(app.domains._dict, [0, 1, 2])
+        self.vm.features['test-feature2'] = 'value2'
+        self.assertEqual(self.state(self.load()), self.state(self.app))
+
+    def test_004_stub_xml(self):
+        stub = qubes.app.VMStub.fromxml(self.app,
+            self.app.domains['test-vm2'].__xml__())
+        self.assertEqual(stub.qid, 3)
+        self.assertEqual(stub.name, 'test-vm2')
+        self.assertEqual(stub.uuid, str(self.vm2.uuid))
+        self.assertIsNone(qubes.app.VMStub.fromxml(self.app,
+            self.app.domains['dom0'].__xml__()))
+
+
+class TC_83_Locking(StoreTestCase):
+    def test_000_load_shared(self):
+        with unittest.mock.patch('fcntl.lockf', wraps=fcntl.lockf) as lockf:
+            app = self.load()
+        self.assertEqual([call[0][1] for call in lockf.call_args_list],
+            [fcntl.LOCK_SH])
+        self.assertEqual(self.state(app), self.state(self.app))
+
+    def test_001_load_exclusive(self):
+        with unittest.mock.patch('fcntl.lockf', wraps=fcntl.lockf) as lockf:
+            app = self.load(lock=True)
+            app.default_kernel = '2.0'
+            app.save()
+        self.assertEqual([call[0][1] for call in lockf.call_args_list],
+            [fcntl.LOCK_EX])
+        self.assertEqual(self.load().default_kernel, '2.0')
+
+    def test_002_replaced_while_waiting(self):
+        # writer renames new store in place while reader waits for the lock
+        self.app.default_kernel = '2.0'
+        real_lockf = fcntl.lockf
+
+        def lockf(fd, operation):
+            if not lockf.replaced:
+                lockf.replaced = True
+                self.app.save()
+            return real_lockf(fd, operation)
+        lockf.replaced = False
+
+        with unittest.mock.patch('fcntl.lockf', side_effect=lockf) as mock:
+            app = self.load()
+        self.assertEqual(mock.call_count, 2)
+        self.assertEqual(app.default_kernel, '2.0')
+
+
+class TC_84_Relations(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.netvm = self.app.add_new_vm('AppVM', label='red',
+            name='test-netvm', template='test-template',
+            provides_network=True)
+
+    def test_000_template(self):
+        template = self.app.domains['test-template']
+        self.assertEqual(self.app.domains.get_vms_based_on(template),
+            {self.vm, self.netvm})
+        template2 = self.app.add_new_vm('TemplateVM', label='black',
+            name='test-template2')
+        self.vm.template = template2
+        self.assertEqual(self.app.domains.get_vms_based_on(template),
+            {self.netvm})
+        self.assertEqual(self.app.domains.get_vms_based_on('test-template2'),
+            {self.vm})
+
+    def test_001_netvm(self):
+        self.assertEqual(list(self.netvm.connected_vms), [])
+        self.app.default_netvm = self.netvm
+        self.assertEqual(list(self.netvm.connected_vms), [self.vm])
+        self.vm.netvm = None
+        self.assertEqual(list(self.netvm.connected_vms), [])
+        del self.vm.netvm
+        self.assertEqual(list(self.netvm.connected_vms), [self.vm])
+        del self.app.default_netvm
+        self.assertEqual(list(self.netvm.connected_vms), [])
+
+    def test_002_netvm_indirect(self):
+        proxy = self.app.add_new_vm('AppVM', label='red', name='test-proxy',
+            template='test-template', provides_network=True)
+        proxy.netvm = self.netvm
+        self.vm.netvm = proxy
+        self.assertEqual(self.app.domains.get_vms_connected_to(self.netvm),
+            {proxy, self.vm})
+        self.assertEqual(
+            self.app.domains.get_vms_connected_directly_to(self.netvm),
+            {proxy})
+
+    def test_003_load(self):
+        self.vm.netvm = self.netvm
+        self.app.save()
+        for lazy in (False, True):
+            app = self.load(lazy=lazy)
+            netvm = app.domains['test-netvm']
+            self.assertEqual(list(netvm.connected_vms),
+                [app.domains['test-vm1']])
+            self.assertEqual(app.domains.get_vms_based_on('test-template'),
+                {app.domains['test-vm1'], netvm})
+
+    def test_004_delete(self):
+        self.vm.netvm = self.netvm
+        del self.app.domains['test-vm1']
+        self.assertEqual(list(self.netvm.connected_vms), [])
+        self.assertEqual(self.app.domains.get_vms_based_on('test-template'),
+            {self.netvm})
+
+    def test_005_qid_reuse(self):
+        self.assertEqual(self.app.domains.get_new_unused_qid(), 4)
+        del self.app.domains['test-vm1']
+        self.assertEqual(self.app.domains.get_new_unused_qid(), 2)
+        self.app.add_new_vm('AppVM', label='red', name='test-vm2',
+            template='test-template')
+        self.assertEqual(self.app.domains.get_new_unused_qid(), 4)
+
+
+class TC_85_MemoizedDefaults(StoreTestCase):
+    def test_000_global_defaults(self):
+        self.assertEqual(self.vm.kernel, '1.0')
+        self.app.default_kernel = '2.0'
+        self.assertEqual(self.vm.kernel, '2.0')
+        self.vm.kernel = None
+        self.app.default_kernel = '3.0'
+        self.assertEqual(self.vm.kernel, '')
+        del self.vm.kernel
+        self.assertEqual(self.vm.kernel, '3.0')
+
+        template = self.app.domains['test-template']
+        self.app.default_dispvm = template
+        self.assertIs(self.vm.default_dispvm, template)
+        self.app.default_dispvm = self.vm
+        self.assertIs(self.vm.default_dispvm, self.vm)
+
+    def test_001_netvm(self):
+        netvm = self.app.add_new_vm('AppVM', label='red', name='test-netvm',
+            template='test-template', provides_network=True)
+        self.assertIsNone(self.vm.netvm)
+        self.assertIsNone(self.vm.ip)
+
+        self.app.default_netvm = netvm
+        self.assertIs(self.vm.netvm, netvm)
+        self.assertEqual(self.vm.ip, '10.137.0.2')
+        # default_fw_netvm
+        self.assertIsNone(netvm.netvm)
+
+        del self.app.default_netvm
+        self.assertIsNone(self.vm.netvm)
+        self.assertIsNone(self.vm.ip)
+
+        self.app.default_netvm = netvm
+        self.vm.provides_network = True
+        self.assertIsNone(self.vm.netvm)
+        # provides network itself
+        self.assertEqual(self.vm.ip, '10.137.0.2')
+
+    def test_002_template(self):
+        template = self.app.domains['test-template']
+        self.assertEqual(self.vm.default_user, 'user')
+        template.default_user = 'someone'
+        self.assertEqual(self.vm.default_user, 'someone')
+
+        template2 = self.app.add_new_vm('TemplateVM', label='black',
+            name='test-template2')
+        self.vm.template = template2
+        self.assertEqual(self.vm.default_user, 'user')
+        template2.default_user = 'someone-else'
+        self.assertEqual(self.vm.default_user, 'someone-else')
+
+    def test_003_pools(self):
+        self.app.default_pool = 'varlibqubes'
+        self.assertEqual(self.app.default_pool_private, 'varlibqubes')
+        self.app.default_pool = 'linux-kernel'
+        self.assertEqual(self.app.default_pool_private, 'linux-kernel')
+        self.app.default_pool_private = 'varlibqubes'
+        self.assertEqual(self.app.default_pool_private, 'varlibqubes')
+
+    def test_003_pools_changed(self):
+        # default_pool depends on the pools, not only on properties
+        self.assertIs(self.app.default_pool_private, self.app.pools['default'])
+        self.app.remove_pool('default')
+        pool = self.app.add_pool('default', driver='file',
+            dir_path=os.path.join(self.tmpdir, 'new-default'))
+        # (default_pool_kernel is set explicitly by load_initial_values())
+        for name in ('default_pool', 'default_pool_private',
+                'default_pool_root', 'default_pool_volatile'):
+            self.assertIs(getattr(self.app, name), pool, name)
+
+    def test_004_load(self):
+        netvm = self.app.add_new_vm('AppVM', label='red', name='test-netvm',
+            template='test-template', provides_network=True)
+        self.app.default_netvm = netvm
+        self.assertIs(self.vm.netvm, netvm)
+        self.app.save()
+
+        app = self.load()
+        self.assertIs(app.domains['test-vm1'].netvm, app.domains['test-netvm'])
+        self.assertEqual(app.domains['test-vm1'].kernel, '1.0')
+        del app.default_netvm
+        self.assertIsNone(app.domains['test-vm1'].netvm)
+
+    def test_005_dependents_bounded(self):
+        # pylint: disable=protected-access
+        vm2 = self.app.add_new_vm('AppVM', label='red', name='test-vm2',
+            template='test-template')
+        for _ in range(10):
+            for vm in (self.vm, vm2):
+                vm._property_changed('kernel')
+                self.assertEqual(vm.kernel, '1.0')
+        template = self.app.default_template
+        self.assertEqual(template.kernel, '1.0')
+        dependents = self.app._property_dependents['default_kernel']
+        self.assertEqual({ref(): names for ref, names in dependents.values()},
+            {template: {'kernel'}, self.vm: {'kernel'}, vm2: {'kernel'}})
+
+        del self.app.domains['test-vm2']
+        del vm2, vm
+        gc.collect()
+        self.assertEqual({ref(): names for ref, names in dependents.values()},
+            {template: {'kernel'}, self.vm: {'kernel'}})
+
+
 class TC_90_Qubes(qubes.tests.QubesTestCase):
     @qubes.tests.skipUnlessDom0
     def test_000_init_empty(self):
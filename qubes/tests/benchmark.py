@@ -0,0 +1,775 @@
+# -*- encoding: utf8 -*-
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, see <http://www.gnu.org/licenses/>.
+
+'''Performance benchmarks.
+
+Those are not run by default, set :envvar:`QUBES_TEST_BENCHMARK` to run them.
+Results are written to standard error.
+'''
+
+import asyncio
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import unittest.mock
+
+import lxml.etree
+
+import qubes
+import qubes.api
+import qubes.api.admin
+import qubes.api.eventbus
+import qubes.app
+import qubes.config
+import qubes.devices
+import qubes.events
+import qubes.tests
+import qubes.tools.qubesd_query
+
+#: number of domains in each of benchmarked collections
+DOMAIN_COUNTS = (10, 100, 1000)
+
+
+class BenchmarkTestCase(qubes.tests.QubesTestCase):
+    '''Base class for benchmarks, with helpers to build large collections'''
+
+    def setUp(self):
+        super().setUp()
+        self.test_base_dir = tempfile.mkdtemp(prefix='qubes-benchmark-')
+        self.addCleanup(shutil.rmtree, self.test_base_dir)
+        for patch in (
+                unittest.mock.patch.dict(qubes.config.system_path,
+                    {'qubes_base_dir': self.test_base_dir}),
+                unittest.mock.patch('qubes.config.qubes_base_dir',
+                    self.test_base_dir),
+                # allow more domains than real system would
+                unittest.mock.patch('qubes.config.max_qid',
+                    max(DOMAIN_COUNTS) + 10),
+                ):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def create_app(self, count):
+        '''Create application with *count* AppVMs (and one template)
+
+        :param int count: number of AppVMs
+        :rtype: :py:class:`qubes.Qubes`
+        '''
+        app = qubes.Qubes(os.path.join(self.test_base_dir, 'qubes.xml'),
+            load=False)
+        app.vmm = unittest.mock.Mock(spec=qubes.app.VMMConnection)
+        app.load_initial_values()
+        app.default_kernel = '1.0'
+        app.default_netvm = None
+        app.clockvm = None
+        app.updatevm = None
+        template = app.add_new_vm('TemplateVM', label='black',
+            name='test-template')
+        app.default_template = template
+        for i in range(count):
+            app.add_new_vm('AppVM', label='red', name='test-vm{}'.format(i),
+                template=template)
+        return app
+
+    @staticmethod
+    def measure(func, repeat=5):
+        '''Call *func* *repeat* times and return the best time, in seconds'''
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            elapsed = time.perf_counter() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        return best
+
+    def report(self, what, **results):
+        '''Write benchmark results to standard error'''
+        sys.stderr.write('\n{}: {}: {}\n'.format(self.id(), what,
+            ' '.join('{}={:.3f}ms'.format(key, value * 1000)
+                for key, value in sorted(results.items()))))
+
+    def report_size(self, what, **results):
+        '''Write memory usage results (in bytes) to standard error'''
+        sys.stderr.write('\n{}: {}: {}\n'.format(self.id(), what,
+            ' '.join('{}={:.1f}KiB'.format(key, value / 1024)
+                for key, value in sorted(results.items()))))
+
+
+@qubes.tests.skipUnlessBenchmark
+class TC_00_Save(BenchmarkTestCase):
+    def test_000_save(self):
+        for count in DOMAIN_COUNTS:
+            app = self.create_app(count)
+            vms = list(app.domains)
+            cold = self.measure(app.save, repeat=1)
+            warm = self.measure(app.save)
+
+            def save_after_change():
+                vms[-1].features['benchmark'] = str(time.time())
+                app.save()
+            changed = self.measure(save_after_change)
+            self.report('save {} domains'.format(len(vms)),
+                cold=cold, warm=warm, one_changed=changed)
+
+
+@qubes.tests.skipUnlessBenchmark
+class TC_01_Load(BenchmarkTestCase):
+    def test_000_load(self):
+        for count in DOMAIN_COUNTS:
+            app = self.create_app(count)
+            app.save()
+
+            def parse():
+                # what load() spends on XML alone, so the most a cache of
+                # parsed qubes.xml could save; it is a small part of load,
+                # which is why there is no such cache
+                xml = lxml.etree.parse(app.store)
+                for node in xml.xpath('./domains/domain'):
+                    node.xpath('./properties/property')
+                    node.xpath('./features/feature')
+                    node.xpath('./devices')
+                    node.xpath('./tags/tag')
+            parsing = self.measure(parse)
+            loading = self.measure(
+                lambda: qubes.Qubes(app.store, offline_mode=True), repeat=3)
+            name = 'test-vm{}'.format(count - 1)
+            loading_lazy = self.measure(
+                lambda: qubes.Qubes(app.store, offline_mode=True,
+                    lazy=True).domains[name], repeat=3)
+            self.report('load {} domains'.format(len(app.domains)),
+                load=loading, lazy_one_domain=loading_lazy, xml=parsing)
+
+
+#: libvirt domain XML of running VM, with some block devices attached
+RUNNING_DOMAIN_XML = '''<domain type="xen">
+  <devices>
+    <disk type="block" device="disk">
+      <source dev="/var/lib/qubes/appvms/test/root.img"/>
+      <target dev="xvda"/>
+    </disk>
+    <disk type="block" device="disk">
+      <source dev="/dev/sda"/>
+      <target dev="xvdi"/>
+    </disk>
+  </devices>
+</domain>'''
+
+
+@qubes.tests.skipUnlessBenchmark
+class TC_02_SaveRunning(BenchmarkTestCase):
+    def test_000_save_running(self):
+        count = 100
+        app = self.create_app(count)
+        for vm in app.domains:
+            if vm.qid == 0:
+                continue
+            vm.events_enabled = False
+            vm.devices['block'].load_persistent(
+                qubes.devices.DeviceAssignment(app.domains[0], 'sda',
+                    persistent=True))
+            vm.events_enabled = True
+        app.vmm.configure_mock(**{
+            'offline_mode': False,
+            'libvirt_conn.lookupByUUID.return_value.isActive.return_value':
+                True,
+            'libvirt_conn.lookupByUUID.return_value.XMLDesc.return_value':
+                RUNNING_DOMAIN_XML,
+        })
+        libvirt_domain = app.vmm.libvirt_conn.lookupByUUID.return_value
+
+        def save_cold():
+            for vm in app.domains:
+                # pylint: disable=protected-access
+                vm._xml_cache = None
+            app.save()
+        libvirt_domain.XMLDesc.reset_mock()
+        saving = self.measure(save_cold)
+        self.assertEqual(libvirt_domain.XMLDesc.call_count, 0)
+
+        def list_attached():
+            # what save() used to do for each domain
+            for vm in app.domains:
+                for devclass in vm.devices:
+                    list(vm.devices[devclass].assignments())
+        listing = self.measure(list_attached)
+        self.assertGreaterEqual(libvirt_domain.XMLDesc.call_count, count)
+
+        self.report('save {} running domains'.format(count),
+            save=saving, list_attached=listing)
+
+
+def _load_store(store, lock, repeat):
+    for _ in range(repeat):
+        app = qubes.Qubes(store, offline_mode=True, lock=lock)
+        if lock:
+            # pylint: disable=protected-access
+            app._release_lock()
+
+
+@qubes.tests.skipUnlessBenchmark
+class TC_03_ConcurrentLoad(BenchmarkTestCase):
+    def test_000_concurrent_load(self):
+        count = 100
+        repeat = 3
+        app = self.create_app(count)
+        app.save()
+        context = multiprocessing.get_context('fork')
+
+        def load_parallel(readers, lock):
+            processes = [context.Process(target=_load_store,
+                    args=(app.store, lock, repeat))
+                for _ in range(readers)]
+            for process in processes:
+                process.start()
+            for process in processes:
+                process.join()
+                self.assertEqual(process.exitcode, 0)
+
+        for readers in (1, 4, 16):
+            shared = self.measure(
+                lambda: load_parallel(readers, False), repeat=1)
+            exclusive = self.measure(
+                lambda: load_parallel(readers, True), repeat=1)
+            self.report('{} readers loading {} domains {} times'.format(
+                    readers, len(app.domains), repeat),
+                shared=shared, exclusive=exclusive)
+
+
+@qubes.tests.skipUnlessBenchmark
+class TC_04_Lookup(BenchmarkTestCase):
+    def test_000_lookup(self):
+        app = self.create_app(max(DOMAIN_COUNTS))
+        names = list(app.domains.names())
+        uuids = [vm.uuid for vm in app.domains if vm.qid != 0]
+
+        def by_name():
+            for name in names:
+                app.domains[name]  # pylint: disable=pointless-statement
+
+        def by_uuid():
+            for vm_uuid in uuids:
+                app.domains[vm_uuid]  # pylint: disable=pointless-statement
+
+        def contains_missing():
+            for name in names:
+                assert name + '-missing' not in app.domains
+
+        def scan_by_name():
+            # what lookup used to do
+            for name in names:
+                next(vm for vm in app.domains if vm.name == name)
+
+        self.report('{} lookups in {} domains'.format(
+                len(names), len(app.domains)),
+            by_name=self.measure(by_name),
+            by_uuid=self.measure(by_uuid),
+            contains_missing=self.measure(contains_missing),
+            scan_by_name=self.measure(scan_by_name, repeat=1))
+
+
+@qubes.tests.skipUnlessBenchmark
+class TC_05_Relations(BenchmarkTestCase):
+    def test_000_relations(self):
+        app = self.create_app(max(DOMAIN_COUNTS))
+        netvm = app.add_new_vm('AppVM', label='red', name='test-netvm',
+            template='test-template', provides_network=True)
+        app.default_netvm = netvm
+        template = app.domains['test-template']
+
+        def scan_based_on():
+            # what get_vms_based_on() used to do
+            return set(vm for vm in app.domains
+                if getattr(vm, 'template', None) == template)
+
+        self.report('relations in {} domains'.format(len(app.domains)),
+            based_on=self.measure(
+                lambda: app.domains.get_vms_based_on(template)),
+            scan_based_on=self.measure(scan_based_on),
+            connected_vms=self.measure(lambda: list(netvm.connected_vms)),
+            unused_qid=self.measure(app.domains.get_new_unused_qid),
+            unused_dispid=self.measure(app.domains.get_new_unused_dispid))
+
+
+@qubes.tests.skipUnlessBenchmark
+class TC_06_Iterate(BenchmarkTestCase):
+    def test_000_iterate(self):
+        for count in DOMAIN_COUNTS:
+            app = self.create_app(count)
+
+            def iterate():
+                for _ in app.domains:
+                    pass
+
+            def iterate_sorting():
+                # what iteration used to do
+                for _ in sorted(app.domains.loaded_vms()):
+                    pass
+
+            self.report('iterate {} domains'.format(len(app.domains)),
+                vms=self.measure(iterate),
+                qids=self.measure(lambda: list(app.domains.qids())),
+                names=self.measure(lambda: list(app.domains.names())),
+                sorting=self.measure(iterate_sorting))
+
+
+@qubes.tests.skipUnlessBenchmark
+class TC_07_Events(BenchmarkTestCase):
+    def test_000_fire_event(self):
+        app = self.create_app(1)
+        vm = app.domains['test-vm0']
+        emitter = qubes.events.Emitter()
+        emitter.events_enabled = True
+        repeat = 10000
+
+        def fire(subject, pre_event=False):
+            for _ in range(repeat):
+                subject.fire_event('benchmark-event', pre_event=pre_event)
+
+        def set_property():
+            for i in range(repeat):
+                vm.memory = 400 + i % 2
+
+        self.report('{} events'.format(repeat),
+            no_handlers=self.measure(lambda: fire(emitter)),
+            vm=self.measure(lambda: fire(vm)),
+            vm_pre=self.measure(lambda: fire(vm, pre_event=True)),
+            vm_property_set=self.measure(set_property))
+
+
+@qubes.tests.skipUnlessBenchmark
+class TC_08_Defaults(BenchmarkTestCase):
+    def test_000_defaults(self):
+        app = self.create_app(max(DOMAIN_COUNTS))
+        netvm = app.add_new_vm('AppVM', label='red', name='test-netvm',
+            template='test-template', provides_network=True)
+        app.default_netvm = netvm
+        names = ('netvm', 'ip', 'kernel', 'default_user', 'default_dispvm',
+            'updateable', 'visible_ip')
+
+        def get_defaults():
+            for vm in app.domains:
+                for name in names:
+                    getattr(vm, name, None)
+
+        def all_properties():
+            # what xml_properties(with_defaults=True) does
+            for vm in app.domains:
+                for prop in vm.property_table().props:
+                    getattr(vm, prop.__name__, None)
+
+        self.report('defaults of {} domains'.format(len(app.domains)),
+            get=self.measure(get_defaults),
+            all_properties=self.measure(all_properties))
+
+
+#: firewall of each domain in :py:class:`TC_09_Memory`
+FIREWALL_XML = '''<firewall version="2"><rules>
+  <rule><properties>
+    <property name="action">accept</property>
+    <property name="specialtarget">dns</property>
+  </properties></rule>
+  <rule><properties>
+    <property name="action">accept</property>
+    <property name="proto">icmp</property>
+  </properties></rule>
+  <rule><properties>
+    <property name="action">accept</property>
+    <property name="proto">tcp</property>
+    <property name="dsthost">192.168.0.0/24</property>
+    <property name="dstports">443</property>
+  </properties></rule>
+  <rule><properties>
+    <property name="action">accept</property>
+    <property name="dsthost">qubes-os.org</property>
+    <property name="comment">updates</property>
+  </properties></rule>
+  <rule><properties>
+    <property name="action">drop</property>
+  </properties></rule>
+</rules></firewall>'''
+
+
+@qubes.tests.skipUnlessBenchmark
+class TC_09_Memory(BenchmarkTestCase):
+    def test_000_memory(self):
+        count = max(DOMAIN_COUNTS)
+        tracemalloc.start()
+        self.addCleanup(tracemalloc.stop)
+
+        start = tracemalloc.get_traced_memory()[0]
+        app = self.create_app(count)
+        vms = [vm for vm in app.domains if vm.qid != 0]
+        for vm in vms:
+            # what storage init would find on a real system
+            for volume in vm.volumes.values():
+                volume.size  # pylint: disable=pointless-statement
+        domains = tracemalloc.get_traced_memory()[0]
+
+        for vm in vms:
+            vm.events_enabled = False
+            for i in range(2):
+                vm.devices['block'].load_persistent(
+                    qubes.devices.DeviceAssignment(app.domains[0],
+                        'sda{}'.format(i), persistent=True))
+            vm.events_enabled = True
+        devices = tracemalloc.get_traced_memory()[0]
+
+        for vm in vms:
+            os.makedirs(vm.dir_path, exist_ok=True)
+            with open(os.path.join(vm.dir_path, vm.firewall_conf), 'w') as f:
+                f.write(FIREWALL_XML)
+            self.assertEqual(len(vm.firewall.rules), 5)
+        firewall = tracemalloc.get_traced_memory()[0]
+
+        per_domains = 1000 / len(vms)
+        self.report_size('memory per 1000 domains',
+            domains=(domains - start) * per_domains,
+            devices=(devices - domains) * per_domains,
+            firewall=(firewall - devices) * per_domains,
+            total=(firewall - start) * per_domains)
+
+
+class _Transport(object):
+    '''In-memory transport for :py:class:`qubes.api.QubesDaemonProtocol`'''
+
+    def __init__(self, loop):
+        self.data = []
+        self.closed = loop.create_future()
+
+    def write(self, data):
+        self.data.append(data)
+
+    def write_eof(self):
+        pass
+
+    def close(self):
+        self.closed.set_result(b''.join(self.data))
+
+    def abort(self):
+        self.closed.set_exception(ConnectionAbortedError())
+
+
+def _api_calls(app, requests):
+    '''Handle Admin API *requests* concurrently, return responses'''
+    loop = asyncio.get_event_loop()
+    transports = []
+    for request in requests:
+        protocol = qubes.api.QubesDaemonProtocol(
+            qubes.api.admin.QubesAdminAPI, app=app)
+        transport = _Transport(loop)
+        protocol.connection_made(transport)
+        protocol.data_received(request)
+        protocol.eof_received()
+        transports.append(transport.closed)
+    responses = loop.run_until_complete(asyncio.gather(*transports))
+    for response in responses:
+        assert response.startswith(b'0\0'), response
+    return [response[2:].decode() for response in responses]
+
+
+@qubes.tests.skipUnlessBenchmark
+class TC_10_API(BenchmarkTestCase):
+    def test_000_throughput(self):
+        app = self.create_app(10)
+        loop = asyncio.get_event_loop()
+        repeat = 1000
+
+        def call(request):
+            transports = []
+            for _ in range(repeat):
+                protocol = qubes.api.QubesDaemonProtocol(
+                    qubes.api.admin.QubesAdminAPI, app=app)
+                transport = _Transport(loop)
+                protocol.connection_made(transport)
+                protocol.data_received(request)
+                protocol.eof_received()
+                transports.append(transport.closed)
+            for response in loop.run_until_complete(
+                    asyncio.gather(*transports)):
+                assert response.startswith(b'0\0'), response
+
+        def list_methods():
+            # what dispatch used to do
+            for _ in range(repeat):
+                list(qubes.api.admin.QubesAdminAPI.list_methods(
+                    'admin.vm.property.Get'))
+
+        self.report('{} requests'.format(repeat),
+            property_get=self.measure(lambda: call(
+                b'dom0\0admin.vm.property.Get\0test-vm0\0label\0')),
+            feature_list=self.measure(lambda: call(
+                b'dom0\0admin.vm.feature.List\0test-vm0\0\0')),
+            label_list=self.measure(lambda: call(
+                b'dom0\0admin.label.List\0dom0\0\0')),
+            list_methods=self.measure(list_methods, repeat=1))
+
+    def test_001_multiplexed(self):
+        app = self.create_app(10)
+        loop = asyncio.get_event_loop()
+        repeat = 1000
+        in_flight = 50
+        sock_path = os.path.join(self.test_base_dir, 'qubesd.sock')
+        server = loop.run_until_complete(loop.create_unix_server(
+            lambda: qubes.api.QubesDaemonProtocol(
+                qubes.api.admin.QubesAdminAPI, app=app),
+            sock_path))
+        self.addCleanup(server.close)
+        request = ('dom0', 'admin.vm.property.Get', 'test-vm0', 'label')
+
+        @asyncio.coroutine
+        def call_v1(semaphore):
+            with (yield from semaphore):
+                reader, writer = yield from asyncio.open_unix_connection(
+                    sock_path)
+                writer.write(b''.join(
+                    field.encode() + b'\0' for field in request))
+                writer.write_eof()
+                response = yield from reader.read()
+                writer.close()
+            assert response.startswith(b'0\0'), response
+
+        @asyncio.coroutine
+        def call_v2(semaphore, conn):
+            with (yield from semaphore):
+                response = yield from conn.call(*request)
+            assert response.startswith(b'0\0'), response
+
+        def v1():
+            semaphore = asyncio.Semaphore(in_flight)
+            loop.run_until_complete(asyncio.gather(
+                *(call_v1(semaphore) for _ in range(repeat))))
+
+        def v2():
+            conn = loop.run_until_complete(
+                qubes.tools.qubesd_query.QubesdConnection.connect(sock_path))
+            semaphore = asyncio.Semaphore(in_flight)
+            loop.run_until_complete(asyncio.gather(
+                *(call_v2(semaphore, conn) for _ in range(repeat))))
+            loop.run_until_complete(conn.close())
+
+        self.report('{} calls, {} in flight'.format(repeat, in_flight),
+            v1_connection_per_call=self.measure(v1),
+            v2_multiplexed=self.measure(v2))
+
+    def test_002_bulk_read(self):
+        app = self.create_app(500)
+        for vm in app.domains:
+            for i in range(5):
+                vm.features['feature{}'.format(i)] = str(i)
+            vm.tags.add('tag1')
+
+        def per_item():
+            names = [line.split(' ')[0] for line in _api_calls(app,
+                [b'dom0\0admin.vm.List\0dom0\0\0'])[0].splitlines()]
+            requests = []
+            for name in names:
+                properties, features, _ = _api_calls(app, [
+                    'dom0\0admin.vm.property.List\0{}\0\0'.format(
+                        name).encode(),
+                    'dom0\0admin.vm.feature.List\0{}\0\0'.format(
+                        name).encode(),
+                    'dom0\0admin.vm.tag.List\0{}\0\0'.format(
+                        name).encode(),
+                ])
+                requests.extend(
+                    'dom0\0admin.vm.property.Get\0{}\0{}\0'.format(
+                        name, prop).encode()
+                    for prop in properties.splitlines())
+                requests.extend(
+                    'dom0\0admin.vm.feature.Get\0{}\0{}\0'.format(
+                        name, feature).encode()
+                    for feature in features.splitlines())
+            _api_calls(app, requests)
+
+        def bulk():
+            _api_calls(app, [
+                b'dom0\0admin.vm.List\0dom0\0\0',
+                b'dom0\0admin.vm.property.GetAll\0dom0\0\0',
+                b'dom0\0admin.vm.feature.GetAll\0dom0\0\0',
+                b'dom0\0admin.vm.tag.ListAll\0dom0\0\0',
+            ])
+
+        self.report('full state of {} qubes'.format(len(app.domains)),
+            per_item=self.measure(per_item, repeat=1),
+            bulk=self.measure(bulk, repeat=3))
+
+    def test_003_set_many(self):
+        app = self.create_app(50)
+        vms = [vm for vm in app.domains if vm.name.startswith('test-vm')]
+        values = [
+            ('vcpus', '2'),
+            ('memory', '500'),
+            ('maxmem', '2000'),
+            ('kernelopts', 'nopat quiet'),
+            ('include_in_backups', 'False'),
+            ('qrexec_timeout', '120'),
+            ('default_user', 'admin'),
+            ('debug', 'True'),
+            ('netvm', ''),
+            ('default_dispvm', ''),
+        ]
+
+        def one_by_one():
+            for vm in vms:
+                _api_calls(app, [
+                    'dom0\0admin.vm.property.Set\0{}\0{}\0{}'.format(
+                        vm.name, name, value).encode()
+                    for name, value in values])
+
+        def set_many():
+            for vm in vms:
+                _api_calls(app, [
+                    'dom0\0admin.vm.property.SetMany\0{}\0\0{}'.format(
+                        vm.name, ''.join('{} {}\n'.format(name, value)
+                            for name, value in values)).encode()])
+
+        self.report('{} properties on {} qubes'.format(len(values), len(vms)),
+            one_by_one=self.measure(one_by_one, repeat=1),
+            set_many=self.measure(set_many, repeat=1))
+
+
+class _SlowTransport(_Transport):
+    """Transport of a client which does not read anything"""
+
+    def __init__(self, loop, protocol, high_water=65536):
+        super().__init__(loop)
+        self.protocol = protocol
+        self.high_water = high_water
+        self.size = 0
+
+    def write(self, data):
+        super().write(data)
+        self.size += len(data)
+        if self.size - len(data) <= self.high_water < self.size:
+            self.protocol.pause_writing()
+
+
+@qubes.tests.skipUnlessBenchmark
+class TC_11_EventsSubscribers(BenchmarkTestCase):
+    def subscribe(self, app, count, transport_class=_Transport, arg=b''):
+        """Start *count* admin.Events calls"""
+        loop = asyncio.get_event_loop()
+        protocols = []
+        for _ in range(count):
+            protocol = qubes.api.QubesDaemonProtocol(
+                qubes.api.admin.QubesAdminAPI, app=app)
+            if transport_class is _SlowTransport:
+                transport = _SlowTransport(loop, protocol)
+            else:
+                transport = transport_class(loop)
+            protocol.connection_made(transport)
+            protocol.data_received(
+                b'dom0\0admin.Events\0dom0\0' + arg + b'\0')
+            protocol.eof_received()
+            protocols.append(protocol)
+        loop.run_until_complete(asyncio.sleep(0.01))
+        return protocols
+
+    def unsubscribe(self, protocols):
+        for protocol in protocols:
+            protocol.connection_lost(None)
+        asyncio.get_event_loop().run_until_complete(asyncio.sleep(0.01))
+
+    def test_000_fanout(self):
+        app = self.create_app(100)
+        vm = app.domains['test-vm0']
+        loop = asyncio.get_event_loop()
+        repeat = 10000
+
+        def fire():
+            for _ in range(repeat):
+                vm.fire_event('benchmark-event', arg='value')
+            loop.run_until_complete(asyncio.sleep(0))
+
+        results = {}
+        for count in (1, 10, 50):
+            protocols = self.subscribe(app, count)
+            results['subscribers_{}'.format(count)] = self.measure(fire)
+            self.unsubscribe(protocols)
+        self.report('{} events'.format(repeat), **results)
+
+    def test_001_slow_client(self):
+        app = self.create_app(1)
+        vm = app.domains['test-vm0']
+        loop = asyncio.get_event_loop()
+        repeat = 100000
+
+        protocols = self.subscribe(app, 1, _SlowTransport)
+        for _ in range(repeat):
+            vm.fire_event('benchmark-event', arg='value')
+        loop.run_until_complete(asyncio.sleep(0))
+        buffered = protocols[0].transport.size
+        self.unsubscribe(protocols)
+        self.report_size('{} events to a client not reading'.format(repeat),
+            buffered=buffered)
+
+    def test_002_resume(self):
+        app = self.create_app(500)
+        vms = [vm for vm in app.domains if vm.name.startswith('test-vm')]
+        bus = qubes.api.eventbus.EventBus.get(app)
+        self.unsubscribe(self.subscribe(app, 1, arg=b'0.0'))
+        sequence = bus.sequence
+        # what happens while the client is disconnected
+        for vm in vms[:100]:
+            vm.memory = 500
+
+        def resync():
+            _api_calls(app, [
+                b'dom0\0admin.vm.List\0dom0\0\0',
+                b'dom0\0admin.vm.property.GetAll\0dom0\0\0',
+                b'dom0\0admin.vm.feature.GetAll\0dom0\0\0',
+                b'dom0\0admin.vm.tag.ListAll\0dom0\0\0',
+            ])
+
+        def resume():
+            protocols = self.subscribe(app, 1,
+                arg='{}.{}'.format(bus.epoch, sequence).encode())
+            data = b''.join(protocols[0].transport.data)
+            assert b'resumed\0True\0' in data, data
+            self.unsubscribe(protocols)
+
+        self.report('reconnect after {} changes in {} qubes'.format(
+                len(vms) // 5, len(app.domains)),
+            full_resync=self.measure(resync, repeat=3),
+            resume=self.measure(resume, repeat=3))
+
+    def test_003_coalesce(self):
+        app = self.create_app(100)
+        vms = [vm for vm in app.domains if vm.name.startswith('test-vm')]
+        loop = asyncio.get_event_loop()
+
+        def storm(arg):
+            protocols = self.subscribe(app, 1, arg=arg)
+            for i in range(10):
+                for vm in vms:
+                    vm.memory = 400 + i
+                    vm.tags.add('tag{}'.format(i % 2))
+            loop.run_until_complete(asyncio.sleep(
+                qubes.api.eventbus.DEFAULT_COALESCE_WINDOW * 2))
+            sent = sum(len(data) for data in protocols[0].transport.data)
+            self.unsubscribe(protocols)
+            return sent
+
+        self.report_size('10 changes of {} qubes'.format(len(vms)),
+            all_events=storm(b''),
+            coalesce=storm(b'coalesce'),
+            coalesce_nopre=storm(b'coalesce+nopre'))
@@ -153,6 +153,17 @@ class TC_00_DeviceCollection(qubes.tests.QubesTestCase):
         self.assertEqual({self.device}, set(self.collection))
         self.assertEventFired(self.emitter, 'device-list:testclass')
 
+    def test_016_list_assignments_persistent(self):
+        self.loop.run_until_complete(self.collection.attach(self.assignment))
+        self.emitter.fired_events.clear()
+        self.assertEqual({self.assignment},
+            self.collection.assignments(persistent=True))
+        # saving qubes.xml should not ask the VM (and the hypervisor)
+        self.assertEventNotFired(self.emitter,
+            'device-list-attached:testclass')
+        self.assertEqual({self.assignment}, self.collection.assignments())
+        self.assertEventFired(self.emitter, 'device-list-attached:testclass')
+
 
 class TC_01_DeviceManager(qubes.tests.QubesTestCase):
     def setUp(self):
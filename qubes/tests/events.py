@@ -168,3 +168,184 @@ class TC_00_Emitter(qubes.tests.QubesTestCase):
 
         self.assertCountEqual(effect,
             ('testvalue1', 'testvalue2', 'testvalue3', 'testvalue4'))
+
+    def test_006_class_handlers_changed(self):
+        class TestEmitter(qubes.events.Emitter):
+            @qubes.events.handler('testevent')
+            def on_testevent_1(self, event):
+                yield 'testevent_1'
+
+        class TestSubEmitter(TestEmitter):
+            pass
+
+        def on_testevent_2(subject, event):
+            yield 'testevent_2'
+
+        emitter = TestSubEmitter()
+        emitter.events_enabled = True
+        self.assertEqual(emitter.fire_event('testevent'), ['testevent_1'])
+
+        # like qubes.ext.Extension does
+        TestEmitter.__handlers__['testevent'].add(on_testevent_2)
+        self.assertEqual(emitter.fire_event('testevent'),
+            ['testevent_1', 'testevent_2'])
+
+        TestEmitter.__handlers__['testevent'].remove(on_testevent_2)
+        self.assertEqual(emitter.fire_event('testevent'), ['testevent_1'])
+
+        TestSubEmitter.__handlers__['*'] = {on_testevent_2}
+        self.assertEqual(emitter.fire_event('otherevent'), ['testevent_2'])
+        self.assertEqual(emitter.fire_event('testevent', pre_event=True),
+            ['testevent_2', 'testevent_1'])
+
+    def test_007_no_handlers(self):
+        emitter = qubes.events.Emitter()
+        emitter.events_enabled = True
+        self.assertEqual(emitter.fire_event('testevent'), [])
+        emitter.add_handler('testevent', lambda subject, event: ['effect'])
+        self.assertEqual(emitter.fire_event('testevent'), ['effect'])
+        self.assertEqual(emitter.fire_event('otherevent'), [])
+
+    def test_008_profiling(self):
+        class TestEmitter(qubes.events.Emitter):
+            @qubes.events.handler('testevent')
+            def on_testevent(self, event):
+                yield 'testevent_1'
+
+        emitter = TestEmitter()
+        emitter.events_enabled = True
+        handler_profile = qubes.events.enable_profiling(slow_threshold=0)
+        self.addCleanup(qubes.events.disable_profiling)
+
+        with self.assertLogs('qubes.events', 'WARNING'):
+            self.assertEqual(emitter.fire_event('testevent'), ['testevent_1'])
+            emitter.fire_event('testevent')
+        name = qubes.events.handler_name(TestEmitter.on_testevent)
+        self.assertEqual(list(handler_profile.stats), [('testevent', name)])
+        calls, total, max_time = handler_profile.stats['testevent', name]
+        self.assertEqual(calls, 2)
+        self.assertGreaterEqual(total, max_time)
+
+        handler_profile.reset()
+        self.assertEqual(handler_profile.stats, {})
+
+        qubes.events.disable_profiling()
+        emitter.fire_event('testevent')
+        self.assertEqual(handler_profile.stats, {})
+
+    def test_009_profiling_async(self):
+        class TestEmitter(qubes.events.Emitter):
+            @qubes.events.handler('testevent')
+            @asyncio.coroutine
+            def on_testevent(self, event):
+                yield from asyncio.sleep(0.01)
+                return ['testvalue']
+
+        loop = asyncio.get_event_loop()
+        emitter = TestEmitter()
+        emitter.events_enabled = True
+        handler_profile = qubes.events.enable_profiling()
+        self.addCleanup(qubes.events.disable_profiling)
+
+        effect = loop.run_until_complete(emitter.fire_event_async('testevent'))
+        self.assertEqual(effect, ['testvalue'])
+        name = qubes.events.handler_name(TestEmitter.on_testevent)
+        calls, total, _ = handler_profile.stats['testevent', name]
+        self.assertEqual(calls, 1)
+        self.assertGreaterEqual(total, 0.01)
+
+    def test_010_async_timeout(self):
+        class TestEmitter(qubes.events.Emitter):
+            @qubes.events.handler('testevent')
+            @asyncio.coroutine
+            def on_testevent_slow(self, event):
+                yield from asyncio.sleep(10)
+                return ['slow']
+
+            @qubes.events.handler('testevent')
+            @asyncio.coroutine
+            def on_testevent_fast(self, event):
+                return ['fast']
+
+        loop = asyncio.get_event_loop()
+        emitter = TestEmitter()
+        emitter.events_enabled = True
+        qubes.events.set_async_limits('testevent', timeout=0.01)
+        self.addCleanup(qubes.events.set_async_limits, 'testevent')
+
+        with self.assertLogs('qubes.events', 'WARNING'):
+            with self.assertRaises(
+                    qubes.exc.QubesEventHandlerTimeoutError) as e:
+                loop.run_until_complete(emitter.fire_event_async('testevent'))
+        self.assertEqual(e.exception.event, 'testevent')
+        self.assertEqual(e.exception.handlers,
+            [qubes.events.handler_name(TestEmitter.on_testevent_slow)])
+
+        # other events are not limited
+        qubes.events.set_async_limits('otherevent', timeout=0.01)
+        self.addCleanup(qubes.events.set_async_limits, 'otherevent')
+        self.assertEqual(
+            loop.run_until_complete(emitter.fire_event_async('otherevent')),
+            [])
+
+    def test_011_async_max_parallel(self):
+        running = [0, 0]
+
+        @asyncio.coroutine
+        def handler(event):
+            running[0] += 1
+            running[1] = max(running)
+            yield from asyncio.sleep(0.01)
+            running[0] -= 1
+            return [event]
+
+        class TestEmitter(qubes.events.Emitter):
+            @qubes.events.handler('testevent')
+            @asyncio.coroutine
+            def on_testevent_1(self, event):
+                return (yield from handler(event))
+
+            @qubes.events.handler('testevent')
+            @asyncio.coroutine
+            def on_testevent_2(self, event):
+                return (yield from handler(event))
+
+            @qubes.events.handler('testevent')
+            @asyncio.coroutine
+            def on_testevent_3(self, event):
+                return (yield from handler(event))
+
+        loop = asyncio.get_event_loop()
+        emitter = TestEmitter()
+        emitter.events_enabled = True
+        qubes.events.set_async_limits('*', max_parallel=1)
+        self.addCleanup(qubes.events.set_async_limits, '*')
+
+        effect = loop.run_until_complete(emitter.fire_event_async('testevent'))
+        self.assertEqual(effect, ['testevent'] * 3)
+        self.assertEqual(running[1], 1)
+
+    def test_012_prefix_wildcard(self):
+        class TestEmitter(qubes.events.Emitter):
+            def __init__(self):
+                super(TestEmitter, self).__init__()
+                self.fired_events = []
+
+            @qubes.events.handler('testevent:*')
+            def on_testevent(self, event):
+                self.fired_events.append(event)
+
+        emitter = TestEmitter()
+        emitter.events_enabled = True
+        emitter.fire_event('testevent:spam')
+        emitter.fire_event('testevent')
+        emitter.fire_event('testevent-other:spam')
+        self.assertEqual(emitter.fired_events, ['testevent:spam'])
+
+        def on_testevent(subject, event):
+            # pylint: disable=unused-argument
+            emitter.fired_events.append('instance:' + event)
+        emitter.add_handler('testevent:*', on_testevent)
+        emitter.fire_event('testevent:eggs')
+        self.assertEqual(emitter.fired_events,
+            ['testevent:spam', 'testevent:eggs', 'instance:testevent:eggs'])
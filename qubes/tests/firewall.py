@@ -484,6 +484,56 @@ class TC_08_Rule(qubes.tests.QubesTestCase):
         self.assertEqual(rule.api_rule, rule_txt)
 
 
+class TC_09_RuleValue(qubes.tests.QubesTestCase):
+    def test_000_same_as_rule(self):
+        for kwargs in (
+                {'action': 'accept'},
+                {'action': 'drop', 'proto': 'tcp', 'dstports': 80,
+                    'dsthost': '192.168.0.0/24', 'comment': 'some comment'},
+                {'action': 'accept', 'proto': 'icmp', 'icmptype': 8,
+                    'expire': '1663292452'},
+                {'action': 'accept', 'specialtarget': 'dns'}):
+            rule = qubes.firewall.Rule(None, **kwargs)
+            value = qubes.firewall.RuleValue(**kwargs)
+            self.assertEqual(value.rule, rule.rule)
+            self.assertEqual(value.api_rule, rule.api_rule)
+            self.assertEqual(
+                lxml.etree.tostring(value.xml_properties()),
+                lxml.etree.tostring(rule.xml_properties()))
+            self.assertEqual(value, rule)
+            self.assertEqual(rule, value)
+            self.assertEqual(hash(value), hash(rule))
+            self.assertEqual(qubes.firewall.RuleValue.from_rule(rule), rule)
+
+            xml_rule = lxml.etree.Element('rule')
+            xml_rule.append(rule.xml_properties())
+            self.assertEqual(qubes.firewall.RuleValue.from_xml(xml_rule),
+                rule)
+
+    def test_001_reject_invalid(self):
+        with self.assertRaises((ValueError, AssertionError)):
+            qubes.firewall.RuleValue(proto='icmp')
+        with self.assertRaises(ValueError):
+            qubes.firewall.RuleValue(action='accept', proto='icmp',
+                dstports=80)
+        with self.assertRaises(ValueError):
+            qubes.firewall.RuleValue(action='accept', icmptype=8)
+        with self.assertRaises(ValueError):
+            qubes.firewall.RuleValue(action='reject')
+        with self.assertRaises(TypeError):
+            qubes.firewall.RuleValue(action='accept', unknown='value')
+
+    def test_002_read_only(self):
+        value = qubes.firewall.RuleValue(action='accept', proto='tcp')
+        with self.assertRaises(AttributeError):
+            value.proto = 'udp'
+        with self.assertRaises(AttributeError):
+            del value.proto
+        with self.assertRaises(AttributeError):
+            value.other = 'value'
+        self.assertEqual(value.api_rule, 'action=accept proto=tcp')
+
+
 class TC_10_Firewall(qubes.tests.QubesTestCase):
     def setUp(self):
         super(TC_10_Firewall, self).setUp()
@@ -585,3 +635,16 @@ class TC_10_Firewall(qubes.tests.QubesTestCase):
             '0003': 'action=accept specialtarget=dns',
         }
         self.assertEqual(fw.qdb_entries(), expected_qdb_entries)
+
+    def test_006_clone(self):
+        fw = qubes.firewall.Firewall(self.vm, True)
+        fw.rules = [
+            qubes.firewall.RuleValue(action='drop', proto='icmp'),
+            qubes.firewall.Rule(None, action='accept', proto='udp'),
+        ]
+        fw2 = qubes.firewall.Firewall(TestVM(), False)
+        fw2.clone(fw)
+        self.assertEqual(fw2.rules, fw.rules)
+        # read-only rules are shared, others copied
+        self.assertIs(fw2.rules[0], fw.rules[0])
+        self.assertIsInstance(fw2.rules[1], qubes.firewall.RuleValue)
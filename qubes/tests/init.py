@@ -112,6 +112,78 @@ class TC_10_property(qubes.tests.QubesTestCase):
         holder.testprop1 = 'testvalue'
         self.assertEqual(holder.testprop1, 'testvalue')
 
+    def test_024_get_default_memoized(self):
+        calls = []
+
+        class MyTestHolder(qubes.tests.TestEmitter, qubes.PropertyHolder):
+            testprop1 = qubes.property('testprop1')
+            testprop2 = qubes.property('testprop2',
+                default=(lambda self: calls.append(self) or
+                    'default-' + self.testprop1),
+                default_depends=('testprop1',))
+        holder = MyTestHolder(None)
+        holder.testprop1 = 'a'
+
+        self.assertEqual(holder.testprop2, 'default-a')
+        self.assertEqual(holder.testprop2, 'default-a')
+        self.assertEqual(len(calls), 1)
+
+        holder.testprop1 = 'b'
+        self.assertEqual(holder.testprop2, 'default-b')
+        self.assertEqual(len(calls), 2)
+
+        holder.testprop2 = 'testvalue'
+        self.assertEqual(holder.testprop2, 'testvalue')
+        del holder.testprop2
+        self.assertEqual(holder.testprop2, 'default-b')
+
+        del holder.testprop1
+        with self.assertRaises(AttributeError):
+            holder.testprop2
+
+    def test_025_get_default_memoized_other(self):
+        class MyTestHolder(qubes.tests.TestEmitter, qubes.PropertyHolder):
+            testprop1 = qubes.property('testprop1', default='x')
+            testprop2 = qubes.property('testprop2',
+                default=(lambda self: self.other.testprop2 + '!'),
+                default_depends=('other.testprop2',))
+            testprop3 = qubes.property('testprop3',
+                default=(lambda self: self.testprop2 + '?'),
+                default_depends=('testprop2',))
+            other = qubes.property('other', default=None)
+        other = MyTestHolder(None)
+        holder = MyTestHolder(None)
+        holder.other = other
+
+        # property of other holder
+        with self.assertRaises(AttributeError):
+            holder.testprop2
+        other.testprop2 = 'a'
+        self.assertEqual(holder.testprop2, 'a!')
+        self.assertEqual(holder.testprop3, 'a!?')
+        other.testprop2 = 'b'
+        self.assertEqual(holder.testprop2, 'b!')
+        # memoized default depending on other memoized default
+        self.assertEqual(holder.testprop3, 'b!?')
+
+        other2 = MyTestHolder(None)
+        other2.testprop2 = 'c'
+        holder.other = other2
+        self.assertEqual(holder.testprop3, 'c!?')
+        other.testprop2 = 'd'
+        self.assertEqual(holder.testprop3, 'c!?')
+
+        # changes of objects which are not property holders are not tracked,
+        # neither are those of unrelated properties
+        class Plain(object):
+            testprop2 = 'e'
+        holder.other = Plain()
+        self.assertEqual(holder.testprop2, 'e!')
+        holder.other.testprop2 = 'f'
+        self.assertEqual(holder.testprop2, 'e!')
+        holder.testprop1 = 'y'
+        self.assertEqual(holder.testprop2, 'e!')
+
     def test_030_set_setter(self):
         def setter(self2, prop, value):
             self.assertIs(self2, holder)
@@ -281,6 +353,36 @@ class TC_20_PropertyHolder(qubes.tests.QubesTestCase):
         expected_prop3.text = 'testdefault'
         self.assertXMLEqual(elements_with_defaults[2], expected_prop3)
 
+    def test_007_property_list_load_stage(self):
+        class MyTestHolder(qubes.tests.TestEmitter, qubes.PropertyHolder):
+            testprop1 = qubes.property('testprop1', load_stage=4)
+            testprop2 = qubes.property('testprop2')
+        self.assertEqual(MyTestHolder.property_list(load_stage=4),
+            [MyTestHolder.testprop1])
+        self.assertEqual(MyTestHolder.property_list(load_stage=2),
+            [MyTestHolder.testprop2])
+        self.assertEqual(MyTestHolder.property_list(load_stage=3), [])
+
+    def test_008_property_added(self):
+        class MyTestHolder(qubes.tests.TestEmitter, qubes.PropertyHolder):
+            testprop1 = qubes.property('testprop1')
+        class MySubHolder(MyTestHolder):
+            pass
+        self.assertEqual(MySubHolder.property_list(),
+            [MyTestHolder.testprop1])
+
+        MyTestHolder.testprop2 = qubes.property('testprop2')
+        self.assertEqual(MySubHolder.property_list(),
+            [MyTestHolder.testprop1, MyTestHolder.testprop2])
+        self.assertIs(MySubHolder.property_get_def('testprop2'),
+            MyTestHolder.testprop2)
+
+        del MyTestHolder.testprop1
+        self.assertEqual(MySubHolder.property_list(),
+            [MyTestHolder.testprop2])
+        with self.assertRaises(AttributeError):
+            MySubHolder.property_get_def('testprop1')
+
     @unittest.skip('test not implemented')
     def test_010_property_require(self):
         pass
@@ -324,7 +426,7 @@ class TC_30_VMCollection(qubes.tests.QubesTestCase):
         self.testvm2 = TestVM(None, None, qid=2, name='testvm2')
 
     def test_000_contains(self):
-        self.vms._dict = {1: self.testvm1}
+        self.vms.add(self.testvm1)
 
         self.assertIn(1, self.vms)
         self.assertIn('testvm1', self.vms)
@@ -335,7 +437,7 @@ class TC_30_VMCollection(qubes.tests.QubesTestCase):
         self.assertNotIn(self.testvm2, self.vms)
 
     def test_001_getitem(self):
-        self.vms._dict = {1: self.testvm1}
+        self.vms.add(self.testvm1)
 
         self.assertIs(self.vms[1], self.testvm1)
         self.assertIs(self.vms['testvm1'], self.testvm1)
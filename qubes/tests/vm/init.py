@@ -147,6 +147,42 @@ class TC_10_BaseVM(qubes.tests.QubesTestCase):
         xml = vm.__xml__()
         self.assertNotIn('nxproperty', xml)
 
+    def test_003_save_cached(self):
+        vm = TestVM(None, None, qid=1, name='testvm')
+        vm.events_enabled = True
+        xml = vm.__xml__()
+        self.assertEqual(xml.xpath('properties/property[@name="testprop"]'),
+            [])
+        # returned element must not be the cached one
+        xml.find('properties').clear()
+        self.assertEqual(
+            len(vm.__xml__().xpath('properties/property[@name="qid"]')), 1)
+
+        vm.testprop = 'testvalue'
+        self.assertEqual(vm.__xml__().xpath(
+            'properties/property[@name="testprop"]/text()'), ['testvalue'])
+        del vm.testprop
+        self.assertEqual(vm.__xml__().xpath(
+            'properties/property[@name="testprop"]'), [])
+
+        vm.features['testfeature'] = 'aqq'
+        self.assertEqual(vm.__xml__().xpath(
+            'features/feature[@name="testfeature"]/text()'), ['aqq'])
+        del vm.features['testfeature']
+        self.assertEqual(vm.__xml__().xpath('features/feature'), [])
+
+        vm.tags.add('testtag')
+        self.assertEqual(vm.__xml__().xpath('tags/tag/@name'), ['testtag'])
+        vm.tags.remove('testtag')
+        self.assertEqual(vm.__xml__().xpath('tags/tag'), [])
+
+    def test_004_save_events_disabled(self):
+        vm = TestVM(None, None, qid=1, name='testvm')
+        vm.__xml__()
+        vm.testprop = 'testvalue'
+        self.assertEqual(vm.__xml__().xpath(
+            'properties/property[@name="testprop"]/text()'), ['testvalue'])
+
 
 class TC_20_Tags(qubes.tests.QubesTestCase):
     def setUp(self):
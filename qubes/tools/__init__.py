@@ -309,6 +309,8 @@ class QubesArgumentParser(argparse.ArgumentParser):
             - '?' consumes zero or one arguments
             - '*' consumes zero or more arguments (and produces a list)
             - '+' consumes one or more arguments (and produces a list)
+    :param bool want_app_lazy: load domains of :py:class:`qubes.Qubes` \
+        object on first access, for tools dealing only with a few of them
 
     *kwargs* are passed to :py:class:`argparser.ArgumentParser`.
 
@@ -320,12 +322,14 @@ class QubesArgumentParser(argparse.ArgumentParser):
     '''
 
     def __init__(self, want_app=True, want_app_no_instance=False,
-                 want_force_root=False, vmname_nargs=None, **kwargs):
+                 want_force_root=False, vmname_nargs=None,
+                 want_app_lazy=False, **kwargs):
 
         super(QubesArgumentParser, self).__init__(**kwargs)
 
         self._want_app = want_app
         self._want_app_no_instance = want_app_no_instance
+        self._want_app_lazy = want_app_lazy
         self._want_force_root = want_force_root
         self._vmname_nargs = vmname_nargs
         if self._want_app:
@@ -360,7 +364,7 @@ class QubesArgumentParser(argparse.ArgumentParser):
         if self._want_app and not self._want_app_no_instance:
             self.set_qubes_verbosity(namespace)
             namespace.app = qubes.Qubes(namespace.app,
-                offline_mode=namespace.offline_mode)
+                offline_mode=namespace.offline_mode, lazy=self._want_app_lazy)
 
         if self._want_force_root:
             self.dont_run_as_root(namespace)
@@ -10,7 +10,11 @@ import qubes
 import qubes.api
 import qubes.api.admin
 import qubes.api.internal
+import qubes.api.metrics
 import qubes.api.misc
+import qubes.api.scheduler
+import qubes.config
+import qubes.events
 import qubes.utils
 import qubes.vm.qubesvm
 
@@ -24,6 +28,12 @@ parser = qubes.tools.QubesArgumentParser(description='Qubes OS daemon')
 parser.add_argument('--debug', action='store_true', default=False,
     help='Enable verbose error logging (all exceptions with full '
          'tracebacks) and also send tracebacks to Admin API clients')
+parser.add_argument('--journal', action='store_true', default=False,
+    help='Append changes to a journal next to qubes.xml, instead of '
+         'rewriting whole qubes.xml on each change')
+parser.add_argument('--profile-events', action='store_true', default=False,
+    help='Collect timing statistics of event handlers (see '
+         'admin.events.Profile) and log the slow ones')
 
 def main(args=None):
     loop = asyncio.get_event_loop()
@@ -35,12 +45,27 @@ def main(args=None):
         raise
 
     args.app.vmm.register_event_handlers(args.app)
+    args.app.save_delay = qubes.config.defaults['save_delay']
+    args.app.journal_enabled = args.journal
+    scheduler = qubes.api.scheduler.CallScheduler.get(args.app)
+    scheduler.source_limits.update(qubes.config.defaults['api_source_limits'])
+    scheduler.lane_limits.update(qubes.config.defaults['api_lane_limits'])
+    scheduler.max_queued = qubes.config.defaults['api_max_queued']
+    for event, (timeout, max_parallel) in \
+            qubes.config.defaults['async_handler_limits'].items():
+        qubes.events.set_async_limits(event, timeout=timeout,
+            max_parallel=max_parallel)
+    if args.profile_events:
+        qubes.events.enable_profiling(
+            qubes.config.defaults['slow_handler_threshold'])
 
     servers = loop.run_until_complete(qubes.api.create_servers(
         qubes.api.admin.QubesAdminAPI,
         qubes.api.internal.QubesInternalAPI,
         qubes.api.misc.QubesMiscAPI,
         app=args.app, debug=args.debug))
+    servers.append(loop.run_until_complete(
+        qubes.api.metrics.create_metrics_server(args.app)))
 
     socknames = []
     for server in servers:
@@ -67,6 +92,8 @@ def main(args=None):
                     'socket {} got unlinked sometime before shutdown'.format(
                         sockname))
     finally:
+        # write changes postponed by app.schedule_save()
+        args.app.flush_save()
         loop.close()
 
 if __name__ == '__main__':
@@ -3,14 +3,25 @@
 import argparse
 import asyncio
 import signal
+import struct
 import sys
 
 QUBESD_SOCK = '/var/run/qubesd.sock'
 
+# multiplexed (version 2) protocol, see qubes.api.QubesDaemonProtocol;
+# not imported from there to keep this tool lightweight
+V2_MAGIC = b'\0QubesAPI/2\n'
+V2_HEADER = struct.Struct('!IBI')
+FRAME_CALL = 0
+FRAME_CANCEL = 1
+FRAME_DATA = 2
+FRAME_END = 3
+FRAME_ABORT = 4
+
 try:
     asyncio.ensure_future
 except AttributeError:
-    asyncio.ensure_future = asyncio.async
+    asyncio.ensure_future = getattr(asyncio, 'async')
 
 parser = argparse.ArgumentParser(
     description='low-level qubesd interrogation tool')
@@ -80,6 +91,126 @@ def qubesd_client(socket, payload, *args):
     finally:
         writer.close()
 
+class QubesdConnection(object):
+    '''Long-lived connection to qubesd, with many calls in progress at once
+
+    Uses multiplexed (version 2) protocol. Each call gets a response in the
+    same format as it would get over a separate (version 1) connection.
+
+    >>> conn = yield from QubesdConnection.connect()
+    >>> response = yield from conn.call('dom0', 'admin.vm.List', 'dom0')
+
+    :param reader: :py:class:`asyncio.StreamReader` of established connection
+    :param writer: :py:class:`asyncio.StreamWriter` of established connection
+    '''
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self._next_request_id = 0
+        #: calls in progress: request id -> (received data, future)
+        self._calls = {}
+        self._reader_task = asyncio.ensure_future(self._read_frames())
+
+    @classmethod
+    @asyncio.coroutine
+    def connect(cls, socket=QUBESD_SOCK, timeout=5):
+        '''Connect to qubesd and negotiate multiplexed protocol
+
+        qubesd without multiplexed protocol support waits for the end of
+        the request instead of answering, so give up after *timeout*.
+
+        :param socket: path to qubesd socket
+        :param timeout: how long to wait for qubesd to confirm the protocol
+        :rtype: QubesdConnection
+        '''
+        reader, writer = yield from asyncio.open_unix_connection(socket)
+        writer.write(V2_MAGIC)
+        try:
+            magic = yield from asyncio.wait_for(
+                reader.readexactly(len(V2_MAGIC)), timeout)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError):
+            magic = None
+        if magic != V2_MAGIC:
+            writer.close()
+            raise ConnectionError(
+                'qubesd does not support multiplexed protocol')
+        return cls(reader, writer)
+
+    @asyncio.coroutine
+    def call(self, src, method, dest, arg='', payload=b''):
+        '''Call qubesd method
+
+        Cancelling the coroutine cancels the call on qubesd side.
+
+        :param src: source qube
+        :param method: method name
+        :param dest: destination qube
+        :param arg: argument to method
+        :param payload: payload of the request
+        :return: whole response, empty if qubesd aborted the call
+        :rtype: bytes
+        '''
+        if self._reader_task.done():
+            raise ConnectionError('connection to qubesd closed')
+
+        request_id = self._next_request_id
+        self._next_request_id = (request_id + 1) % 2**32
+        future = asyncio.get_event_loop().create_future()
+        self._calls[request_id] = ([], future)
+
+        body = b''.join(field.encode('ascii') + b'\0'
+            for field in (src, method, dest, arg)) + payload
+        self.writer.write(
+            V2_HEADER.pack(request_id, FRAME_CALL, len(body)) + body)
+
+        try:
+            return (yield from future)
+        except asyncio.CancelledError:
+            if self._calls.pop(request_id, None) is not None:
+                self.writer.write(V2_HEADER.pack(request_id, FRAME_CANCEL, 0))
+            raise
+
+    @asyncio.coroutine
+    def _read_frames(self):
+        try:
+            while True:
+                request_id, frame_type, length = V2_HEADER.unpack(
+                    (yield from self.reader.readexactly(V2_HEADER.size)))
+                data = yield from self.reader.readexactly(length)
+                if request_id not in self._calls:
+                    # cancelled call
+                    continue
+                if frame_type == FRAME_DATA:
+                    self._calls[request_id][0].append(data)
+                    continue
+                chunks, future = self._calls.pop(request_id)
+                if future.done():
+                    continue
+                if frame_type == FRAME_END:
+                    future.set_result(b''.join(chunks))
+                else:
+                    future.set_result(b'')
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            for _, future in self._calls.values():
+                if not future.done():
+                    future.set_exception(
+                        ConnectionError('connection to qubesd closed'))
+            self._calls.clear()
+
+    @asyncio.coroutine
+    def close(self):
+        '''Close the connection, failing all calls in progress'''
+        self.writer.close()
+        self._reader_task.cancel()
+        try:
+            yield from self._reader_task
+        except asyncio.CancelledError:
+            pass
+
+
 def main(args=None):
     args = parser.parse_args(args)
     loop = asyncio.get_event_loop()
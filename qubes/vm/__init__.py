@@ -25,6 +25,7 @@
 
 '''
 
+import copy
 import datetime
 import os
 import re
@@ -261,6 +262,11 @@ class BaseVM(qubes.PropertyHolder):
     This class is responsible for serializing and deserialising machines and
     provides basic framework. It contains no management logic. For that, see
     :py:class:`qubes.vm.qubesvm.QubesVM`.
+
+    Serialised form of the domain is cached between calls to
+    :py:meth:`__xml__` and dropped by :py:meth:`on_xml_dirty` whenever
+    anything it contains may have changed. Since the cache depends on events,
+    it is used only when :py:attr:`events_enabled` is set.
     '''
     # pylint: disable=no-member
 
@@ -273,6 +279,9 @@ class BaseVM(qubes.PropertyHolder):
         #: mother :py:class:`qubes.Qubes` object
         self.app = app
 
+        #: cached ``<domain>`` element, see :py:meth:`__xml__`
+        self._xml_cache = None
+
         super(BaseVM, self).__init__(xml, **kwargs)
 
         #: dictionary of features of this qube
@@ -328,7 +337,31 @@ class BaseVM(qubes.PropertyHolder):
         '''Initialise logger for this domain.'''
         self.log = qubes.log.get_vm_logger(self.name)
 
+    @qubes.events.handler('property-set:*', 'property-del:*',
+        'clone-properties',
+        'domain-feature-set', 'domain-feature-delete',
+        'domain-tag-add', 'domain-tag-delete',
+        'device-attach:*', 'device-detach:*')
+    def on_xml_dirty(self, event, **kwargs):
+        '''Drop cached serialised form when it may have changed'''
+        # pylint: disable=unused-argument
+        self._xml_cache = None
+
     def __xml__(self):
+        if not self.events_enabled:
+            # changes are not tracked, so the cache can't be trusted
+            self._xml_cache = None
+            return self._xml_domain()
+
+        if self._xml_cache is None:
+            self._xml_cache = self._xml_domain()
+        return copy.deepcopy(self._xml_cache)
+
+    def _xml_domain(self):
+        '''Serialise the domain, without using the cache.
+
+        :rtype: lxml.etree._Element
+        '''
         element = lxml.etree.Element('domain')
         element.set('id', 'domain-' + str(self.qid))
         element.set('class', self.__class__.__name__)
@@ -87,6 +87,7 @@ class NetVMMixin(qubes.events.Emitter):
 
     ip = qubes.property('ip', type=str,
         default=_default_ip,
+        default_depends=('provides_network', 'netvm', 'qid', 'dispid'),
         setter=_setter_ip,
         doc='IP address of this domain.')
 
@@ -94,6 +95,8 @@ class NetVMMixin(qubes.events.Emitter):
     netvm = qubes.VMProperty('netvm', load_stage=4, allow_none=True,
         default=(lambda self: self.app.default_fw_netvm if self.provides_network
             else self.app.default_netvm),
+        default_depends=('provides_network', 'app.default_fw_netvm',
+            'app.default_netvm'),
         setter=_setter_netvm,
         doc='''VM that provides network connection to this domain. When
             `None`, machine is disconnected. When absent, domain uses default
@@ -165,9 +168,9 @@ class NetVMMixin(qubes.events.Emitter):
         ''' Return a generator containing all domains connected to the current
             NetVM.
         '''
-        for vm in self.app.domains:
-            if getattr(vm, 'netvm', None) is self:
-                yield vm
+        connected = self.app.domains.get_vms_connected_directly_to(self)
+        for vm in sorted(connected):
+            yield vm
 
     #
     # used in both
@@ -390,6 +390,7 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
         setter=_setter_positive_int,
         default=(lambda self:
             qubes.config.defaults['hvm_memory' if self.hvm else 'memory']),
+        default_depends=('hvm',),
         doc='Memory currently available for this VM.')
 
     maxmem = qubes.property('maxmem', type=int,
@@ -414,6 +415,7 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
     kernel = qubes.property('kernel', type=str,
         setter=_setter_kernel,
         default=(lambda self: self.app.default_kernel),
+        default_depends=('app.default_kernel',),
         doc='Kernel used by this domain.')
 
     # CORE2: swallowed uses_default_kernelopts
@@ -437,6 +439,7 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
         # pylint: disable=no-member
         default=(lambda self: self.template.default_user
             if hasattr(self, 'template') else 'user'),
+        default_depends=('template.default_user',),
         setter=_setter_default_user,
         doc='FIXME')
 
@@ -477,10 +480,12 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
         load_stage=4,
         allow_none=True,
         default=(lambda self: self.app.default_dispvm),
+        default_depends=('app.default_dispvm',),
         doc='Default VM to be used as Disposable VM for service calls.')
 
     updateable = qubes.property('updateable',
         default=(lambda self: not hasattr(self, 'template')),
+        default_depends=('template',),
         type=bool,
         setter=qubes.property.forbidden,
         doc='True if this machine may be updated on its own.')
@@ -244,6 +244,9 @@ fi
 %{python3_sitelib}/qubes/api/__pycache__/*
 %{python3_sitelib}/qubes/api/__init__.py
 %{python3_sitelib}/qubes/api/admin.py
+%{python3_sitelib}/qubes/api/eventbus.py
+%{python3_sitelib}/qubes/api/metrics.py
+%{python3_sitelib}/qubes/api/scheduler.py
 %{python3_sitelib}/qubes/api/internal.py
 %{python3_sitelib}/qubes/api/misc.py
 
@@ -304,8 +307,12 @@ fi
 
 %{python3_sitelib}/qubes/tests/api.py
 %{python3_sitelib}/qubes/tests/api_admin.py
+%{python3_sitelib}/qubes/tests/api_eventbus.py
+%{python3_sitelib}/qubes/tests/api_metrics.py
+%{python3_sitelib}/qubes/tests/api_scheduler.py
 %{python3_sitelib}/qubes/tests/api_misc.py
 %{python3_sitelib}/qubes/tests/app.py
+%{python3_sitelib}/qubes/tests/benchmark.py
 %{python3_sitelib}/qubes/tests/devices.py
 %{python3_sitelib}/qubes/tests/devices_block.py
 %{python3_sitelib}/qubes/tests/events.py